@@ -1,7 +1,9 @@
 import argparse
+import json
 import os
 import pickle
 import pprint
+from functools import partial
 
 import gymnasium as gym
 import numpy as np
@@ -17,11 +19,17 @@ from tianshou.utils.net.common import Net
 from tianshou.utils.net.discrete import NoisyLinear
 
 from Simulation import Simulation
+from airport_dataset import get_dataset, select_ports
+from scenarios import evaluation_ids, load_scenarios
+from instrumentation import merge_stats, stats_scalars
+from buffer_checkpoint import BufferCheckpoint
+from batched_simulation import BatchedSimulation
+from shm_vector_env import SharedMemoryVectorEnv
 
 port_count = 10
 plane_count = 1
 
-def get_args():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--task', type=str, default='Simulation')
     parser.add_argument('--reward-threshold', type=float, default=None)
@@ -42,9 +50,8 @@ def get_args():
     parser.add_argument('--step-per-collect', type=int, default=96)
     parser.add_argument('--update-per-step', type=float, default=0.125)
     parser.add_argument('--batch-size', type=int, default=256)
-    parser.add_argument(
-        '--hidden-sizes', type=int, nargs='*', default=[(port_count + 1)**2, 128, 128, 56]
-    )
+    # by default the first layer is (P + 1)**2 wide for the dense observation, see test_rainbow
+    parser.add_argument('--hidden-sizes', type=int, nargs='*', default=None)
     parser.add_argument('--training-num', type=int, default=8)
     parser.add_argument('--test-num', type=int, default=100)
     parser.add_argument('--logdir', type=str, default='log')
@@ -58,42 +65,116 @@ def get_args():
         '--device', type=str, default='cuda'
     )
     parser.add_argument("--save-interval", type=int, default=4)
-    args = parser.parse_known_args()[0]
+    # the replay buffer checkpoint only rewrites segments of this many rows changed since the last one
+    parser.add_argument('--buffer-segment-size', type=int, default=1024)
+    # uncompressed segments are memory-mapped on --resume instead of decompressed
+    parser.add_argument('--buffer-compression', type=str, default='none', choices=['zlib', 'none'])
+    parser.add_argument(
+        '--env-backend', type=str, default='dummy', choices=['dummy', 'batched', 'shmem']
+    )
+    # shmem backend: train workers default to one per train env up to the core count,
+    # test envs get the remaining cores
+    parser.add_argument('--train-workers', type=int, default=None)
+    parser.add_argument('--test-workers', type=int, default=None)
+    # "event" flies planes for their real durations, see Simulation.EventEngine, "jit" is the step
+    # engine compiled with numba, see step_kernel.py (dummy and shmem backends)
+    parser.add_argument('--engine', type=str, default='step', choices=['step', 'event', 'jit'])
+    # observations carry the valid actions; Rainbow never picks, nor explores, a masked one
+    # (dummy and shmem backends)
+    parser.add_argument('--action-mask', action="store_true")
+    # per-phase env timings and counters forwarded to tensorboard every --instrument-interval
+    # env steps (dummy and shmem backends)
+    parser.add_argument('--instrument', action="store_true")
+    parser.add_argument('--instrument-interval', type=int, default=1000)
+    # cProfile --profile-steps steps of train env --profile-env into --profile-path
+    parser.add_argument('--profile-steps', type=int, default=0)
+    parser.add_argument('--profile-env', type=int, default=0)
+    parser.add_argument('--profile-path', type=str, default='simulation.prof')
+    # training ends after the next test once this file exists, see sweep.py
+    parser.add_argument('--stop-file', type=str, default=None)
+    # test episodes are saved under --record-dir/test_<env> for replay.py (dummy and shmem backends)
+    parser.add_argument('--record-dir', type=str, default=None)
+    # The ports: --ports codes in that order, or every port narrowed down to --region
+    # (lat_min lat_max lon_min lon_max), the --top-k hubs and the first --port-count of those
+    # (0 for all of them). With none of these options the first 10 ports of ports.json.
+    # --hubs (a count of the top hubs or their codes) only puts demand on routes touching a hub,
+    # --sparse-observation then observes just those routes. See Simulation.Resources.
+    parser.add_argument('--ports', type=str, nargs='+', default=None)
+    parser.add_argument('--region', type=float, nargs=4, default=None)
+    parser.add_argument('--top-k', type=int, default=None)
+    parser.add_argument('--port-count', type=int, default=None)
+    parser.add_argument('--hubs', type=str, nargs='+', default=None)
+    parser.add_argument('--sparse-observation', action="store_true")
+    # scenario stores written by scenarios.py (dummy and shmem backends): train envs draw a
+    # stored episode on every reset, test envs replay the evaluation set in a fixed order,
+    # the same episodes on every test when it has --test-num scenarios
+    parser.add_argument('--train-scenarios', type=str, default=None)
+    parser.add_argument('--test-scenarios', type=str, default=None)
+    return parser
+
+
+def get_args():
+    args = get_parser().parse_known_args()[0]
     return args
 
 
-def test_rainbow(args=get_args()):
-    # env = Simulation(domestic_ports)
-    args.state_shape = (port_count * (port_count + 1))
-    args.action_shape = port_count
-    if args.reward_threshold is None:
-        default_reward_threshold = {"CartPole-v0": 195}
-        args.reward_threshold = 1000000000 # TODO:What is that ?
-    # train_envs = gym.make(args.task)
-    # you can also use tianshou.env.SubprocVectorEnv
-    train_envs = DummyVectorEnv(
-        [lambda: Simulation() for _ in range(args.training_num)]
-    )
-    # test_envs = gym.make(args.task)
-    test_envs = DummyVectorEnv(
-        [lambda: Simulation() for _ in range(args.test_num)]
-    )
-    # seed
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    train_envs.seed(args.seed)
-    test_envs.seed(args.seed)
+def make_port_index(args):
+    # --port-count never cuts an explicit --ports list and 0 keeps every port; without any port
+    # option the env keeps its first port_count ports
+    count = None if args.ports is not None else args.port_count
+    if count is None and args.ports is None and args.region is None and args.top_k is None:
+        count = port_count
+    return select_ports(get_dataset(), args.ports, count or None, args.region, args.top_k)
 
-    # model
 
+def parse_hubs(hubs):
+    # ["3"] is the top 3 hubs, anything else a list of codes
+    if hubs is not None and len(hubs) == 1 and hubs[0].isdigit():
+        return int(hubs[0])
+    return hubs
+
+
+def make_env(args, port_index, **kwargs):
+    return Simulation(engine=args.engine, action_mask=args.action_mask, ports=port_index,
+                      hubs=parse_hubs(args.hubs), sparse_observation=args.sparse_observation, **kwargs)
+
+
+def save_port_index(env, path):
+    # what policy_server.py needs to lay out observations for the trained policy
+    resources = env.resources
+    with open(path, "w") as f:
+        json.dump({
+            "codes": env.port_index.codes,
+            "sparse_observation": env.sparse_observation,
+            "route_indptr": resources.route_indptr.tolist(),
+            "route_indices": resources.route_indices.tolist(),
+        }, f)
+
+
+def make_env_fns(args, env_num, profile=False, record=None, scenarios=None, evaluation=False):
+    env_fns = []
+    store_size = len(load_scenarios(scenarios)) if scenarios and evaluation else None
+    for env_id in range(env_num):
+        profile_steps = args.profile_steps if profile and env_id == args.profile_env else 0
+        record_dir = os.path.join(args.record_dir, f"{record}_{env_id}") if record and args.record_dir else None
+        scenario_ids = evaluation_ids(store_size, env_id, env_num) if store_size else None
+        env_fns.append(partial(make_env, args, args.port_index, copy_observation=False,
+                               trajectory_retention="off", instrument=args.instrument, profile_steps=profile_steps,
+                               profile_path=args.profile_path, record_dir=record_dir, scenarios=scenarios,
+                               scenario_ids=scenario_ids))
+    return env_fns
+
+
+def make_net(args, device):
+    # Rainbow's dueling, noisy, distributional Q network; also rebuilt by policy_server.py to load policy.pth
     def noisy_linear(x, y):
         return NoisyLinear(x, y, args.noisy_std)
 
-    net = Net(
+    return Net(
         args.state_shape,
         args.action_shape,
         hidden_sizes=args.hidden_sizes,
-        device=args.device,
+        device=device,
         softmax=True,
         num_atoms=args.num_atoms,
         dueling_param=({
@@ -102,6 +183,58 @@ def test_rainbow(args=get_args()):
             "linear_layer": noisy_linear
         }),
     )
+
+
+def test_rainbow(args=get_args()):
+    # env = Simulation(domestic_ports)
+    # the shapes come from an env on the selected ports, port id i is args.port_index.codes[i]
+    args.port_index = make_port_index(args)
+    probe_env = make_env(args, args.port_index, trajectory_retention="off")
+    obs_space = probe_env.observation_space["obs"] if args.action_mask else probe_env.observation_space
+    args.state_shape = int(np.prod(obs_space.shape))
+    args.action_shape = len(args.port_index)
+    if args.hidden_sizes is None:
+        args.hidden_sizes = [args.state_shape + args.action_shape + 1, 128, 128, 56]
+    if args.reward_threshold is None:
+        default_reward_threshold = {"CartPole-v0": 195}
+        args.reward_threshold = 1000000000 # TODO:What is that ?
+    # train_envs = gym.make(args.task)
+    # you can also use tianshou.env.SubprocVectorEnv
+    if args.env_backend == 'batched':
+        # its envs are plain step-engine Simulations without these, so refuse rather than ignore them
+        if args.hubs is not None or args.sparse_observation or args.train_scenarios or args.test_scenarios:
+            raise ValueError("The batched backend has no --hubs, --sparse-observation or scenarios")
+        if args.action_mask or args.engine != 'step':
+            raise ValueError("The batched backend has no --action-mask and only the step --engine")
+        if args.instrument or args.record_dir:
+            raise ValueError("The batched backend has no --instrument or --record-dir")
+        train_envs = BatchedSimulation(args.training_num, ports=args.port_index)
+        test_envs = BatchedSimulation(args.test_num, ports=args.port_index)
+    elif args.env_backend == 'shmem':
+        cpu_count = os.cpu_count() or 1
+        train_workers = args.train_workers or min(args.training_num, cpu_count)
+        test_workers = args.test_workers or max(1, cpu_count - train_workers)
+        train_envs = SharedMemoryVectorEnv(make_env_fns(args, args.training_num, profile=True,
+                                                        scenarios=args.train_scenarios),
+                                           args.training_num, train_workers)
+        test_envs = SharedMemoryVectorEnv(make_env_fns(args, args.test_num, record="test", scenarios=args.test_scenarios,
+                                                       evaluation=True),
+                                          args.test_num, test_workers)
+    else:
+        train_envs = DummyVectorEnv(make_env_fns(args, args.training_num, profile=True,
+                                                 scenarios=args.train_scenarios))
+        # test_envs = gym.make(args.task)
+        test_envs = DummyVectorEnv(make_env_fns(args, args.test_num, record="test", scenarios=args.test_scenarios,
+                                                evaluation=True))
+    # seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    train_envs.seed(args.seed)
+    test_envs.seed(args.seed)
+
+    # model
+
+    net = make_net(args, args.device)
     optim = torch.optim.Adam(net.parameters(), lr=args.lr)
     policy = RainbowPolicy(
         net,
@@ -132,15 +265,45 @@ def test_rainbow(args=get_args()):
     # log
     log_path = os.path.join(args.logdir, args.task, "rainbow")
     writer = SummaryWriter(log_path)
+    save_port_index(probe_env, os.path.join(log_path, "port_index.json"))
+    probe_env.close()
     logger = TensorboardLogger(writer, save_interval=args.save_interval)
 
+    def make_buffer_checkpoint(buffer):
+        # observations are plane and passenger counts, exact in uint16
+        return BufferCheckpoint(
+            buffer, os.path.join(log_path, "train_buffer"), segment_size=args.buffer_segment_size,
+            compact_dtypes={"obs": np.uint16, "obs_next": np.uint16,
+                            "obs.obs": np.uint16, "obs_next.obs": np.uint16},  # with --action-mask
+            compression=None if args.buffer_compression == 'none' else args.buffer_compression,
+        )
+
+    buffer_checkpoint = make_buffer_checkpoint(buf)
+
     def save_best_fn(policy):
         torch.save(policy.state_dict(), os.path.join(log_path, "policy.pth"))
 
     def stop_fn(mean_rewards):
+        if args.stop_file and os.path.exists(args.stop_file):
+            return True
         return mean_rewards >= args.reward_threshold
 
+    # env stats are cumulative per env, each log writes the difference since the previous one
+    env_stats_log = {"env_step": None, "snapshot": None}
+
+    def log_env_stats(env_step):
+        if not args.instrument or not hasattr(train_envs, "get_env_attr"):
+            return
+        if env_stats_log["env_step"] is not None and env_step - env_stats_log["env_step"] < args.instrument_interval:
+            return
+        snapshot = merge_stats(stats.snapshot() for stats in train_envs.get_env_attr("stats"))
+        if env_stats_log["snapshot"] is not None:
+            interval = {name: value - env_stats_log["snapshot"][name] for name, value in snapshot.items()}
+            logger.write("train/env_step", env_step, stats_scalars(interval))
+        env_stats_log.update(env_step=env_step, snapshot=snapshot)
+
     def train_fn(epoch, env_step):
+        log_env_stats(env_step)
         # eps annealing, just a demo
         if env_step <= 100000:
             policy.set_eps(args.eps_train)
@@ -175,8 +338,8 @@ def test_rainbow(args=get_args()):
                 "optim": optim.state_dict(),
             }, ckpt_path
         )
-        buffer_path = os.path.join(log_path, "train_buffer.pkl")
-        pickle.dump(train_collector.buffer, open(buffer_path, "wb"))
+        # copies the changed buffer segments and writes them on a background thread
+        buffer_checkpoint.save()
         return ckpt_path
 
     if args.resume:
@@ -191,8 +354,15 @@ def test_rainbow(args=get_args()):
         else:
             print("Fail to restore policy and optim.")
         buffer_path = os.path.join(log_path, "train_buffer.pkl")
-        if os.path.exists(buffer_path):
-            train_collector.buffer = pickle.load(open(buffer_path, "rb"))
+        if buffer_checkpoint.exists():
+            buffer_checkpoint.restore()
+            print("Successfully restore buffer.")
+        elif os.path.exists(buffer_path):
+            # checkpoint of an older run
+            with open(buffer_path, "rb") as f:
+                train_collector.buffer = pickle.load(f)
+            buffer_checkpoint.close()
+            buffer_checkpoint = make_buffer_checkpoint(train_collector.buffer)
             print("Successfully restore buffer.")
         else:
             print("Fail to restore buffer.")
@@ -216,18 +386,23 @@ def test_rainbow(args=get_args()):
         resume_from_log=args.resume,
         save_checkpoint_fn=save_checkpoint_fn,
     )
+    buffer_checkpoint.close()
+    # also flushes the episodes still being written with --record-dir
+    train_envs.close()
+    test_envs.close()
     # assert stop_fn(result["best_reward"])
 
     if __name__ == "__main__":
         pprint.pprint(result)
         # Let's watch its performance!
-        env = Simulation()
+        env = make_env(args, args.port_index)
         policy.eval()
         policy.set_eps(args.eps_test)
         collector = Collector(policy, env)
-        result = collector.collect(n_episode=1, render=args.render)
-        rews, lens = result["rews"], result["lens"]
+        watch_result = collector.collect(n_episode=1, render=args.render)
+        rews, lens = watch_result["rews"], watch_result["lens"]
         print(f"Final reward: {rews.mean()}, length: {lens.mean()}")
+    return result
 
 
 def test_rainbow_resume(args=get_args()):
@@ -1,26 +1,37 @@
+import heapq
+import os
+import warnings
+
 import gymnasium as gym
-from gymnasium.spaces import Tuple, Discrete, Box, Dict
+from gymnasium.spaces import Tuple, Discrete, MultiDiscrete, MultiBinary, Box, Dict
 import numpy as np
 from enum import Enum
 
-import random
-import pygame
-import json
+from airport_dataset import PortIndex, get_dataset, select_ports
+from instrumentation import SimulationStats, StepProfiler
+from trajectory import EpisodeRecorder, TrajectoryRecorder
 
-port_distances = json.load(open("port_distances.json"))
 port_count = 10
 plane_count = 1
 max_passenger_count = 3000
-domestic_ports = json.load(open("ports.json"))
-domestic_ports = [[port_name, domestic_ports[port_name]] for port_name in domestic_ports.keys()][:port_count]
+demand_refresh_interval = 5  # steps between demand regenerations
 
 model_informations = {}
 possible_passengers_between_ports = {}
 
+
+def __getattr__(name):
+    # the airport data is loaded on first use (see airport_dataset), importing does no I/O
+    if name == "domestic_ports":
+        return get_dataset().ports(port_count)
+    if name == "distance_matrix":
+        return get_dataset().distances(port_count)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def interpolate_location(start_loc, end_loc, route_completion):
-    lat = float(start_loc["latitude"]) + (float(end_loc["latitude"]) - float(start_loc["latitude"])) * route_completion
-    lon = float(start_loc["longitude"]) + (
-                float(end_loc["longitude"]) - float(start_loc["longitude"])) * route_completion
+    lat = start_loc["latitude"] + (end_loc["latitude"] - start_loc["latitude"]) * route_completion
+    lon = start_loc["longitude"] + (end_loc["longitude"] - start_loc["longitude"]) * route_completion
     return {"latitude": lat, "longitude": lon}
 
 class PortTypes:
@@ -35,6 +46,64 @@ passenger_ranges = {
     PortTypes.HIGH_PORT: (50, 100)
 }
 
+
+def passenger_bounds(port_types):
+    # inclusive (low, high) passenger bounds for an array of port types
+    ranges = np.array([passenger_ranges[port_type] for port_type in sorted(passenger_ranges)])
+    bounds = ranges[np.asarray(port_types)]
+    return bounds[..., 0], bounds[..., 1]
+
+
+def generate_demand(rng, passenger_low, passenger_high, size=()):
+    # Draws the whole demand matrix in one call: row i uses the bounds of departure port i
+    # and the diagonal is zero. passenger_low/high are (..., P), the result is size + (..., P, P).
+    port_count = passenger_low.shape[-1]
+    shape = tuple(size) + passenger_low.shape + (port_count,)
+    demand = rng.integers(passenger_low[..., None], passenger_high[..., None] + 1, shape)
+    demand[..., np.arange(port_count), np.arange(port_count)] = 0
+    return demand
+
+
+def demand_ranks(demand_rows, departure_port_ids):
+    # Rank of every arrival port within its departure row, for a batch of (P,) rows.
+    # Rows are ordered by demand descending, ties broken by the departure port itself first
+    # and then every other port by id (the order of the old demand dict in get_reward).
+    port_count = demand_rows.shape[-1]
+    row_idx = np.arange(len(demand_rows))
+    key = np.arange(1, port_count + 1) - demand_rows.astype(np.int64) * (port_count + 1)
+    key[row_idx, departure_port_ids] -= np.asarray(departure_port_ids) + 1
+    order = np.argsort(key, axis=1)
+    ranks = np.empty_like(order)
+    ranks[row_idx[:, None], order] = np.arange(port_count)
+    return ranks
+
+
+def rank_reward(ranks, port_count):
+    # Plane.get_reward from demand ranks, works elementwise on any array of ranks
+    return (port_count - ranks) / port_count
+
+
+def board_passengers(flat_demand, route_keys, capacity):
+    # Boards every plane in one pass. flat_demand is a flattened demand view, route_keys the
+    # flat index of each plane's (departure, arrival) pair. Planes sharing a route fill up
+    # in plane id order; the boarded passengers are removed from flat_demand in place.
+    if len(route_keys) == 1:
+        boarded = np.minimum(flat_demand[route_keys], capacity).astype(np.int64)
+        flat_demand[route_keys] -= boarded
+        return boarded
+    order = np.argsort(route_keys, kind="stable")
+    keys = route_keys[order]
+    sorted_capacity = capacity[order]
+    new_group = np.concatenate(([True], keys[1:] != keys[:-1]))
+    seated_before = np.cumsum(sorted_capacity) - sorted_capacity
+    group_start = np.flatnonzero(new_group)
+    seated_before -= seated_before[group_start][np.cumsum(new_group) - 1]
+
+    boarded = np.empty(len(route_keys), dtype=np.int64)
+    boarded[order] = np.minimum(np.maximum(flat_demand[keys] - seated_before, 0), sorted_capacity)
+    np.subtract.at(flat_demand, route_keys, boarded)
+    return boarded
+
 class Port:
     def __init__(self, id, name, location, port_type):
         self.id = id
@@ -43,114 +112,346 @@ class Port:
         self.port_type = port_type
         self.random_passenger_range = passenger_ranges[port_type]
 
-        self.plane_parked = []  # [int -> plane_id]
-        self.plane_coming = []  # [int -> plane_id]
-        self.plane_departing = []  # [int -> plane_id]
-
-        self.current_passenger_count = None  # int
-        self.possible_passenger_count = {}  # {port: int}
-
-    def update(self, resources):
-        self.current_passenger_count = 0
-        for port_id in resources.ports.keys():
-            if port_id != self.id:
-                self.possible_passenger_count[port_id] = random.randint(*self.random_passenger_range)
-                self.current_passenger_count += self.possible_passenger_count[port_id]
-
-    def reset(self, continued_plane_id, resources, mode="train"):
-        self.current_passenger_count = 0
-        self.possible_passenger_count = {self.id: 0}
-        for port_id in resources.ports.keys():
-            if port_id != self.id:
-                self.possible_passenger_count[port_id] = random.randint(*self.random_passenger_range)
-                self.current_passenger_count += self.possible_passenger_count[port_id]
-        self.plane_coming = []
-        self.plane_departing = []
-        parked_plane_count = self.current_passenger_count // 250
-        self.plane_parked = []
-        plane_left = len(resources.planes) - continued_plane_id
-        for _ in range(min(parked_plane_count, plane_left)):
-            self.plane_parked.append(continued_plane_id)
-            resources.planes[continued_plane_id].reset(self.id, resources)
-            continued_plane_id += 1
-        return continued_plane_id
+        self.fleet = None  # Fleet, plane membership is derived from its arrays
+        self.possible_passenger_count = None  # np.ndarray[port_id -> int], row view of Resources.demand
 
+    @property
+    def current_passenger_count(self):
+        return int(self.possible_passenger_count.sum())
 
-class PlaneStatus(Enum):
-    WAIT = 0
-    FLY = 1
+    @property
+    def plane_parked(self):
+        return np.flatnonzero((self.fleet.current_port_id == self.id)
+                              & (self.fleet.status == PlaneStatus.WAIT.value)).tolist()
 
+    @property
+    def plane_coming(self):
+        return np.flatnonzero((self.fleet.arrival_port_id == self.id)
+                              & (self.fleet.status == PlaneStatus.FLY.value)).tolist()
 
-class ScheduleStatusInfo:
-    def __init__(self, status, departure_port_id, arrival_port_id):
-        self.step_count = 1
-        self.status: PlaneStatus = status
-        self.departure_port_id = departure_port_id
-        if self.status != PlaneStatus.WAIT:
-            assert (arrival_port_id != None or arrival_port_id != -1), \
-                "Arrival port id must not be None or -1 when status is not WAIT!!"
-            self.arrival_port_id = arrival_port_id
-        else:
-            assert (arrival_port_id == None or arrival_port_id == -1), \
-                "Arrival port id must be None or -1 when status is WAIT!!"
+    @property
+    def plane_departing(self):
+        return np.flatnonzero((self.fleet.departure_port_id == self.id)
+                              & (self.fleet.status == PlaneStatus.FLY.value)).tolist()
 
-    def expand_one_step(self):
-        self.step_count += 1
+
+class PlaneStatus(Enum):
+    WAIT = 0
+    FLY = 1
 
 
-class PlaneSchedule:
-    def __init__(self) -> None:
-        self.status_schedule = []
-        self.previous_status = None
+class Fleet:
+    # Every plane's state as one contiguous array per attribute, indexed by plane id.
+    def __init__(self, plane_count, port_names, trajectory_retention="off", trajectory_length=None):
+        self.size = plane_count
+        self.port_names = port_names
+        self.id = np.arange(plane_count)
+        self.capacity = np.where(self.id % 2 == 0, 250, 350)
+        self.model = np.full(plane_count, -1, dtype=np.int16)  # index into model_names, -1 for none
+        self.model_names = []
+        self.fuel = np.full(plane_count, np.nan, dtype=np.float32)
+
+        self.current_passenger_count = np.zeros(plane_count, dtype=np.int64)
+        self.current_passenger_ratio = np.zeros(plane_count, dtype=np.float32)
+
+        self.latitude = np.zeros(plane_count)
+        self.longitude = np.zeros(plane_count)
+        self.status = np.zeros(plane_count, dtype=np.int8)  # PlaneStatus value
+        self.current_port_id = np.full(plane_count, -1, dtype=np.int64)
+
+        self.route_completion = np.zeros(plane_count, dtype=np.float32)
+        self.departure_port_id = np.full(plane_count, -1, dtype=np.int64)
+        self.arrival_port_id = np.full(plane_count, -1, dtype=np.int64)
+
+        self.curr_fly_total_miles = np.full(plane_count, np.nan, dtype=np.float32)
+
+        self.trajectory = TrajectoryRecorder(plane_count, trajectory_retention, trajectory_length)
+        self.single_reward = np.zeros(1)  # reused by step_single
+
+    def reset(self, parked_port_ids, resources):
+        self.current_passenger_count[:] = 0
+        self.current_passenger_ratio[:] = 0
+        self.status[:] = PlaneStatus.WAIT.value
+
+        self.departure_port_id[:] = parked_port_ids
+        self.current_port_id[:] = parked_port_ids
+        self.arrival_port_id[:] = -1
+        self.latitude[:] = resources.port_latitude[parked_port_ids]
+        self.longitude[:] = resources.port_longitude[parked_port_ids]
+
+        self.route_completion[:] = 0
+        self.curr_fly_total_miles[:] = np.nan
+        self.trajectory.clear()
+
+    def step(self, action, resources, plane_ids=None, step=None, stats=None):
+        # Moves the given planes (all by default) to their action ports and returns one reward
+        # per plane. Boarding is resolved against the demand matrix in one vectorized pass.
+        # The move is added to the trajectory when the simulation step is given.
+        # stats (a SimulationStats, see instrumentation) gets the time of every phase.
+        if plane_ids is None:
+            if self.size == 1 and stats is None:
+                return self.step_single(action, resources, step)
+            plane_ids = self.id
+        departure, arrival, boarded, reward = self.depart(action, resources, plane_ids, stats)
+        self.arrive(plane_ids, arrival, resources)
+        if stats is not None:
+            stats.lap("move")
+
+        if step is not None:
+            status = np.where(departure == arrival, PlaneStatus.WAIT.value, PlaneStatus.FLY.value)
+            self.trajectory.record(step, plane_ids, departure, arrival, boarded, reward, status)
+        if stats is not None:
+            stats.lap("trajectory")
+        return reward
 
-    def add_step(self, status, departure_port_id, arrival_port_id=None):
-        if self.previous_status == None or status != self.previous_status:
-            schedule_info = ScheduleStatusInfo(status, departure_port_id, arrival_port_id)
-            self.status_schedule.append(schedule_info)
+    def step_single(self, action, resources, step=None):
+        # step() for a fleet of one plane on Python scalars: the same moves and rewards without
+        # numpy's per-call overhead on 1-element arrays, which dominated the default env's step
+        departure = int(self.departure_port_id[0])
+        arrival = int(action) if np.ndim(action) == 0 else int(np.asarray(action).reshape(-1)[0])
+        if arrival < 0 or arrival >= len(resources.ports):
+            raise IndexError(f"action {arrival} is out of the port range")
+        self.arrival_port_id[0] = arrival
+        boarded = 0
+        if departure == arrival:
+            self.curr_fly_total_miles[0] = 0
+            reward = -1.0
         else:
-            schedule_info: ScheduleStatusInfo = self.status_schedule[-1]
-            schedule_info.expand_one_step()
-        self.previous_status = schedule_info.status
+            self.curr_fly_total_miles[0] = resources.distance_matrix.distances[departure, arrival]
+            boarded = int(min(resources.demand[departure, arrival], int(self.capacity[0])))
+            port_count = len(resources.ports)
+            reward = (port_count - resources.board(departure, arrival, boarded)) / port_count
+        self.current_passenger_count[0] = boarded
+        self.current_passenger_ratio[0] = boarded / int(self.capacity[0])
+
+        self.current_port_id[0] = arrival
+        self.departure_port_id[0] = arrival
+        self.arrival_port_id[0] = -1
+        self.status[0] = PlaneStatus.WAIT.value
+        self.route_completion[0] = 0
+        self.latitude[0] = resources.port_latitude[arrival]
+        self.longitude[0] = resources.port_longitude[arrival]
+
+        self.single_reward[0] = reward
+        if step is not None and self.trajectory.retention != "off":
+            status = PlaneStatus.WAIT.value if departure == arrival else PlaneStatus.FLY.value
+            self.trajectory.record(step, self.id, departure, arrival, boarded, self.single_reward, status)
+        return self.single_reward
+
+    def depart(self, action, resources, plane_ids, stats=None):
+        # boards the planes for their action ports and rewards them, they stay at departure
+        port_count = len(resources.ports)
+        departure = self.departure_port_id[plane_ids]
+        arrival = np.broadcast_to(np.asarray(action, dtype=np.int64), departure.shape)
+        if stats is not None:
+            stats.count("invalid_actions", (~resources.valid_route(departure, arrival)).sum())
+
+        stay = departure == arrival
+        if stay.all():
+            # nobody moves: nothing boards and the demand, so the ranks, stay as they are
+            self.arrival_port_id[plane_ids] = arrival
+            self.curr_fly_total_miles[plane_ids] = 0
+            self.current_passenger_count[plane_ids] = 0
+            self.current_passenger_ratio[plane_ids] = 0
+            if stats is not None:
+                stats.lap("reward")
+            return departure, arrival, np.zeros(len(departure), dtype=np.int64), np.full(len(departure), -1.0)
+
+        self.arrival_port_id[plane_ids] = arrival
+        self.curr_fly_total_miles[plane_ids] = resources.distance_matrix[departure, arrival]
+        if stats is not None:
+            # pairs without a distance in port_distances.json use the filled-in estimate
+            stats.count("fallback_distances", resources.distance_matrix.missing[departure, arrival].sum())
+            stats.lap("distance")
 
-    def convert_to_table(self):
-        # convert the schedule to a table with visualizations
-        pass
+        # transfer passangers from port(departure) to plane
+        boarded = board_passengers(resources.demand.reshape(-1), departure * port_count + arrival,
+                                   self.capacity[plane_ids])
+        self.current_passenger_count[plane_ids] = boarded
+        self.current_passenger_ratio[plane_ids] = boarded / self.capacity[plane_ids]
+        if stats is not None:
+            stats.count("boarded_passengers", boarded.sum())
+            stats.lap("boarding")
+
+        # only rows something was boarded from changed
+        changed = departure[boarded > 0]
+        if len(changed):
+            resources.update_ranks(changed)
+        reward = np.where(stay, -1.0,
+                          rank_reward(resources.ranks[departure, arrival], port_count))
+        if stats is not None:
+            stats.lap("reward")
+        return departure, arrival, boarded, reward
+
+    def arrive(self, plane_ids, arrival, resources):
+        self.current_port_id[plane_ids] = arrival
+        self.departure_port_id[plane_ids] = arrival
+        self.arrival_port_id[plane_ids] = -1
+        self.status[plane_ids] = PlaneStatus.WAIT.value
+        self.route_completion[plane_ids] = 0
+        self.latitude[plane_ids] = resources.port_latitude[arrival]
+        self.longitude[plane_ids] = resources.port_longitude[arrival]
+
+
+class EventEngine:
+    # Discrete-event core behind Simulation(engine="event"). A plane flies for
+    # ceil(distance / MILE_COMPLETION_PER_HOUR) hours, then turns around at the arrival port for
+    # PREPARE_STEP_COUNT hours; a plane told to stay where it is holds for an hour. Arrivals and
+    # ready times are kept in a heap and the clock jumps straight to the next time a plane is
+    # ready, so only ready planes ever get an action.
+    ARRIVE = 0
+    READY = 1
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.events = []  # heap of (hour, kind, plane_id)
+        self.available = np.ones(fleet.size, dtype=bool)
+        self.departure_time = np.zeros(fleet.size, dtype=np.int64)
+        self.arrival_time = np.zeros(fleet.size, dtype=np.int64)
+
+    def reset(self):
+        self.events.clear()
+        self.available[:] = True
+
+    def depart(self, clock, plane_ids, departure, arrival, distance, resources):
+        # schedules the planes that just took an action, returns the hours until each is ready
+        fleet = self.fleet
+        hold = departure == arrival
+        flight_hours = np.maximum(1, np.ceil(distance / Plane.MILE_COMPLETION_PER_HOUR))
+        hours = np.where(hold, 1, flight_hours).astype(np.int64)
+        self.available[plane_ids] = False
+        self.departure_time[plane_ids] = clock
+        self.arrival_time[plane_ids] = clock + hours
+        if hold.any():
+            fleet.arrive(plane_ids[hold], arrival[hold], resources)
+        fleet.status[plane_ids[~hold]] = PlaneStatus.FLY.value
+        for plane_id, hour, held in zip(plane_ids.tolist(), (clock + hours).tolist(), hold.tolist()):
+            heapq.heappush(self.events, (hour, self.READY if held else self.ARRIVE, plane_id))
+        return np.where(hold, hours, hours + Plane.PREPARE_STEP_COUNT)
+
+    def advance(self, clock, horizon, resources):
+        # Processes the events hour by hour until at least one plane is ready and returns the new
+        # clock (capped at horizon). All events of an hour are applied together.
+        fleet = self.fleet
+        events = self.events
+        any_ready = self.available.any()
+        while events and events[0][0] < horizon:
+            hour = events[0][0]
+            if any_ready and hour > clock:
+                break
+            arrivals = []
+            ready = []
+            while events and events[0][0] == hour:
+                _, kind, plane_id = heapq.heappop(events)
+                (arrivals if kind == self.ARRIVE else ready).append(plane_id)
+            clock = hour
+            if arrivals:
+                fleet.arrive(arrivals, fleet.arrival_port_id[arrivals], resources)
+                for plane_id in arrivals:
+                    heapq.heappush(events, (hour + Plane.PREPARE_STEP_COUNT, self.READY, plane_id))
+            if ready:
+                self.available[ready] = True
+                any_ready = True
+        if not any_ready:
+            clock = horizon
+        self.update_positions(clock, resources)
+        return clock
+
+    def update_positions(self, clock, resources):
+        # route completion and interpolated location of the planes in the air
+        fleet = self.fleet
+        flying = np.flatnonzero(fleet.status == PlaneStatus.FLY.value)
+        if not len(flying):
+            return
+        completion = (clock - self.departure_time[flying]) / (self.arrival_time[flying] - self.departure_time[flying])
+        departure = fleet.departure_port_id[flying]
+        arrival = fleet.arrival_port_id[flying]
+        fleet.route_completion[flying] = completion
+        fleet.latitude[flying] = (resources.port_latitude[departure]
+                                  + (resources.port_latitude[arrival] - resources.port_latitude[departure]) * completion)
+        fleet.longitude[flying] = (resources.port_longitude[departure]
+                                   + (resources.port_longitude[arrival] - resources.port_longitude[departure]) * completion)
+
+
+class FleetField:
+    # Plane attribute stored in the Fleet array of the same name
+    def __set_name__(self, owner, name):
+        self.name = name
 
-    def clear(self):
-        self.status_schedule = []
-        self.previous_status = None
+    def __get__(self, plane, owner=None):
+        if plane is None:
+            return self
+        return getattr(plane.fleet, self.name)[plane.id].item()
+
+    def __set__(self, plane, value):
+        getattr(plane.fleet, self.name)[plane.id] = value
 
 
 class Plane:
-    def __init__(self, id, capacity):
+    # Thin view over one row of a Fleet
+    __slots__ = ("id", "fleet")
+
+    # TODO: change this parameter
+    MILE_COMPLETION_PER_HOUR = 100
+    PREPARE_STEP_COUNT = 2
+    image_size = (30, 30)
+
+    capacity = FleetField()  # int
+    fuel = FleetField()  # float: [0,1]
+    current_passenger_count = FleetField()  # int
+    current_passenger_ratio = FleetField()  # float: [0,1]
+    current_port_id = FleetField()  # int
+    route_completion = FleetField()  # float: [0,1]
+    departure_port_id = FleetField()  # int
+    arrival_port_id = FleetField()  # int
+    curr_fly_total_miles = FleetField()  # float
+
+    def __init__(self, id, fleet):
         self.id = id  # int
-        self.capacity = capacity  # int
-        self.model = None  # string
-        self.fuel = None  # float: [0,1]
-
-        self.current_passenger_count = None  # int
-        self.current_passenger_ratio = None  # float: [0,1]
-
-        self.location = None  # (x, y)
-        self.status = None  # PlaneStatus
-        self.current_port_id = None  # int
-
-        self.route_completion = None  # float: [0,1]
-        self.departure_port_id = None  # int
-        self.arrival_port_id = None  # int
-
-        self.curr_fly_total_miles = None  # int
-
-        self.schedule = PlaneSchedule()
-
-        # TODO: change this parameter
-        self.MILE_COMPLETION_PER_HOUR = 100
-        self.PREPARE_STEP_COUNT = 2
-        self.image = pygame.image.load("ucak.png")
-        self.image_size = (30, 30)
-        self.image = pygame.transform.scale(self.image, self.image_size)
-
-        self.stops = []
+        self.fleet = fleet
+
+    @property
+    def image(self):
+        # only needed for rendering, loaded once per process through the shared asset cache
+        from visualization import load_image
+        return load_image("ucak.png", self.image_size)
+
+    @property
+    def model(self):
+        model_id = self.fleet.model[self.id]
+        return None if model_id < 0 else self.fleet.model_names[model_id]
+
+    @model.setter
+    def model(self, model):
+        if model not in self.fleet.model_names:
+            self.fleet.model_names.append(model)
+        self.fleet.model[self.id] = self.fleet.model_names.index(model)
+
+    @property
+    def status(self):
+        return PlaneStatus(self.fleet.status[self.id])
+
+    @status.setter
+    def status(self, status):
+        self.fleet.status[self.id] = status.value
+
+    @property
+    def location(self):
+        return {"latitude": self.fleet.latitude[self.id], "longitude": self.fleet.longitude[self.id]}
+
+    @location.setter
+    def location(self, location):
+        self.fleet.latitude[self.id] = float(location["latitude"])
+        self.fleet.longitude[self.id] = float(location["longitude"])
+
+    @property
+    def stops(self):
+        return [self.fleet.port_names[port_id] for port_id in self.fleet.trajectory.stops(self.id)]
+
+    @property
+    def schedule(self):
+        # run-length encoded WAIT/FLY spans of this plane, see TrajectoryRecorder
+        return self.fleet.trajectory.plane_table(self.id)
 
     def init_model(self, model):
         if model not in model_informations:
@@ -161,148 +462,190 @@ class Plane:
         self.capacity = model_informations[model]["capacity"]
 
     def step(self, action, resources):
-        # self.schedule.add_step(self.status, self.departure_port_id, self.arrival_port_id)
-        self.arrival_port_id = action
-        try:
-            self.curr_fly_total_miles = port_distances[resources.ports[self.departure_port_id].name][
-                resources.ports[self.arrival_port_id].name]
-        except:
-            self.curr_fly_total_miles = 400
-        time_for_step = self.curr_fly_total_miles / self.MILE_COMPLETION_PER_HOUR
-
-        resources.ports[self.departure_port_id].plane_parked.remove(self.id)
-        resources.ports[self.departure_port_id].plane_departing.append(self.id)
-        resources.ports[self.arrival_port_id].plane_coming.append(self.id)
-
-        # transfer passangers from port(departure) to plane
-        self.current_passenger_count = min(self.capacity,
-                                           resources.ports[self.departure_port_id].possible_passenger_count[
-                                               self.arrival_port_id])
-        resources.ports[self.departure_port_id].possible_passenger_count[
-            self.arrival_port_id] -= self.current_passenger_count
-        resources.ports[self.departure_port_id].current_passenger_count -= self.current_passenger_count
-
-        resources.ports[self.departure_port_id].plane_departing.remove(self.id)
-        resources.ports[self.arrival_port_id].plane_coming.remove(self.id)
-        resources.ports[self.arrival_port_id].plane_parked.append(self.id)
-        self.location = resources.ports[self.arrival_port_id].location
-        # self.arrival.current_passenger_count += self.current_passenger_count
-
-        if self.current_port_id == action:
-            reward = -1
-        else:
-            reward = self.get_reward(resources)
-        self.current_port_id = self.arrival_port_id
-        self.departure_port_id = self.arrival_port_id
-        self.arrival_port_id = -1
-
-        self.stops.append(resources.ports[self.departure_port_id].name)
-
-        return reward
+        return resources.fleet.step([action], resources, plane_ids=[self.id])[0]
 
     def get_reward(self, resource):
-        passengers = resource.ports[self.current_port_id].possible_passenger_count
-        items = sorted(passengers.items(), key=lambda x:x[1], reverse=True)
-
-        i = 0
-        for item in items:
-            if item[0] == self.arrival_port_id:
-                break
-            i += 1
-
-        return (len(resource.ports)  - i) / len(resource.ports)
+        # rank of arrival_port_id in the current port's demand, kept up to date by Resources
+        return rank_reward(resource.ranks[self.current_port_id, self.arrival_port_id], len(resource.ports))
 
         # return (self.current_passenger_count / self.capacity) ** 2
 
-    def reset(self, parked_plane_id, resources):
-        self.current_passenger_count = 0
-        self.current_passenger_ratio = 0
-        self.status = PlaneStatus.WAIT
-
-        self.departure_port_id = parked_plane_id
-        self.current_port_id = parked_plane_id
-        self.arrival_port_id = -1
-        self.location = resources.ports[parked_plane_id].location
-
-        self.route_completion = 0
-        self.curr_fly_total_miles = None
-        self.schedule.clear()
-
-        self.stops.clear()
-
-
-class Visualization:
-    def __init__(self, width, height) -> None:
-        pygame.init()  # pygame'i başlatır
-        self.width = width
-        self.height = height
-        self.screen = pygame.display.set_mode((self.width, self.height))  # ekranı oluşturur
-        pygame.display.set_caption("Simulasyon")  # pencere
-        # pencere başlığını ayarlar
-        self.background_image = pygame.image.load("arkaplan.jpg")  # arkaplan resmini yükler
-        self.background_image = pygame.transform.scale(self.background_image, (self.width, self.height))
-
-        self.boundary_min_x = 0
-        self.boundary_min_y = 0
-        self.boundary_max_x = 0
-        self.boundary_max_y = 0
-        self.lat_length = self.boundary_max_x - self.boundary_min_x
-        self.lon_length = self.boundary_max_y - self.boundary_min_y
-
-    def convert_geoloc_to_cart(self, loc):
-        x_ratio = (loc["longitude"] - self.boundary_min_x) / self.lon_length
-        y_ratio = (loc["latitude"] - self.boundary_min_y) / self.lat_length
-        x_loc = x_ratio * self.width
-        y_loc = y_ratio * self.height
-        return (x_loc, y_loc)
-
-    def render_port(self, port: Port):
-        color = (0, 0, 0)
-        circle_radius = 5
-        size = 32
-        font = pygame.font.Font(None, size)  # font nesnesi oluşturur
-        text_surface = font.render(port.name, True, color)  # metni renderlar
-        port_cart_loc = self.convert_geoloc_to_cart(port.location)
-        self.screen.blit(text_surface, (port_cart_loc[0], port_cart_loc[1] + circle_radius))  # metni çizer
-        pygame.draw.circle(self.screen, color, self.location, circle_radius)
-
-    def render_plane(self, plane: Plane):
-        plane_cart_loc = self.convert_geoloc_to_cart(plane.location)
-        self.screen.blit(plane.image, plane_cart_loc)
-
-    def render(self, resources):
-        self.screen.blit(self.background_image, (0, 0))
-        for port in resources.ports.values():  # havalimanlarını çizer
-            self.render_port(port)
-        for plane in resources.planes.values():
-            self.render_plane(plane)
-        pygame.display.flip()
-
 
 class Resources:
-    def __init__(self) -> None:
+    def __init__(self, rng=None, plane_count=plane_count, trajectory_retention="off", trajectory_length=None,
+                 port_count=port_count, ports=None, hubs=None) -> None:
         self.ports = {}
         self.planes = {}
-
+        self.rng = np.random.default_rng() if rng is None else rng
+        dataset = get_dataset()
+        # ports is a PortIndex or a list of port codes, the first port_count ports of ports.json
+        # otherwise; port ids follow its order
+        if not isinstance(ports, PortIndex):
+            ports = select_ports(dataset, ports, port_count if ports is None else None)
+        self.port_index = ports
+        domestic_ports = dataset.ports(ports)
+        self.distance_matrix = dataset.distances(ports)
+        port_types = self.rng.integers(0, len(passenger_ranges), len(domestic_ports))
+
+        # observation[0] is the planes per port, observation[1:] is the demand matrix.
+        # Ports and planes update it in place so observe() does not rebuild it every step.
+        self.observation = np.zeros((len(domestic_ports) + 1, len(domestic_ports)))
+        self.demand = self.observation[1:]
+        # demand rank of every (departure, arrival) pair, see demand_ranks. A boarding only
+        # changes one cell of rank_keys (demand_ranks' sort keys); the rows it touched are
+        # re-sorted when ranks is next read, the reward reads the rank off the keys directly
+        self._ranks = np.zeros((len(domestic_ports), len(domestic_ports)), dtype=np.int64)
+        self.rank_keys = np.zeros((len(domestic_ports), len(domestic_ports)))
+        self.rank_key_base = np.tile(np.arange(1, len(domestic_ports) + 1), (len(domestic_ports), 1))
+        np.fill_diagonal(self.rank_key_base, 0)
+        self.stale_rank_rows = set()
+        # routes to another port with a known distance
+        self.reachable = ~self.distance_matrix.missing & ~np.eye(len(domestic_ports), dtype=bool)
+        coordinates = dataset.port_coordinates(ports)
+        self.port_latitude = np.array(coordinates[:, 0])
+        self.port_longitude = np.array(coordinates[:, 1])
+        # Pairs that get demand: all of them, or with hubs (a count of the top hubs, see
+        # AirportDataset.hub_scores, or their codes) only hub-and-spoke routes touching a hub.
+        # route_indptr/route_indices is the CSR layout of those pairs, see demand_csr.
+        self.route_mask = None
+        if hubs is not None:
+            if isinstance(hubs, int):
+                rank = np.empty(len(dataset), dtype=np.int64)
+                rank[dataset.hub_scores()] = np.arange(len(dataset))
+                hub_ids = np.argsort(rank[ports.dataset_ids], kind="stable")[:hubs]
+            else:
+                hub_ids = [ports.id(code) for code in hubs]
+            hub = np.zeros(len(domestic_ports), dtype=bool)
+            hub[hub_ids] = True
+            self.route_mask = (hub[:, None] | hub[None, :]) & ~np.eye(len(domestic_ports), dtype=bool)
+        routes = ~np.eye(len(domestic_ports), dtype=bool) if self.route_mask is None else self.route_mask
+        self.route_departure, self.route_indices = np.nonzero(routes)
+        self.route_indptr = np.concatenate(([0], np.cumsum(routes.sum(axis=1))))
+
+        self.fleet = Fleet(plane_count, [port_info[0] for port_info in domestic_ports],
+                           trajectory_retention, trajectory_length)
         for port_id, port_info in enumerate(domestic_ports):
-            self.ports[port_id] = Port(port_id, port_info[0], port_info[1], random.randint(0, 2))
+            self.ports[port_id] = Port(port_id, port_info[0], port_info[1], int(port_types[port_id]))
+            self.ports[port_id].possible_passenger_count = self.demand[port_id]
+            self.ports[port_id].fleet = self.fleet
+        self.passenger_low, self.passenger_high = passenger_bounds(port_types)
 
         for plane_id in range(plane_count):
-            if plane_id % 2 == 0:
-                capacity = 250
-            else:
-                capacity = 350
-            self.planes[plane_id] = Plane(plane_id, capacity)
+            self.planes[plane_id] = Plane(plane_id, self.fleet)
+
+    def reseed(self, seed=None):
+        # port types are drawn from the same generator so a seed fixes the whole episode
+        self.rng = np.random.default_rng(seed)
+        self.set_port_types(self.rng.integers(0, len(passenger_ranges), len(self.ports)))
+
+    def set_port_types(self, port_types):
+        for port_id, port in self.ports.items():
+            port.port_type = int(port_types[port_id])
+            port.random_passenger_range = passenger_ranges[port.port_type]
+        self.passenger_low, self.passenger_high = passenger_bounds(port_types)
+
+    def draw_demand(self, size=()):
+        demand = generate_demand(self.rng, self.passenger_low, self.passenger_high, size)
+        if self.route_mask is not None:
+            demand *= self.route_mask
+        return demand
+
+    def demand_csr(self):
+        # (indptr, indices, data) of the demand on the routes, row per departure port
+        return self.route_indptr, self.route_indices, self.demand[self.route_departure, self.route_indices]
+
+    def set_demand(self, demand):
+        self.demand[:] = demand
+        self.update_ranks()
+
+    def valid_route(self, departure, arrival):
+        # another reachable port with passengers waiting for it
+        return self.reachable[departure, arrival] & (self.demand[departure, arrival] > 0)
+
+    def action_mask(self, port_ids):
+        # valid destinations from each of port_ids; a port with none keeps staying as its only action
+        mask = self.reachable[port_ids] & (self.demand[port_ids] > 0)
+        stuck = ~mask.any(axis=1)
+        if stuck.any():
+            mask[stuck, port_ids[stuck]] = True
+        return mask
+
+    @property
+    def ranks(self):
+        if self.stale_rank_rows:
+            port_ids = np.array(sorted(self.stale_rank_rows))
+            self.stale_rank_rows.clear()
+            self._ranks[port_ids] = demand_ranks(self.demand[port_ids], port_ids)
+        return self._ranks
+
+    def update_ranks(self, port_ids=None):
+        # demand only changes on refresh (all rows) and boarding (the departure rows)
+        if port_ids is None:
+            port_ids = np.arange(len(self.ports))
+            self.stale_rank_rows.clear()
+        elif self.stale_rank_rows:
+            self.stale_rank_rows.difference_update(np.asarray(port_ids).tolist())
+        self.rank_keys[port_ids] = self.rank_key_base[port_ids] - self.demand[port_ids] * (len(self.ports) + 1)
+        self._ranks[port_ids] = demand_ranks(self.demand[port_ids], port_ids)
+
+    def board(self, departure, arrival, boarded):
+        # One plane boarding from a single pair, returns the pair's rank afterwards. The lower
+        # demand raises its key by boarded * (P + 1); the rank is the count of smaller keys in
+        # the row, O(P) without re-sorting it.
+        key_row = self.rank_keys[departure]
+        if boarded:
+            self.demand[departure, arrival] -= boarded
+            key_row[arrival] += boarded * (len(self.ports) + 1)
+            self.stale_rank_rows.add(departure)
+        return int(np.count_nonzero(key_row < key_row[arrival]))
+
+    def reset_fleet(self):
+        # Each port, in port order, gets demand // 250 parked planes; the rest wait at the last port.
+        parked_counts = self.demand.sum(axis=1).astype(np.int64) // 250
+        port_ids = np.searchsorted(np.cumsum(parked_counts), self.fleet.id, side="right")
+        self.fleet.reset(np.minimum(port_ids, len(self.ports) - 1), self)
 
 
 class Simulation(gym.Env):
     metadata = {'render.modes': ['human', 'machine']}
 
-    def __init__(self):
-        self.seed = np.random.seed
-        self.sim_duration = 168  # in hour
-        self.step_count = 0
-        self.resources = Resources()
+    def __init__(self, copy_observation=True, pregenerate_demand=False, plane_count=plane_count, visualize=False,
+                 trajectory_retention="off", trajectory_length=None, port_count=port_count, instrument=False,
+                 profile_steps=0, profile_path="simulation.prof", engine="step", sim_duration=168,
+                 action_mask=False, render_fps=30, frame_skip=1, record_dir=None, ports=None, hubs=None,
+                 sparse_observation=False, scenarios=None, scenario_ids=None):
+        # with copy_observation=False observe() returns the internal buffer itself, which is
+        # only safe for callers that copy it anyway (e.g. DummyVectorEnv stacking observations)
+        self.copy_observation = copy_observation
+        self.sim_duration = sim_duration  # in hour
+        self.step_count = 0  # the clock, in hours
+        # trajectory_retention is "off", "last" (the last trajectory_length records) or "full"; the
+        # per plane stops and schedule are only kept when asked for, recording costs most of a step
+        # port_count takes the first ports of ports.json, ports (a PortIndex or codes, see
+        # select_ports) any subset; hubs limits demand to hub-and-spoke routes (see Resources)
+        self.resources = Resources(plane_count=plane_count, trajectory_retention=trajectory_retention,
+                                   trajectory_length=trajectory_length, port_count=port_count, ports=ports,
+                                   hubs=hubs)
+        self.port_index = self.resources.port_index
+
+        # with pregenerate_demand the whole episode's demand (reset + every refresh) is drawn
+        # up front on reset as one (refresh_count + 1, P, P) array
+        self.pregenerate_demand = pregenerate_demand
+        self.demand_schedule = None
+        self.demand_refresh_count = 0
+
+        # scenarios (a ScenarioStore or its directory, see scenarios.py) replaces all of that: a
+        # reset takes the port types, plane positions and demand trace of a stored scenario, the
+        # next of scenario_ids in turn or, without them, one drawn with the env's seed
+        if isinstance(scenarios, str):
+            from scenarios import load_scenarios
+            scenarios = load_scenarios(scenarios)
+        if scenarios is not None:
+            scenarios.check(self.resources, sim_duration)
+        self.scenarios = scenarios
+        self.scenario_ids = scenario_ids
+        self.scenario_resets = 0
+        self.scenario_id = None
 
         # one_space = Tuple((Discrete(len(ports)), Discrete(len(ports)),
         #                    Box(low=np.array([0, 0, 0]), high=np.array([100, 100, 100]), shape=(3,),
@@ -316,7 +659,7 @@ class Simulation(gym.Env):
 
         port_count = len((self.resources.ports))
         high_values = (np.ones((len(self.resources.ports), len(self.resources.ports))) - np.diag([1]*len(self.resources.ports))) * max_passenger_count
-        high_values = np.vstack((np.ones(port_count), high_values))
+        high_values = np.vstack((np.full(port_count, plane_count), high_values))
         # high_values = np.concatenate((np.array([len(self.resources.ports)]), high_values.flatten()))
         # self.observation_space = Box(low=np.zeros(len(self.resources.ports) * len(self.resources.ports) + 1),
         #      high=high_values,
@@ -325,62 +668,279 @@ class Simulation(gym.Env):
 
 
         self.observation_space = Box(low=np.zeros((port_count + 1, port_count)), high=high_values, shape=(port_count+1, port_count), dtype=np.integer)
+        # sparse_observation flattens it to the planes per port followed by the demand of every
+        # route in CSR order (Resources.demand_csr), P + routes values instead of (P + 1) * P
+        self.sparse_observation = sparse_observation
+        if sparse_observation:
+            resources = self.resources
+            self.route_keys = resources.route_departure * port_count + resources.route_indices
+            self.sparse_state = np.zeros(port_count + len(self.route_keys))
+            self.observation_space = Box(low=np.zeros(len(self.sparse_state)),
+                                         high=np.concatenate((high_values[0], high_values[1:].reshape(-1)[self.route_keys])),
+                                         shape=self.sparse_state.shape, dtype=np.integer)
+        # with action_mask the observation is {"obs": state, "mask": valid actions}, the form
+        # tianshou's DQN family masks their q values and exploration with
+        self.use_action_mask = action_mask
+        if action_mask:
+            mask_space = MultiBinary(port_count) if plane_count == 1 else MultiBinary([plane_count, port_count])
+            self.observation_space = Dict({"obs": self.observation_space, "mask": mask_space})
+
+        # a single action sends every plane to the same port, as before; with a fleet step()
+        # also takes one action per plane
+        if plane_count == 1:
+            self.action_space = Discrete(len(self.resources.ports))
+        else:
+            self.action_space = MultiDiscrete([len(self.resources.ports)] * plane_count)
 
-        self.action_space = Discrete(len(self.resources.ports))
-
-        self.visualize = False
+        # pygame is only imported when a Visualization is created, so headless envs never load it.
+        # A frame is drawn every frame_skip steps and at most render_fps times a second (None: no
+        # limit), the steps in between skip rendering instead of waiting for it
+        self.visualize = visualize
         if self.visualize:
-            self.visualizator = Visualization(800, 600)
+            from visualization import Visualization
+            self.visualizator = Visualization(800, 600, fps=render_fps, frame_skip=frame_skip)
+
+        # engine="step" moves every plane to its action port within the hour; engine="event" flies
+        # them for real durations (see EventEngine), a step then only takes actions for the planes
+        # in info["available"] and advances the clock to when the next ones are ready
+        # engine="jit" is the step engine run by the numba kernels of step_kernel.py, or by the
+        # numpy code above when numba is not installed
+        if engine not in ("step", "event", "jit"):
+            raise ValueError(f"Unknown engine {engine!r}, expected 'step', 'event' or 'jit'")
+        self.engine = EventEngine(self.resources.fleet) if engine == "event" else None
+        self.kernel = None
+        if engine == "jit":
+            import step_kernel
+            if step_kernel.available:
+                self.kernel = step_kernel.StepKernel(self.resources)
+            else:
+                warnings.warn("numba is not installed, engine='jit' runs the numpy step engine")
+
+        # record_dir saves every finished episode (plane moves and demand, see EpisodeRecorder) as
+        # record_dir/episode_00000.npz, ... for replay.py to draw later without slowing the env down
+        self.record_dir = record_dir
+        self.recorder = None
+        self.recorded_episodes = 0
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+            self.recorder = EpisodeRecorder([port.name for port in self.resources.ports.values()],
+                                            self.resources.port_latitude, self.resources.port_longitude)
+
+        # instrument=True times every phase of step/reset and counts events (see instrumentation),
+        # reported in the info dict and by get_stats(); off, the only cost is a None check per phase
+        self.stats = SimulationStats() if instrument else None
+        # profile_steps > 0 runs cProfile over that many steps and writes it to profile_path
+        if profile_steps > 0:
+            self.step = StepProfiler(self.step, profile_steps, profile_path).step
 
         # TODO: Do we need it ?
         # self.reset()
 
     def step(self, action):
+        if self.engine is not None:
+            return self.event_step(action)
         done = False
-        reward = 0
-        for i, plane in self.resources.planes.items():
-            reward += plane.step(action, self.resources)
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+        fleet = self.resources.fleet
+        if self.kernel is not None:
+            plane_reward = self.kernel.step(action, self.step_count, stats)
+            departure = self.kernel.departure
+        else:
+            departure = fleet.current_port_id.copy() if self.recorder is not None else None
+            plane_reward = fleet.step(action, self.resources, step=self.step_count, stats=stats)
+        reward = float(plane_reward.sum())
+
+        if self.step_count % demand_refresh_interval == 0:
+            if self.kernel is not None:
+                self.kernel.set_demand(self.next_demand())
+            else:
+                self.resources.set_demand(self.next_demand())
+            if stats is not None:
+                stats.count("demand_refreshes")
+                stats.lap("demand_refresh")
 
-        if self.step_count % 5 == 0:
-            for port in self.resources.ports.values():
-                port.update(self.resources)
+        if self.recorder is not None:
+            self.recorder.record(self.step_count, fleet.id, departure, fleet.current_port_id, 1, plane_reward)
+            self.recorder.record_demand(self.step_count + 1, self.resources.demand)
 
         if self.visualize:
             self.visualizator.render(self.resources)
+            if stats is not None:
+                stats.lap("render")
 
         self.step_count += 1
 
         if self.sim_duration == self.step_count:
             done = True
+            self.save_recording()
             # self.reset()
             # TODO: Do we need self.reset() ?
 
-        return self.observe(), reward, done, False, {}
+        observation = self.observe()
+        if stats is not None:
+            stats.lap("observe")
+            stats.count("steps")
+            return observation, reward, done, False, {"stats": stats.finish()}
+        return observation, reward, done, False, {}
+
+    def event_step(self, action):
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+        resources = self.resources
+        fleet = resources.fleet
+        plane_ids = np.flatnonzero(self.engine.available)
+        action = np.asarray(action, dtype=np.int64)
+        if action.ndim:
+            action = action[plane_ids]
+        departure, arrival, boarded, reward = fleet.depart(action, resources, plane_ids, stats)
+        busy_hours = self.engine.depart(self.step_count, plane_ids, departure, arrival,
+                                        fleet.curr_fly_total_miles[plane_ids], resources)
+        fleet.trajectory.record(self.step_count, plane_ids, departure, arrival, boarded, reward,
+                                fleet.status[plane_ids], span=busy_hours)
+        if stats is not None:
+            stats.lap("trajectory")
+
+        clock = self.engine.advance(self.step_count, self.sim_duration, resources)
+        if stats is not None:
+            stats.lap("move")
+        # demand refreshes at every multiple of demand_refresh_interval passed, as in step();
+        # only the last of them is drawn since each one replaces the whole matrix
+        refreshes = -(-clock // demand_refresh_interval) - -(-self.step_count // demand_refresh_interval)
+        if refreshes:
+            self.demand_refresh_count += refreshes - 1
+            resources.set_demand(self.next_demand())
+            if stats is not None:
+                stats.count("demand_refreshes", refreshes)
+                stats.lap("demand_refresh")
+
+        if self.recorder is not None:
+            self.recorder.record(self.step_count, plane_ids, departure, arrival,
+                                 self.engine.arrival_time[plane_ids] - self.step_count, reward)
+            self.recorder.record_demand(clock, resources.demand)
+            if clock >= self.sim_duration:
+                self.save_recording()
+
+        if self.visualize:
+            self.visualizator.render(resources)
+            if stats is not None:
+                stats.lap("render")
+
+        info = {"available": self.engine.available.copy(), "hours": clock - self.step_count}
+        self.step_count = clock
+        observation = self.observe()
+        if stats is not None:
+            stats.lap("observe")
+            stats.count("steps")
+            info["stats"] = stats.finish()
+        return observation, float(reward.sum()), clock >= self.sim_duration, False, info
+
+    def save_recording(self):
+        if self.recorder is None:
+            return
+        path = os.path.join(self.record_dir, f"episode_{self.recorded_episodes:05d}.npz")
+        self.recorder.save(path, self.sim_duration)
+        self.recorded_episodes += 1
+
+    def get_stats(self, pop=False):
+        # accumulated phase seconds and counters, pop=True also starts a new interval
+        if self.stats is None:
+            return None
+        return self.stats.pop() if pop else self.stats.snapshot()
+
+    def seed(self, seed=None):
+        self.resources.reseed(seed)
+        return [seed]
+
+    def next_demand(self):
+        if self.demand_schedule is not None:
+            demand = self.demand_schedule[self.demand_refresh_count]
+        else:
+            demand = self.resources.draw_demand()
+        self.demand_refresh_count += 1
+        return demand
+
+    def next_scenario_id(self):
+        if self.scenario_ids is not None:
+            scenario_id = self.scenario_ids[self.scenario_resets % len(self.scenario_ids)]
+        else:
+            scenario_id = self.resources.rng.integers(len(self.scenarios))
+        self.scenario_resets += 1
+        return int(scenario_id)
 
     def reset(self, seed=None, options=None):
-        current_plane_id = 0
-        for port in self.resources.ports.values():
-            current_plane_id = port.reset(current_plane_id, self.resources)
-        for i in range(current_plane_id, len(self.resources.planes)):
-            self.resources.planes[i].reset(len(self.resources.ports) - 1, self.resources)
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+        if seed is not None:
+            self.seed(seed)
+        self.demand_refresh_count = 0
+        if self.scenarios is not None:
+            self.scenario_id = self.next_scenario_id()
+            self.resources.set_port_types(self.scenarios.port_types[self.scenario_id])
+            self.demand_schedule = self.scenarios.demand[self.scenario_id]
+        elif self.pregenerate_demand:
+            refresh_count = len(range(0, self.sim_duration, demand_refresh_interval))
+            self.demand_schedule = self.resources.draw_demand((refresh_count + 1,))
+        self.resources.set_demand(self.next_demand())
+        if self.scenarios is not None:
+            self.resources.fleet.reset(self.scenarios.plane_port_ids[self.scenario_id], self.resources)
+        else:
+            self.resources.reset_fleet()
+        if self.engine is not None:
+            self.engine.reset()
+        if self.kernel is not None:
+            self.kernel.count_planes()
 
         self.step_count = 0
-
-        return self.observe(), {}
+        if self.recorder is not None:
+            self.recorder.start(self.resources.fleet.current_port_id, self.resources.demand)
+
+        # same keys as the step info so the Collector can stack them
+        info = {} if self.engine is None else {"available": self.engine.available.copy(), "hours": 0}
+        observation = self.observe()
+        if stats is not None:
+            stats.lap("reset")
+            stats.count("resets")
+            info["stats"] = stats.finish()
+        return observation, info
 
     def observe(self):
-        plane_departure_port_id = self.resources.planes[0].departure_port_id
-        port_passenger_mat = np.zeros((len(self.resources.ports), len(self.resources.ports)))
-        for port in self.resources.ports.values():
-            for other_port in self.resources.ports.values():
-                port_passenger_mat[port.id][other_port.id] = port.possible_passenger_count[other_port.id]
-        # state = np.concatenate(([plane_departure_port_id], port_passenger_mat.flatten()))
-        current_port_vec = np.zeros(len(self.resources.ports))
-        current_port_vec[plane_departure_port_id] = 1
-        state = np.vstack((current_port_vec, port_passenger_mat))
-        # state = np.zeros((len(self.resources.ports) + 1, len(self.resources.ports)))
+        # first row counts the planes on the ground at each port, a one-hot of the current port for
+        # a single plane
+        state = self.resources.observation
+        fleet = self.resources.fleet
+        if self.kernel is not None:
+            pass  # the step kernel keeps the counts up to date
+        elif self.engine is None:
+            state[0] = np.bincount(fleet.current_port_id, minlength=len(self.resources.ports))
+        else:
+            grounded = fleet.current_port_id[fleet.status == PlaneStatus.WAIT.value]
+            state[0] = np.bincount(grounded, minlength=len(self.resources.ports))
+        if self.sparse_observation:
+            port_count = len(state[0])
+            self.sparse_state[:port_count] = state[0]
+            np.take(self.resources.demand.reshape(-1), self.route_keys, out=self.sparse_state[port_count:])
+            state = self.sparse_state
+        if self.copy_observation:
+            state = state.copy()
+        if self.use_action_mask:
+            return {"obs": state, "mask": self.action_mask()}
         return state
 
+    def action_mask(self):
+        # valid destinations of every plane (same port, no demand and unknown distance masked),
+        # (P,) for a single plane; planes in the air under the event engine get none
+        fleet = self.resources.fleet
+        mask = self.resources.action_mask(fleet.current_port_id)
+        if self.engine is not None:
+            mask[~self.engine.available] = False
+        if len(fleet.id) == 1:
+            return mask[0]
+        return mask
+
         # for plane in self.resources.planes.values():
         #     # print([plane.departure_port_id, plane.arrival_port_id, plane.current_passenger_count, plane.current_passenger_ratio, plane.route_completion])
         #     observation = np.array([plane.departure_port_id, plane.arrival_port_id, plane.current_passenger_count,
@@ -391,4 +951,5 @@ class Simulation(gym.Env):
         pass
 
     def close(self):
-        pass
+        if self.recorder is not None:
+            self.recorder.close()
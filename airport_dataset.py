@@ -0,0 +1,177 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from distance_matrix import DistanceMatrix
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+PORTS_PATH = os.path.join(DATA_DIR, "ports.json")
+DISTANCES_PATH = os.path.join(DATA_DIR, "port_distances.json")
+BUNDLE_PATH = os.path.join(DATA_DIR, "airports")
+
+# one .npy per array so np.load can memory-map each of them
+BUNDLE_FILES = ("codes", "coordinates", "distances", "missing")
+
+
+class AirportDataset:
+    # Port codes, float64 (latitude, longitude) per port and the filled float32 distance
+    # matrix, all indexed by port id in ports.json order.
+    def __init__(self, codes, coordinates, distances, missing) -> None:
+        self.codes = [str(code) for code in codes]
+        self.coordinates = coordinates  # (P, 2)
+        self.distance_matrix = DistanceMatrix(self.codes, distances, missing)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def ports(self, port_count=None):
+        # [[code, {"latitude": float, "longitude": float}], ...] for the first port_count ports
+        # or the ports of a PortIndex
+        codes = port_count.codes if isinstance(port_count, PortIndex) else self.codes[:port_count]
+        return [[code, {"latitude": float(lat), "longitude": float(lon)}]
+                for code, (lat, lon) in zip(codes, self.port_coordinates(port_count))]
+
+    def distances(self, port_count=None):
+        # DistanceMatrix of the first port_count ports, a view into the (memory-mapped) full matrix
+        # (a PortIndex selects any subset, copied unless it is such a prefix)
+        if isinstance(port_count, PortIndex):
+            if not port_count.is_prefix():
+                ids = np.ix_(port_count.dataset_ids, port_count.dataset_ids)
+                matrix = self.distance_matrix
+                return DistanceMatrix(port_count.codes, matrix.distances[ids], matrix.missing[ids])
+            port_count = len(port_count)
+        matrix = self.distance_matrix
+        return DistanceMatrix(matrix.codes[:port_count], matrix.distances[:port_count, :port_count],
+                              matrix.missing[:port_count, :port_count])
+
+    def port_coordinates(self, ports=None):
+        # (P, 2) latitude, longitude of a PortIndex or of the first `ports` ports
+        if isinstance(ports, PortIndex):
+            return np.asarray(self.coordinates)[ports.dataset_ids]
+        return np.asarray(self.coordinates[:ports])
+
+    def hub_scores(self):
+        # Order of how hub-like each port is: most known routes in port_distances.json first, ties
+        # broken by the shortest mean distance to the other ports. ports.json has no port size.
+        known_routes = (~np.asarray(self.distance_matrix.missing)).sum(axis=1)
+        mean_distance = np.asarray(self.distance_matrix.distances).mean(axis=1)
+        return np.lexsort((mean_distance, -known_routes))
+
+
+class PortIndex:
+    # The ports a simulation runs on: port id i is codes[i], row dataset_ids[i] of the dataset.
+    # The order is fixed by the selection, so ids stay stable for a saved policy.
+    def __init__(self, codes, dataset_ids):
+        self.codes = [str(code) for code in codes]
+        self.dataset_ids = np.asarray(dataset_ids, dtype=np.int64)
+        self.ids = {code: port_id for port_id, code in enumerate(self.codes)}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def id(self, code):
+        return self.ids[code]
+
+    def code(self, port_id):
+        return self.codes[port_id]
+
+    def is_prefix(self):
+        return bool(np.array_equal(self.dataset_ids, np.arange(len(self.codes))))
+
+
+def select_ports(dataset, ports=None, port_count=None, region=None, top_k=None):
+    # PortIndex of the given codes (in that order) or of every port, narrowed down to the ports
+    # inside region (lat_min, lat_max, lon_min, lon_max), then to the top_k hubs (see
+    # hub_scores) and finally to the first port_count of what is left
+    if ports is not None:
+        missing = [code for code in ports if code not in dataset.distance_matrix.index]
+        if missing:
+            raise KeyError(f"Unknown port codes {missing}")
+        ids = np.array([dataset.distance_matrix.index[code] for code in ports], dtype=np.int64)
+    else:
+        ids = np.arange(len(dataset))
+    if region is not None:
+        lat_min, lat_max, lon_min, lon_max = region
+        latitude, longitude = np.asarray(dataset.coordinates)[ids].T
+        ids = ids[(latitude >= lat_min) & (latitude <= lat_max) & (longitude >= lon_min) & (longitude <= lon_max)]
+    if top_k is not None:
+        rank = np.empty(len(dataset), dtype=np.int64)
+        rank[dataset.hub_scores()] = np.arange(len(dataset))
+        ids = ids[np.sort(np.argsort(rank[ids], kind="stable")[:top_k])]
+    if port_count is not None:
+        ids = ids[:port_count]
+    if len(ids) < 2:
+        raise ValueError("A simulation needs at least two ports")
+    return PortIndex([dataset.codes[i] for i in ids], ids)
+
+
+def compile_dataset(ports_path=PORTS_PATH, distances_path=DISTANCES_PATH, output_dir=BUNDLE_PATH, fill="haversine"):
+    with open(ports_path) as f:
+        ports = json.load(f)
+    with open(distances_path) as f:
+        port_distances = json.load(f)
+    ports = [[code, ports[code]] for code in ports.keys()]
+    distance_matrix = DistanceMatrix.from_json(port_distances, ports, fill=fill)
+    coordinates = np.array([[float(port[1]["latitude"]), float(port[1]["longitude"])] for port in ports])
+
+    arrays = {
+        "codes": np.array(distance_matrix.codes),
+        "coordinates": coordinates,
+        "distances": distance_matrix.distances,
+        "missing": distance_matrix.missing,
+    }
+    if output_dir is None:
+        return AirportDataset(arrays["codes"], coordinates, distance_matrix.distances, distance_matrix.missing)
+    os.makedirs(output_dir, exist_ok=True)
+    for name in BUNDLE_FILES:
+        # write then rename so a reader never maps a half written file; the temporary name is
+        # unique so processes compiling the same bundle at once do not write into each other's file
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir, prefix=name + ".", suffix=".npy")
+        # mkstemp files are private, the bundle is readable by everyone like a plain np.save
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, arrays[name])
+        os.replace(tmp_path, os.path.join(output_dir, name + ".npy"))
+    return AirportDataset(arrays["codes"], coordinates, distance_matrix.distances, distance_matrix.missing)
+
+
+def load_dataset(path=BUNDLE_PATH, mmap=True):
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+              for name in BUNDLE_FILES}
+    return AirportDataset(arrays["codes"], arrays["coordinates"], arrays["distances"], arrays["missing"])
+
+
+def bundle_is_fresh(path=BUNDLE_PATH, sources=(PORTS_PATH, DISTANCES_PATH)):
+    bundle_files = [os.path.join(path, name + ".npy") for name in BUNDLE_FILES]
+    if not all(os.path.exists(file) for file in bundle_files):
+        return False
+    bundle_mtime = min(os.path.getmtime(file) for file in bundle_files)
+    return all(os.path.getmtime(source) <= bundle_mtime for source in sources)
+
+
+_dataset = None
+
+
+def get_dataset():
+    # Loaded on first use and then shared by every env in the process. The bundle is compiled
+    # from the JSON files when it is missing or older than them; the memory-mapped pages are
+    # shared read-only with forked worker processes.
+    global _dataset
+    if _dataset is None:
+        if bundle_is_fresh():
+            _dataset = load_dataset()
+        else:
+            try:
+                compile_dataset()
+                _dataset = load_dataset()
+            except OSError:
+                # read-only checkout, keep the compiled arrays in memory
+                _dataset = compile_dataset(output_dir=None)
+    return _dataset
+
+
+if __name__ == "__main__":
+    dataset = compile_dataset()
+    print(f"Compiled {len(dataset)} ports into {BUNDLE_PATH}")
@@ -0,0 +1,184 @@
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from airport_dataset import get_dataset
+from batched_simulation import BatchedSimulation
+from Simulation import port_count
+
+# Non-learned single plane policies. Each takes a stack of Simulation.observe() outputs,
+# (N, P + 1, P): row 0 is the one-hot of the plane's port, rows 1: the demand matrix, and
+# returns one destination per env.
+
+
+def current_ports(obs):
+    return obs[:, 0].argmax(axis=1)
+
+
+def departure_rows(obs):
+    # demand from the plane's port to every destination, (N, P)
+    return obs[np.arange(len(obs)), 1 + current_ports(obs)]
+
+
+def random_policy(obs, rng=np.random.default_rng()):
+    return rng.integers(0, obs.shape[-1], len(obs))
+
+
+def greedy_max_demand(obs):
+    # fly where the most passengers are waiting to go
+    rows = departure_rows(obs).copy()
+    rows[np.arange(len(obs)), current_ports(obs)] = -1
+    return rows.argmax(axis=1)
+
+
+class DemandPerMile:
+    # most waiting passengers per distance flown
+    def __init__(self, port_count=port_count):
+        self.distances = np.asarray(get_dataset().distances(port_count).distances, dtype=np.float64)
+
+    def __call__(self, obs):
+        current = current_ports(obs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = departure_rows(obs) / self.distances[current]
+        score[np.arange(len(obs)), current] = -np.inf
+        return score.argmax(axis=1)
+
+
+def expand_rewards(rows, current, capacity):
+    # Reward of every destination from each state as Simulation computes it: the passengers
+    # board first, then the destination's rank in the departure row is looked up.
+    # rows (M, P) demand out of current (M,) -> boarded (M, P), reward (M, P)
+    states, ports = rows.shape
+    boarded = np.minimum(rows, capacity)
+    # Only the candidate's own demand drops by what boards, so its rank is the number of other
+    # ports ahead of its reduced key (same keys as Simulation.demand_ranks).
+    key = np.arange(1, ports + 1) - rows * (ports + 1)
+    key[np.arange(states), current] -= current + 1
+    reduced = key + boarded * (ports + 1)
+    ranks = (key[:, None, :] < reduced[:, :, None]).sum(axis=2) - (boarded > 0)
+    reward = (ports - ranks) / ports
+    reward[np.arange(states), current] = -1.0
+    return boarded, reward
+
+
+def beam_search_chunk(obs, depth, beam_width, capacity, gamma):
+    # Beams of (port, score, first action) per env, all envs at once. Instead of a demand copy
+    # per beam, each beam keeps the (departure, arrival, boarded) of its flights so far and
+    # they are subtracted from the observed demand row it reads. The demand model ignores
+    # refreshes that happen during the lookahead.
+    env_num, ports = len(obs), obs.shape[-1]
+    demand = obs[:, 1:].astype(np.int64)  # (N, P, P)
+    current = current_ports(obs)[:, None]  # (N, B)
+    score = np.zeros((env_num, 1))
+    first = np.zeros((env_num, 1), dtype=np.int64)
+    flights = np.zeros((env_num, 1, 0, 3), dtype=np.int64)  # (N, B, level, departure/arrival/boarded)
+    env_idx = np.arange(env_num)[:, None]
+    for level in range(depth):
+        beams = current.shape[1]
+        rows = demand[env_idx, current]  # (N, B, P)
+        for departure, arrival, boarded in np.moveaxis(flights, (2, 3), (0, 1)):
+            rows[env_idx, np.arange(beams), arrival] -= np.where(departure == current, boarded, 0)
+        boarded, reward = expand_rewards(rows.reshape(-1, ports), current.reshape(-1), capacity)
+        candidates = (score[:, :, None] + gamma ** level * reward.reshape(env_num, beams, ports)).reshape(env_num, -1)
+        width = min(beam_width, candidates.shape[1])
+        best = np.argpartition(-candidates, width - 1, axis=1)[:, :width]
+        parent, action = best // ports, best % ports
+
+        flight = np.stack([current[env_idx, parent], action,
+                           boarded.reshape(env_num, beams, ports)[env_idx, parent, action]], axis=-1)
+        flights = np.concatenate([flights[env_idx, parent], flight[:, :, None]], axis=2)
+        score = candidates[env_idx, best]
+        first = action if level == 0 else first[env_idx, parent]
+        current = action
+    return first[np.arange(env_num), score.argmax(axis=1)]
+
+
+class BeamSearch:
+    # depth-step lookahead over the rank reward keeping the beam_width best partial schedules.
+    # Envs are split into chunks run on a pool of workers ("thread" or "process") once there
+    # are more than chunk_size of them, worthwhile for large port counts.
+    def __init__(self, depth=3, beam_width=4, capacity=250, gamma=1.0, workers=None, pool="thread",
+                 chunk_size=256):
+        self.depth = depth
+        self.beam_width = beam_width
+        self.capacity = capacity
+        self.gamma = gamma
+        self.chunk_size = chunk_size
+        self.executor = None
+        if workers is not None and workers > 1:
+            executor_class = ThreadPoolExecutor if pool == "thread" else ProcessPoolExecutor
+            self.executor = executor_class(max_workers=workers)
+
+    def __call__(self, obs):
+        args = (self.depth, self.beam_width, self.capacity, self.gamma)
+        if self.executor is None or len(obs) <= self.chunk_size:
+            return beam_search_chunk(obs, *args)
+        chunks = [obs[start:start + self.chunk_size] for start in range(0, len(obs), self.chunk_size)]
+        futures = [self.executor.submit(beam_search_chunk, chunk, *args) for chunk in chunks]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def evaluate(policy, episodes=1000, env_num=1000, seed=0, port_count=port_count):
+    # Runs whole episodes on env_num BatchedSimulation envs at a time. Returns every episode's
+    # total reward, in the units of Plane.get_reward (-1 for staying), and the wall time.
+    env = BatchedSimulation(min(env_num, episodes), seed=seed, port_count=port_count)
+    returns = []
+    start = time.perf_counter()
+    while len(returns) < episodes:
+        obs, _ = env.reset()
+        total = np.zeros(len(env))
+        done = np.zeros(len(env), dtype=bool)
+        while not done.all():
+            obs, reward, terminated, truncated, _ = env.step(policy(obs))
+            total += reward
+            done = terminated | truncated
+        returns.extend(total.tolist())
+    return np.array(returns[:episodes]), time.perf_counter() - start
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policies", nargs="+", default=["random", "greedy", "per-mile", "beam"])
+    parser.add_argument("--episodes", type=int, default=2000)
+    parser.add_argument("--env-num", type=int, default=1000)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--port-count", type=int, default=port_count)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--beam-width", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--pool", type=str, default="thread", choices=["thread", "process"])
+    return parser.parse_args()
+
+
+def main(args):
+    policies = {
+        "random": random_policy,
+        "greedy": greedy_max_demand,
+        "per-mile": DemandPerMile(args.port_count),
+        "beam": BeamSearch(args.depth, args.beam_width, workers=args.workers, pool=args.pool),
+    }
+    results = []
+    for name in args.policies:
+        for seed in args.seeds:
+            returns, seconds = evaluate(policies[name], args.episodes, args.env_num, seed, args.port_count)
+            results.append({
+                "policy": name,
+                "seed": seed,
+                "episodes": len(returns),
+                "mean_reward": float(returns.mean()),
+                "std_reward": float(returns.std()),
+                "episodes_per_second": len(returns) / seconds,
+            })
+    policies["beam"].close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(get_args())
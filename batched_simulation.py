@@ -0,0 +1,126 @@
+import numpy as np
+from gymnasium.spaces import Discrete, MultiDiscrete, Box
+
+from airport_dataset import PortIndex, get_dataset, select_ports
+from Simulation import (port_count, plane_count, max_passenger_count, passenger_ranges, demand_refresh_interval,
+                        passenger_bounds, generate_demand, demand_ranks, rank_reward,
+                        board_passengers)
+
+
+class BatchedSimulation:
+    # N copies of Simulation held as stacked arrays and stepped in one call.
+    # Implements the part of tianshou's BaseVectorEnv interface the Collector uses.
+    is_async = False
+
+    def __init__(self, env_num, sim_duration=168, seed=None, port_count=port_count, plane_count=plane_count,
+                 ports=None):
+        self.env_num = env_num
+        self.sim_duration = sim_duration
+        # ports (a PortIndex or codes) as in Simulation; only their number matters here
+        if ports is not None and not isinstance(ports, PortIndex):
+            ports = select_ports(get_dataset(), ports)
+        self.port_index = ports
+        self.port_count = len(get_dataset().distances(port_count)) if ports is None else len(ports)
+        self.plane_count = plane_count
+        self.rng = np.random.default_rng(seed)
+
+        self.plane_capacity = np.where(np.arange(self.plane_count) % 2 == 0, 250, 350)
+        self.port_types = self.rng.integers(0, len(passenger_ranges), (env_num, self.port_count))
+
+        self.demand = np.zeros((env_num, self.port_count, self.port_count), dtype=np.int64)
+        self.ranks = np.zeros((env_num, self.port_count, self.port_count), dtype=np.int64)
+        self.plane_port_id = np.zeros((env_num, self.plane_count), dtype=np.int64)
+        self.step_count = np.zeros(env_num, dtype=np.int64)
+
+        high_values = (np.ones((self.port_count, self.port_count)) - np.eye(self.port_count)) * max_passenger_count
+        high_values = np.vstack((np.full(self.port_count, self.plane_count), high_values))
+        observation_space = Box(low=np.zeros((self.port_count + 1, self.port_count)), high=high_values,
+                                shape=(self.port_count + 1, self.port_count), dtype=np.int64)
+        # one action per plane, or one for all of them, as in Simulation
+        if self.plane_count == 1:
+            action_space = Discrete(self.port_count)
+        else:
+            action_space = MultiDiscrete([self.port_count] * self.plane_count)
+        self.observation_space = [observation_space] * env_num
+        self.action_space = [action_space] * env_num
+
+    def __len__(self):
+        return self.env_num
+
+    def _wrap_id(self, id=None):
+        if id is None:
+            return np.arange(self.env_num)
+        return np.atleast_1d(np.asarray(id, dtype=np.int64))
+
+    def _set_demand(self, env_ids):
+        passenger_low, passenger_high = passenger_bounds(self.port_types[env_ids])
+        demand = generate_demand(self.rng, passenger_low, passenger_high)
+        self.demand[env_ids] = demand
+        port_ids = np.tile(np.arange(self.port_count), len(env_ids))
+        ranks = demand_ranks(demand.reshape(-1, self.port_count), port_ids)
+        self.ranks[env_ids] = ranks.reshape(demand.shape)
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.port_types = self.rng.integers(0, len(passenger_ranges), (self.env_num, self.port_count))
+        return [seed] * self.env_num
+
+    def reset(self, id=None, seed=None, **kwargs):
+        if seed is not None:
+            self.seed(seed)
+        env_ids = self._wrap_id(id)
+        self._set_demand(env_ids)
+
+        # Port.reset parks demand // 250 planes at each port in port order and puts
+        # whatever is left over at the last port.
+        parked_counts = self.demand[env_ids].sum(axis=2) // 250
+        parked_cumsum = np.cumsum(parked_counts, axis=1)
+        plane_ids = np.arange(self.plane_count)
+        port_ids = (parked_cumsum[:, :, None] <= plane_ids[None, None, :]).sum(axis=1)
+        self.plane_port_id[env_ids] = np.minimum(port_ids, self.port_count - 1)
+
+        self.step_count[env_ids] = 0
+        return self.observe(env_ids), np.array([{} for _ in env_ids], dtype=object)
+
+    def step(self, action, id=None):
+        env_ids = self._wrap_id(id)
+        action = np.asarray(action, dtype=np.int64)
+        if action.ndim == 1:
+            action = np.repeat(action[:, None], self.plane_count, axis=1)
+
+        # all planes of all envs board in one pass, as in Fleet.step
+        env_idx = np.repeat(env_ids, self.plane_count)
+        departure = self.plane_port_id[env_ids].reshape(-1)
+        arrival = action.reshape(-1)
+        route_keys = (env_idx * self.port_count + departure) * self.port_count + arrival
+        board_passengers(self.demand.reshape(-1), route_keys, np.tile(self.plane_capacity, len(env_ids)))
+
+        # only the boarded departure rows changed, so only their ranks are recomputed
+        self.ranks[env_idx, departure] = demand_ranks(self.demand[env_idx, departure], departure)
+        plane_reward = rank_reward(self.ranks[env_idx, departure, arrival], self.port_count)
+        plane_reward = np.where(departure == arrival, -1.0, plane_reward)
+        reward = plane_reward.reshape(len(env_ids), self.plane_count).sum(axis=1)
+        self.plane_port_id[env_ids] = action
+
+        refresh_ids = env_ids[self.step_count[env_ids] % demand_refresh_interval == 0]
+        if len(refresh_ids):
+            self._set_demand(refresh_ids)
+
+        self.step_count[env_ids] += 1
+        terminated = self.step_count[env_ids] == self.sim_duration
+        truncated = np.zeros(len(env_ids), dtype=bool)
+        info = np.array([{} for _ in env_ids], dtype=object)
+        return self.observe(env_ids), reward, terminated, truncated, info
+
+    def observe(self, id=None):
+        env_ids = self._wrap_id(id)
+        state = np.zeros((len(env_ids), self.port_count + 1, self.port_count))
+        np.add.at(state[:, 0], (np.arange(len(env_ids))[:, None], self.plane_port_id[env_ids]), 1)
+        state[:, 1:] = self.demand[env_ids]
+        return state
+
+    def render(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
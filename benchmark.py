@@ -0,0 +1,766 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+def current_rss():
+    # resident set size of this process in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _call_and_send(conn, fn, args):
+    try:
+        conn.send((True, fn(*args)))
+    except Exception as e:
+        conn.send((False, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def run_in_fresh_process(fn, *args):
+    # spawned, not forked, so imports and peak RSS are measured from scratch; a plain Process
+    # rather than a Pool because pool workers are daemonic and shmem envs start their own workers
+    import multiprocessing as mp
+    context = mp.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=_call_and_send, args=(child_conn, fn, args))
+    process.start()
+    child_conn.close()
+    ok, value = parent_conn.recv()
+    process.join()
+    if not ok:
+        raise RuntimeError(value)
+    return value
+
+
+def bench_startup(args):
+    # Env construction cost as Rl.py pays it. Run in a fresh process so the import is measured.
+    # --eager-assets decodes the plane image per plane like Plane.__init__ used to, for comparison.
+    rss_start = current_rss()
+    start = time.perf_counter()
+    from Simulation import Simulation
+    if args.eager_assets:
+        import pygame
+    import_seconds = time.perf_counter() - start
+    rss_import = current_rss()
+
+    envs = []
+    images = []
+    start = time.perf_counter()
+    for _ in range(args.env_num):
+        env = Simulation()
+        if args.eager_assets:
+            for plane in env.resources.planes.values():
+                images.append(pygame.transform.scale(pygame.image.load("ucak.png"), plane.image_size))
+        envs.append(env)
+    construct_seconds = time.perf_counter() - start
+    rss_envs = current_rss()
+
+    return {
+        "benchmark": "startup",
+        "env_num": args.env_num,
+        "eager_assets": args.eager_assets,
+        "pygame_imported": "pygame" in sys.modules,
+        "import_seconds": import_seconds,
+        "construct_seconds": construct_seconds,
+        "construct_us_per_env": construct_seconds / args.env_num * 1e6,
+        "rss_import_bytes": rss_import - rss_start,
+        "rss_per_env_bytes": (rss_envs - rss_import) / args.env_num,
+    }
+
+
+def make_vector_env(backend, env_num, worker_num=None, port_count=None, plane_count=None):
+    from functools import partial
+    import Simulation as simulation
+    port_count = port_count or simulation.port_count
+    plane_count = plane_count or simulation.plane_count
+    env_fn = partial(simulation.Simulation, copy_observation=False, trajectory_retention="off",
+                     port_count=port_count, plane_count=plane_count)
+    if backend == "dummy":
+        from tianshou.env import DummyVectorEnv
+        return DummyVectorEnv([env_fn for _ in range(env_num)])
+    if backend == "batched":
+        from batched_simulation import BatchedSimulation
+        return BatchedSimulation(env_num, port_count=port_count, plane_count=plane_count)
+    if backend == "shmem":
+        from shm_vector_env import SharedMemoryVectorEnv
+        return SharedMemoryVectorEnv(env_fn, env_num, worker_num)
+    raise ValueError(f"Unknown backend {backend!r}")
+
+
+def random_actions(rng, action_space, env_num):
+    # one action per env, or one per plane for a MultiDiscrete fleet
+    if hasattr(action_space, "nvec"):
+        return rng.integers(0, action_space.nvec, (env_num, len(action_space.nvec)))
+    return rng.integers(0, action_space.n, env_num)
+
+
+def run_vector_env(env, steps, seed=0):
+    # steps every env `steps` times with random actions, resetting finished envs like the Collector
+    rng = np.random.default_rng(seed)
+    action_space = env.action_space[0]
+    seconds = 0.0
+    for _ in range(steps):
+        actions = random_actions(rng, action_space, len(env))
+        start = time.perf_counter()
+        _, _, terminated, truncated, _ = env.step(actions)
+        done_ids = np.flatnonzero(np.logical_or(terminated, truncated))
+        if len(done_ids):
+            env.reset(done_ids)
+        seconds += time.perf_counter() - start
+    return seconds
+
+
+def peak_rss():
+    import resource
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def measure_env(backend, port_count, plane_count, env_num, worker_num, steps, alloc_steps):
+    # One grid cell, run in a fresh process so the peak RSS belongs to this configuration alone.
+    # Allocations are traced in this process only, shmem workers are not included.
+    import tracemalloc
+    import batched_simulation
+    import shm_vector_env
+    import tianshou.env
+    from airport_dataset import get_dataset
+    # imports and the dataset load are paid once per process, not per env; tianshou (and torch)
+    # for every backend so the peak RSS of dummy and the others starts from the same imports
+    get_dataset()
+
+    start = time.perf_counter()
+    env = make_vector_env(backend, env_num, worker_num, port_count, plane_count)
+    construct_seconds = time.perf_counter() - start
+    env.seed(0)
+    reset_calls = 5
+    start = time.perf_counter()
+    for _ in range(reset_calls):
+        env.reset()
+    reset_seconds = (time.perf_counter() - start) / reset_calls
+
+    run_vector_env(env, min(steps, 5))  # warm up
+    blocks = sys.getallocatedblocks()
+    step_seconds = run_vector_env(env, steps)
+    retained_blocks = sys.getallocatedblocks() - blocks
+
+    tracemalloc.start()
+    alloc_peak = 0
+    rng = np.random.default_rng(1)
+    for _ in range(alloc_steps):
+        actions = random_actions(rng, env.action_space[0], len(env))
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        env.step(actions)
+        alloc_peak += tracemalloc.get_traced_memory()[1] - before
+        env.reset()
+    tracemalloc.stop()
+
+    # observe() of one env on its own, the per-step observation cost inside step
+    if backend == "batched":
+        observe = env.observe
+    else:
+        from Simulation import Simulation
+        single = Simulation(copy_observation=False, trajectory_retention="off",
+                            port_count=port_count, plane_count=plane_count)
+        single.reset(seed=0)
+        observe = single.observe
+    observe_calls = 1000
+    start = time.perf_counter()
+    for _ in range(observe_calls):
+        observe()
+    observe_seconds = time.perf_counter() - start
+    env.close()
+
+    rss, worker_rss = peak_rss()
+    env_steps = env_num * steps
+    return {
+        "backend": backend,
+        "port_count": port_count,
+        "plane_count": plane_count,
+        "env_num": env_num,
+        "worker_num": worker_num,
+        "steps": steps,
+        "env_steps_per_second": env_steps / step_seconds,
+        "us_per_step": step_seconds / env_steps * 1e6,
+        "reset_us": reset_seconds / env_num * 1e6,
+        "observe_us": observe_seconds / observe_calls * 1e6 / (env_num if backend == "batched" else 1),
+        "construct_us_per_env": construct_seconds / env_num * 1e6,
+        "alloc_peak_bytes_per_step": alloc_peak / max(alloc_steps, 1) / env_num,
+        "retained_blocks_per_step": retained_blocks / env_steps,
+        "peak_rss_bytes": rss,
+        "worker_peak_rss_bytes": worker_rss,
+    }
+
+
+def best_of(runs):
+    # the best value of every metric over repeated runs, which is the least disturbed by other load
+    result = dict(runs[0])
+    for name, direction in METRICS.items():
+        if name in result:
+            result[name] = (max if direction > 0 else min)(run[name] for run in runs)
+    return result
+
+
+def bench_throughput(args):
+    # Steps/sec, us per step, reset and observe cost, allocations and peak RSS over the grid of
+    # backend x port_count x plane_count x env_num (x worker_num for shmem). Every env runs
+    # about --env-steps steps in total, so large grids stay affordable.
+    import itertools
+    from airport_dataset import get_dataset
+    port_counts = [port_count or len(get_dataset()) for port_count in args.port_counts]
+    results = []
+    for backend, port_count, plane_count, env_num in itertools.product(
+            args.backends, port_counts, args.plane_counts, args.env_nums):
+        worker_nums = args.worker_nums if backend == "shmem" else [1]
+        for worker_num in worker_nums:
+            steps = max(args.min_steps, args.env_steps // env_num)
+            runs = [run_in_fresh_process(measure_env, backend, port_count, plane_count, env_num, worker_num,
+                                         steps, args.alloc_steps) for _ in range(args.repeat)]
+            result = best_of(runs)
+            print(f"{backend} ports={port_count} planes={plane_count} envs={env_num} workers={worker_num}: "
+                  f"{result['env_steps_per_second']:.0f} steps/s", file=sys.stderr)
+            results.append(result)
+    return {"benchmark": "throughput", "results": results}
+
+
+def bench_train(args):
+    # Share of offpolicy_trainer wall time spent inside the vector envs (step and reset, as
+    # called by the Collectors) for a short Rl.py run; the rest is the policy, buffer and logging.
+    import tempfile
+    sys.argv = sys.argv[:1]  # Rl.get_args parses the command line at import
+    import torch
+    import Rl
+    from batched_simulation import BatchedSimulation
+    from shm_vector_env import SharedMemoryVectorEnv
+    from tianshou.env import DummyVectorEnv
+
+    env_seconds = [0.0]
+
+    def timed(method):
+        def wrapper(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return method(*a, **kw)
+            finally:
+                env_seconds[0] += time.perf_counter() - start
+        return wrapper
+
+    for cls in (DummyVectorEnv, BatchedSimulation, SharedMemoryVectorEnv):
+        cls.step = timed(cls.step)
+        cls.reset = timed(cls.reset)
+
+    rl_args = Rl.get_args()
+    rl_args.env_backend = args.backend
+    rl_args.epoch = args.epoch
+    rl_args.step_per_epoch = args.step_per_epoch
+    rl_args.training_num = args.training_num
+    rl_args.test_num = args.test_num
+    rl_args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    with tempfile.TemporaryDirectory() as logdir:
+        rl_args.logdir = logdir
+        start = time.perf_counter()
+        Rl.test_rainbow(rl_args)
+        total_seconds = time.perf_counter() - start
+    return {
+        "benchmark": "train",
+        "backend": args.backend,
+        "device": rl_args.device,
+        "epoch": args.epoch,
+        "step_per_epoch": args.step_per_epoch,
+        "training_num": args.training_num,
+        "test_num": args.test_num,
+        "total_seconds": total_seconds,
+        "env_seconds": env_seconds[0],
+        "env_fraction": env_seconds[0] / total_seconds,
+    }
+
+
+def sorted_dict_reward(passengers, departure_port_id, arrival_port_id):
+    # Plane.get_reward as it was before demand ranks: sort the demand dict, then scan for the arrival
+    items = sorted(passengers.items(), key=lambda x: x[1], reverse=True)
+    i = 0
+    for item in items:
+        if item[0] == arrival_port_id:
+            break
+        i += 1
+    return (len(passengers) - i) / len(passengers)
+
+
+def bench_reward(args):
+    # microseconds per reward: the old dict sort, the per-boarding paths before and now, a
+    # cached lookup, and the batched path over many (departure, arrival) pairs at once
+    from airport_dataset import get_dataset
+    from Simulation import Resources, demand_ranks, rank_reward
+    rng = np.random.default_rng(0)
+    results = []
+    for port_count in args.port_counts:
+        port_count = port_count or len(get_dataset())
+        demand = rng.integers(0, 101, (port_count, port_count))
+        np.fill_diagonal(demand, 0)
+        departure = rng.integers(0, port_count, args.calls)
+        arrival = (departure + rng.integers(1, port_count, args.calls)) % port_count
+        dicts = [{d: 0, **{j: int(demand[d, j]) for j in range(port_count) if j != d}} for d in range(port_count)]
+
+        start = time.perf_counter()
+        for d, a in zip(departure, arrival):
+            sorted_dict_reward(dicts[d], d, a)
+        sorted_us = (time.perf_counter() - start) / args.calls * 1e6
+
+        # A boarding as the env does it, a plane load leaves one demand cell (kept from running
+        # out), then the row's ranks are re-sorted (the path before) or the pair's rank is
+        # counted off the kept sort keys (Resources.board, the path now)
+        resources = Resources(plane_count=1, trajectory_retention="off", port_count=port_count)
+        loads = rng.integers(1, 251, args.calls)
+        boarding_demand = (demand + 250 * args.calls) * (1 - np.eye(port_count, dtype=np.int64))
+        resources.set_demand(boarding_demand)
+        start = time.perf_counter()
+        for d, a, load in zip(departure.tolist(), arrival.tolist(), loads.tolist()):
+            resources.demand[d, a] -= load
+            resources.update_ranks([d])
+            rank_reward(resources.ranks[d, a], port_count)
+        row_sort_us = (time.perf_counter() - start) / args.calls * 1e6
+        sorted_ranks = resources.ranks.copy()
+
+        resources.set_demand(boarding_demand)
+        start = time.perf_counter()
+        for d, a, load in zip(departure.tolist(), arrival.tolist(), loads.tolist()):
+            rank_reward(resources.board(d, a, load), port_count)
+        row_update_us = (time.perf_counter() - start) / args.calls * 1e6
+        ranks = resources.ranks
+        if not np.array_equal(ranks, sorted_ranks):
+            raise RuntimeError("Resources.board left other ranks than re-sorting the rows")
+
+
+        start = time.perf_counter()
+        for d, a in zip(departure, arrival):
+            rank_reward(ranks[d, a], port_count)
+        lookup_us = (time.perf_counter() - start) / args.calls * 1e6
+
+        rows = demand[departure]
+        start = time.perf_counter()
+        rank_reward(demand_ranks(rows, departure)[np.arange(args.calls), arrival], port_count)
+        batched_us = (time.perf_counter() - start) / args.calls * 1e6
+
+        results.append({
+            "port_count": port_count,
+            "sorted_dict_us": sorted_us,
+            "row_sort_and_lookup_us": row_sort_us,
+            "row_update_and_lookup_us": row_update_us,
+            "cached_lookup_us": lookup_us,
+            "batched_us": batched_us,
+        })
+    return {"benchmark": "reward", "calls": args.calls, "results": results}
+
+
+def _measure_dataset_load(source):
+    # runs in a fresh process: time and RSS growth of getting the full airport dataset
+    rss_start = current_rss()
+    start = time.perf_counter()
+    if source == "import":
+        import Simulation
+    elif source == "json":
+        from airport_dataset import compile_dataset
+        dataset = compile_dataset(output_dir=None)
+        dataset.distance_matrix.distances.sum()
+    else:
+        from airport_dataset import load_dataset
+        dataset = load_dataset()
+        dataset.distance_matrix.distances.sum()
+    return {"source": source, "seconds": time.perf_counter() - start, "rss_bytes": current_rss() - rss_start}
+
+
+def bench_dataset(args):
+    # importing Simulation, building the dataset from the JSON files as import used to,
+    # and memory-mapping the compiled bundle, each in a fresh process
+    from airport_dataset import compile_dataset
+    compile_dataset()
+    results = []
+    for source in ("import", "json", "bundle"):
+        runs = [run_in_fresh_process(_measure_dataset_load, source) for _ in range(args.repeat)]
+        results.append({
+            "source": source,
+            "seconds": min(run["seconds"] for run in runs),
+            "rss_bytes": min(run["rss_bytes"] for run in runs),
+        })
+    return {"benchmark": "dataset", "repeat": args.repeat, "results": results}
+
+
+def fill_buffer(buffer, steps, rng, port_count=10, buffer_num=8):
+    # transitions shaped like Simulation's, added the way the Collector adds them
+    from tianshou.data import Batch
+    for _ in range(steps // buffer_num):
+        obs = rng.integers(0, 100, (buffer_num, port_count + 1, port_count)).astype(np.float64)
+        buffer.add(Batch(obs=obs, act=rng.integers(0, port_count, buffer_num), rew=rng.random(buffer_num),
+                         terminated=np.zeros(buffer_num, bool), truncated=np.zeros(buffer_num, bool),
+                         obs_next=obs, info=Batch()), buffer_ids=np.arange(buffer_num))
+
+
+def bench_checkpoint(args):
+    # Training-thread pause of one replay buffer checkpoint: pickle.dump of the buffer data as
+    # Rl.py used to do, against BufferCheckpoint's first (full) and incremental saves after
+    # --new-steps more transitions. The background write and the restore are timed too.
+    import pickle
+    import shutil
+    import tempfile
+    from tianshou.data import PrioritizedVectorReplayBuffer
+    from buffer_checkpoint import BufferCheckpoint
+    results = []
+    for buffer_size in args.buffer_sizes:
+        rng = np.random.default_rng(0)
+        buffer = PrioritizedVectorReplayBuffer(buffer_size, buffer_num=8, alpha=0.6, beta=0.4, weight_norm=True)
+        directory = tempfile.mkdtemp()
+        checkpoint = BufferCheckpoint(buffer, os.path.join(directory, "buffer"),
+                                      compact_dtypes={"obs": np.uint16, "obs_next": np.uint16})
+        fill_buffer(buffer, buffer_size, rng)
+
+        start = time.perf_counter()
+        with open(os.path.join(directory, "buffer.pkl"), "wb") as f:
+            pickle.dump(buffer._meta, f)
+        pickle_seconds = time.perf_counter() - start
+        pickle_bytes = os.path.getsize(os.path.join(directory, "buffer.pkl"))
+
+        start = time.perf_counter()
+        checkpoint.save()
+        full_pause = time.perf_counter() - start
+        checkpoint.wait()
+        full_seconds = time.perf_counter() - start
+
+        fill_buffer(buffer, args.new_steps, rng)
+        start = time.perf_counter()
+        checkpoint.save()
+        incremental_pause = time.perf_counter() - start
+        checkpoint.wait()
+        incremental_seconds = time.perf_counter() - start
+        checkpoint_bytes = sum(entry.stat().st_size for entry in os.scandir(checkpoint.path))
+        checkpoint.close()
+
+        restored = PrioritizedVectorReplayBuffer(buffer_size, buffer_num=8, alpha=0.6, beta=0.4, weight_norm=True)
+        start = time.perf_counter()
+        BufferCheckpoint(restored, checkpoint.path).restore()
+        restore_seconds = time.perf_counter() - start
+        shutil.rmtree(directory)
+
+        results.append({
+            "buffer_size": buffer_size,
+            "pickle_ms": pickle_seconds * 1e3,
+            "full_pause_ms": full_pause * 1e3,
+            "full_write_ms": full_seconds * 1e3,
+            "incremental_pause_ms": incremental_pause * 1e3,
+            "incremental_write_ms": incremental_seconds * 1e3,
+            "restore_ms": restore_seconds * 1e3,
+            "pickle_bytes": pickle_bytes,
+            "checkpoint_bytes": checkpoint_bytes,
+        })
+    return {"benchmark": "checkpoint", "new_steps": args.new_steps, "results": results}
+
+
+def bench_inference(args):
+    # CPU latency of one batched forward pass of the Rainbow network per backend and batch size,
+    # then PolicyServer under --concurrency clients sending single plane requests.
+    import asyncio
+    sys.argv = sys.argv[:1]  # Rl.get_args parses the command line at import
+    import torch
+    from policy_server import PolicyServer, Predictor, encode, load_policy, random_policy_module, serve_load
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    module = load_policy(args.policy) if args.policy else random_policy_module()
+    rng = np.random.default_rng(0)
+    results = []
+    for backend in args.backends:
+        predictor = Predictor(module, backend)
+        for batch_size in args.batch_sizes:
+            port_count = predictor.port_count
+            obs, mask = encode(rng.integers(0, 100, (batch_size, port_count, port_count)),
+                               rng.integers(0, port_count, batch_size), route_keys=predictor.route_keys)
+            predictor(obs, mask)
+            calls = max(3, args.rows // batch_size)
+            runs = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                for _ in range(calls):
+                    predictor(obs, mask)
+                runs.append((time.perf_counter() - start) / calls)
+            latency = min(runs)
+            results.append({
+                "backend": backend,
+                "batch_size": batch_size,
+                "latency_us": latency * 1e6,
+                "rows_per_second": batch_size / latency,
+            })
+
+        server = PolicyServer(predictor, args.max_batch_size, args.max_delay)
+        start = time.perf_counter()
+        latencies = asyncio.run(serve_load(server, args.requests, args.concurrency, rng))
+        seconds = time.perf_counter() - start
+        results.append({
+            "backend": backend,
+            "batch_size": "server",
+            "requests_per_second": len(latencies) / seconds,
+            "p50_latency_us": float(np.percentile(latencies, 50)) * 1e6,
+            "p99_latency_us": float(np.percentile(latencies, 99)) * 1e6,
+        })
+    return {"benchmark": "inference", "threads": torch.get_num_threads(), "concurrency": args.concurrency,
+            "max_batch_size": args.max_batch_size, "max_delay": args.max_delay, "results": results}
+
+
+def kernel_rollout(engine, port_count, plane_count, seed, episodes):
+    # seeded episodes of random actions: every step's reward and observation and the fleet's
+    # state after it, for comparing engines
+    from Simulation import Simulation
+    env = Simulation(engine=engine, port_count=port_count, plane_count=plane_count, trajectory_retention="full")
+    env.seed(seed)
+    rng = np.random.default_rng(seed)
+    fleet = env.resources.fleet
+    trace = []
+    for _ in range(episodes):
+        obs, _ = env.reset()
+        trace.append(obs)
+        done = False
+        while not done:
+            action = rng.integers(0, len(env.resources.ports), plane_count)
+            obs, reward, done, _, _ = env.step(action if plane_count > 1 else action[0])
+            trace.extend([obs, reward, env.resources.ranks.copy(), fleet.current_passenger_count.copy(),
+                          fleet.current_passenger_ratio.copy(), fleet.curr_fly_total_miles.copy(),
+                          fleet.latitude.copy(), fleet.status.copy()])
+        trace.append(fleet.trajectory.table())
+    return trace
+
+
+def measure_engine(engine, port_count, plane_count, steps):
+    from Simulation import Simulation
+    env = Simulation(engine=engine, port_count=port_count, plane_count=plane_count, copy_observation=False,
+                     trajectory_retention="off")
+    env.seed(0)
+    env.reset()
+    actions = np.random.default_rng(0).integers(0, len(env.resources.ports), (steps, plane_count))
+    if plane_count == 1:
+        actions = actions[:, 0]
+    env.step(actions[0])  # compiles (or loads) the kernels outside the timing
+    start = time.perf_counter()
+    for action in actions:
+        _, _, done, _, _ = env.step(action)
+        if done:
+            env.reset()
+    return steps / (time.perf_counter() - start)
+
+
+def bench_kernel(args):
+    # engine="jit" against the numpy step engine it replaces: seeded rollouts must match step
+    # for step (a mismatch fails the run), then env steps per second of both
+    import itertools
+    import step_kernel
+    from airport_dataset import get_dataset
+    if not step_kernel.available:
+        raise RuntimeError("numba is not installed, engine='jit' would only run the step engine")
+    results = []
+    mismatches = []
+    for port_count, plane_count in itertools.product(args.port_counts, args.plane_counts):
+        port_count = port_count or None
+        for seed in args.seeds:
+            reference = kernel_rollout("step", port_count, plane_count, seed, args.episodes)
+            compiled = kernel_rollout("jit", port_count, plane_count, seed, args.episodes)
+            if len(reference) != len(compiled) or not all(
+                    np.array_equal(a, b) for a, b in zip(reference, compiled)):
+                mismatches.append({"port_count": port_count, "plane_count": plane_count, "seed": seed})
+        for engine in ("step", "jit"):
+            steps_per_second = max(measure_engine(engine, port_count, plane_count, args.steps)
+                                   for _ in range(args.repeat))
+            results.append({
+                "engine": engine,
+                "port_count": port_count or len(get_dataset()),
+                "plane_count": plane_count,
+                "env_steps_per_second": steps_per_second,
+            })
+    if mismatches:
+        raise RuntimeError(f"engine='jit' differs from engine='step' in {mismatches}")
+    return {"benchmark": "kernel", "equivalent": True, "seeds": args.seeds, "episodes": args.episodes,
+            "results": results}
+
+
+# direction of every metric: 1 when higher is better, -1 when lower is better.
+# Other fields identify the configuration a result belongs to or, like retained_blocks_per_step
+# (near zero, a leak shows up as it growing with the step count), are reported but not compared.
+METRICS = {
+    "env_steps_per_second": 1,
+    "us_per_step": -1,
+    "reset_us": -1,
+    "observe_us": -1,
+    "construct_us_per_env": -1,
+    "alloc_peak_bytes_per_step": -1,
+    "peak_rss_bytes": -1,
+    "worker_peak_rss_bytes": -1,
+    "import_seconds": -1,
+    "construct_seconds": -1,
+    "rss_import_bytes": -1,
+    "rss_per_env_bytes": -1,
+    "sorted_dict_us": -1,
+    "row_sort_and_lookup_us": -1,
+    "row_update_and_lookup_us": -1,
+    "cached_lookup_us": -1,
+    "batched_us": -1,
+    "seconds": -1,
+    "rss_bytes": -1,
+    "total_seconds": -1,
+    "env_seconds": -1,
+    "env_fraction": -1,
+    "pickle_ms": -1,
+    "full_pause_ms": -1,
+    "full_write_ms": -1,
+    "incremental_pause_ms": -1,
+    "incremental_write_ms": -1,
+    "restore_ms": -1,
+    "checkpoint_bytes": -1,
+    "latency_us": -1,
+    "rows_per_second": 1,
+    "requests_per_second": 1,
+    "p50_latency_us": -1,
+    "p99_latency_us": -1,
+}
+CONFIG_FIELDS = ("benchmark", "backend", "engine", "port_count", "plane_count", "env_num", "worker_num", "source",
+                 "eager_assets", "device", "buffer_size", "batch_size")
+
+
+def result_records(report):
+    # flat list of (config key, metrics) for a report with or without a "results" list
+    records = []
+    for result in report.get("results", [report]):
+        result = {"benchmark": report["benchmark"], **result}
+        key = tuple((field, result[field]) for field in CONFIG_FIELDS if field in result)
+        records.append((key, {name: value for name, value in result.items() if name in METRICS}))
+    return records
+
+
+def compare(report, baseline, tolerance):
+    # A metric regresses when it is worse than the baseline by more than `tolerance` (relative).
+    baseline_records = dict(result_records(baseline))
+    regressions = []
+    improvements = []
+    unmatched = 0
+    for key, metrics in result_records(report):
+        if key not in baseline_records:
+            unmatched += 1
+            continue
+        for name, value in metrics.items():
+            base = baseline_records[key].get(name)
+            if not base:
+                continue
+            change = (value - base) / abs(base) * METRICS[name]
+            entry = {"config": dict(key), "metric": name, "baseline": base, "value": value, "change": change}
+            if change < -tolerance:
+                regressions.append(entry)
+            elif change > tolerance:
+                improvements.append(entry)
+    return {"tolerance": tolerance, "regressions": regressions, "improvements": improvements,
+            "unmatched": unmatched}
+
+
+def machine_info():
+    import platform
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=None, help="also write the JSON report here")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change flagged as a regression")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup = subparsers.add_parser("startup")
+    startup.add_argument("--env-num", type=int, default=108)
+    startup.add_argument("--eager-assets", action="store_true")
+    startup.set_defaults(func=bench_startup)
+
+    throughput = subparsers.add_parser("throughput")
+    throughput.add_argument("--backends", nargs="+", default=["dummy", "batched", "shmem"])
+    # 0 stands for every port in ports.json
+    throughput.add_argument("--port-counts", type=int, nargs="+", default=[10, 0])
+    throughput.add_argument("--plane-counts", type=int, nargs="+", default=[1, 10, 100, 500])
+    throughput.add_argument("--env-nums", type=int, nargs="+", default=[1, 10, 100, 1000])
+    throughput.add_argument("--worker-nums", type=int, nargs="+", default=[os.cpu_count() or 1])
+    throughput.add_argument("--env-steps", type=int, default=20000, help="env steps per configuration")
+    throughput.add_argument("--min-steps", type=int, default=50)
+    throughput.add_argument("--alloc-steps", type=int, default=5)
+    throughput.add_argument("--repeat", type=int, default=3, help="runs per configuration, the best is kept")
+    throughput.set_defaults(func=bench_throughput)
+
+    train = subparsers.add_parser("train")
+    train.add_argument("--backend", type=str, default="dummy", choices=["dummy", "batched", "shmem"])
+    train.add_argument("--epoch", type=int, default=1)
+    train.add_argument("--step-per-epoch", type=int, default=2000)
+    train.add_argument("--training-num", type=int, default=8)
+    train.add_argument("--test-num", type=int, default=10)
+    train.set_defaults(func=bench_train)
+
+    reward = subparsers.add_parser("reward")
+    # 0 stands for every port in ports.json
+    reward.add_argument("--port-counts", type=int, nargs="+", default=[10, 0])
+    reward.add_argument("--calls", type=int, default=20000)
+    reward.set_defaults(func=bench_reward)
+
+    dataset = subparsers.add_parser("dataset")
+    dataset.add_argument("--repeat", type=int, default=5)
+    dataset.set_defaults(func=bench_dataset)
+
+    checkpoint = subparsers.add_parser("checkpoint")
+    checkpoint.add_argument("--buffer-sizes", type=int, nargs="+", default=[20000, 100000, 500000])
+    checkpoint.add_argument("--new-steps", type=int, default=960)
+    checkpoint.set_defaults(func=bench_checkpoint)
+
+    inference = subparsers.add_parser("inference")
+    inference.add_argument("--policy", type=str, default=None, help="policy.pth, an untrained network if unset")
+    inference.add_argument("--backends", nargs="+", default=["eager", "torchscript"],
+                           choices=["eager", "torchscript", "onnx"])
+    inference.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16, 64, 256, 1024, 4096])
+    inference.add_argument("--rows", type=int, default=50000, help="rows per timing run of each batch size")
+    inference.add_argument("--repeat", type=int, default=3)
+    inference.add_argument("--threads", type=int, default=None)
+    inference.add_argument("--requests", type=int, default=20000)
+    inference.add_argument("--concurrency", type=int, default=256)
+    inference.add_argument("--max-batch-size", type=int, default=1024)
+    inference.add_argument("--max-delay", type=float, default=0.002)
+    inference.set_defaults(func=bench_inference)
+
+    kernel = subparsers.add_parser("kernel")
+    # 0 stands for every port in ports.json
+    kernel.add_argument("--port-counts", type=int, nargs="+", default=[10, 0])
+    kernel.add_argument("--plane-counts", type=int, nargs="+", default=[1, 10, 100])
+    kernel.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    kernel.add_argument("--episodes", type=int, default=2, help="episodes per seeded rollout")
+    kernel.add_argument("--steps", type=int, default=20000, help="env steps per timing run")
+    kernel.add_argument("--repeat", type=int, default=3)
+    kernel.set_defaults(func=bench_kernel)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    report = {"machine": machine_info(), **args.func(args)}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(report, json.load(f), args.tolerance)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    if args.baseline and report["comparison"]["regressions"]:
+        for entry in report["comparison"]["regressions"]:
+            print(f"REGRESSION {entry['metric']} {entry['config']}: {entry['baseline']:.4g} -> "
+                  f"{entry['value']:.4g} ({entry['change']:+.1%})", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,223 @@
+import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def flatten_batch(batch, prefix=""):
+    # {"info.stats.steps": array, ...} and the paths of empty sub-batches
+    arrays = {}
+    empty = []
+    for key, value in batch.items():
+        path = prefix + key
+        if hasattr(value, "items"):
+            if len(value.keys()) == 0:
+                empty.append(path)
+            else:
+                sub_arrays, sub_empty = flatten_batch(value, path + ".")
+                arrays.update(sub_arrays)
+                empty.extend(sub_empty)
+        else:
+            arrays[path] = value
+    return arrays, empty
+
+
+def unflatten(arrays, empty):
+    tree = {}
+    for path, value in [*arrays.items(), *((path, {}) for path in empty)]:
+        node = tree
+        *parents, key = path.split(".")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[key] = value
+    return tree
+
+
+class BufferCheckpoint:
+    # Incremental on-disk copy of a tianshou replay buffer (plain, vector or prioritized).
+    #
+    # The buffer's arrays are cut into segments of segment_size rows; add() is wrapped to mark
+    # the segments it writes, and save() only writes those. save() copies the dirty segments on
+    # the calling thread (the only pause for training), then a background thread compresses
+    # them into new files and commits the checkpoint by atomically replacing manifest.json.
+    # Fields listed in compact_dtypes are stored in that dtype (e.g. uint16 for the count
+    # observations of Simulation), the rest as they are. The priority tree and the small
+    # bookkeeping state (indices, sizes, episode counters) are rewritten whole every time.
+    def __init__(self, buffer, path, segment_size=1024, compact_dtypes=None, compression="zlib"):
+        if compression not in ("zlib", None):
+            raise ValueError(f"Unknown compression {compression!r}, expected 'zlib' or None")
+        self.buffer = buffer
+        self.path = path
+        self.segment_size = segment_size
+        self.compact_dtypes = compact_dtypes or {}
+        self.compression = compression
+        self.segment_count = -(-buffer.maxsize // segment_size)
+        self.dirty = np.ones(self.segment_count, dtype=bool)
+        self.manifest = self.read_manifest()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+        add = buffer.add
+
+        def tracked_add(batch, buffer_ids=None):
+            result = add(batch, buffer_ids)
+            self.dirty[np.asarray(result[0]) // self.segment_size] = True
+            return result
+
+        buffer.add = tracked_add
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def exists(self):
+        return self.manifest is not None
+
+    def _state(self):
+        # every attribute of the buffer and its sub-buffers except the data and priority tree
+        def attributes(buffer):
+            skip = {"_meta", "buffers", "weight", "add"}
+            return {key: value for key, value in vars(buffer).items() if key not in skip}
+        state = {"buffer": attributes(self.buffer)}
+        if hasattr(self.buffer, "buffers"):
+            state["buffers"] = [attributes(buffer) for buffer in self.buffer.buffers]
+        return state
+
+    def save(self):
+        # returns once the dirty data is copied, the write itself runs in the background
+        self.wait()
+        arrays, empty = flatten_batch(self.buffer._meta)
+        manifest = self.manifest or {"generation": 0, "fields": {}}
+        if manifest.get("segment_size", self.segment_size) != self.segment_size:
+            # segments cut at another size can not be patched, start over with every segment dirty
+            manifest = {"generation": manifest["generation"], "fields": {}}
+        generation = manifest["generation"] + 1
+
+        dirty = self.dirty.copy()
+        self.dirty[:] = False
+        segments = []  # (path, segment index, copy)
+        for path, array in arrays.items():
+            field = manifest["fields"].get(path)
+            new_field = field is None or field["shape"] != list(array.shape)
+            for index in np.flatnonzero(dirty) if not new_field else range(self.segment_count):
+                rows = array[index * self.segment_size:(index + 1) * self.segment_size]
+                segments.append((path, index, rows.astype(self.compact_dtypes.get(path, rows.dtype))))
+        weight = getattr(self.buffer, "weight", None)
+        weight = None if weight is None else weight._value.copy()
+        state = pickle.dumps(self._state())
+        dtypes = {path: (str(array.dtype), list(array.shape)) for path, array in arrays.items()}
+        self.pending = self.executor.submit(self._write, generation, manifest, segments, dtypes, empty, weight, state)
+
+    def _segment_file(self, path, index, generation):
+        extension = ".npz" if self.compression else ".npy"
+        return f"{path}.{index}.{generation}{extension}"
+
+    def _write_array(self, name, array):
+        # written under a temporary name, renamed into place only once it is complete
+        tmp_path = os.path.join(self.path, name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            if self.compression:
+                np.savez_compressed(f, array=array)
+            else:
+                np.save(f, array)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def _write(self, generation, manifest, segments, dtypes, empty, weight, state):
+        os.makedirs(self.path, exist_ok=True)
+        fields = {path: dict(manifest["fields"].get(path, {})) for path in dtypes}
+        for path, (dtype, shape) in dtypes.items():
+            if fields[path].get("shape") != shape:
+                fields[path] = {"segments": [None] * self.segment_count}
+            fields[path].update(dtype=dtype, shape=shape)
+        for path, index, rows in segments:
+            name = self._segment_file(path, index, generation)
+            self._write_array(name, rows)
+            fields[path]["segments"][index] = name
+
+        files = {"state": f"state.{generation}.pkl"}
+        with open(os.path.join(self.path, files["state"]), "wb") as f:
+            f.write(state)
+        if weight is not None:
+            files["weight"] = f"weight.{generation}{'.npz' if self.compression else '.npy'}"
+            self._write_array(files["weight"], weight)
+
+        new_manifest = {"generation": generation, "segment_size": self.segment_size, "fields": fields,
+                        "empty": empty, "files": files}
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(new_manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+        self.manifest = new_manifest
+
+        # files of older generations are only dropped after the new manifest is in place
+        referenced = {name for field in fields.values() for name in field["segments"] if name}
+        referenced.update(files.values())
+        referenced.add(MANIFEST)
+        for name in os.listdir(self.path):
+            if name not in referenced:
+                os.remove(os.path.join(self.path, name))
+
+    def _load_array(self, name, mmap, mode="r"):
+        file_path = os.path.join(self.path, name)
+        if name.endswith(".npz"):
+            with np.load(file_path, allow_pickle=True) as archive:
+                return archive["array"]
+        try:
+            return np.load(file_path, mmap_mode=mode if mmap else None)
+        except ValueError:
+            # object arrays can not be mapped
+            return np.load(file_path, allow_pickle=True)
+
+    def restore(self, mmap=True):
+        # Fills the buffer from the last committed checkpoint, cut at the segment size it was
+        # saved with. A field kept whole in one uncompressed segment of its own dtype becomes a
+        # copy-on-write mapping of that file, read as the buffer touches it; any other field is
+        # assembled in memory, from mappings of uncompressed segments or from the decompressed
+        # ones. Nothing is unpickled but the small bookkeeping state.
+        self.wait()
+        manifest = self.read_manifest()
+        if manifest is None:
+            raise FileNotFoundError(f"No buffer checkpoint in {self.path}")
+        segment_size = manifest["segment_size"]
+        arrays = {}
+        for path, field in manifest["fields"].items():
+            dtype = np.dtype(field["dtype"])
+            segments = field["segments"]
+            if mmap and len(segments) == 1 and segments[0] is not None and segments[0].endswith(".npy"):
+                array = self._load_array(segments[0], mmap, mode="c")
+                if array.dtype == dtype and list(array.shape) == field["shape"]:
+                    arrays[path] = array
+                    continue
+            array = np.empty(field["shape"], dtype=dtype)
+            for index, name in enumerate(segments):
+                if name is not None:
+                    array[index * segment_size:(index + 1) * segment_size] = self._load_array(name, mmap)
+            arrays[path] = array
+
+        from tianshou.data import Batch
+        self.buffer.set_batch(Batch(unflatten(arrays, manifest["empty"])))
+        with open(os.path.join(self.path, manifest["files"]["state"]), "rb") as f:
+            state = pickle.load(f)
+        vars(self.buffer).update(state["buffer"])
+        for buffer, buffer_state in zip(getattr(self.buffer, "buffers", []), state.get("buffers", [])):
+            vars(buffer).update(buffer_state)
+        if "weight" in manifest["files"]:
+            self.buffer.weight._value[:] = self._load_array(manifest["files"]["weight"], mmap)
+        self.manifest = manifest
+        self.dirty[:] = False
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
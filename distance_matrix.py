@@ -0,0 +1,66 @@
+import numpy as np
+
+# port_distances.json comes from the THY getSector endpoint, which reports kilometres,
+# so the haversine fill uses the same unit.
+EARTH_RADIUS = 6371.0
+DEFAULT_DISTANCE = 400
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class DistanceMatrix:
+    FILL_POLICIES = ("haversine", "constant")
+
+    def __init__(self, codes, distances, missing=None):
+        self.codes = list(codes)
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.distances = np.asarray(distances, dtype=np.float32)  # (P, P), indexed by port id
+        # pairs that were not in the source table and had to be filled
+        self.missing = np.zeros(self.distances.shape, dtype=bool) if missing is None else missing
+
+    @classmethod
+    def from_json(cls, port_distances, ports, fill="haversine", fill_value=DEFAULT_DISTANCE):
+        # ports: [[code, {"latitude": str, "longitude": str}], ...] in port id order
+        if fill not in cls.FILL_POLICIES:
+            raise ValueError(f"Unknown fill policy {fill!r}, expected one of {cls.FILL_POLICIES}")
+        codes = [port[0] for port in ports]
+        port_count = len(codes)
+
+        distances = np.full((port_count, port_count), np.nan, dtype=np.float32)
+        for i, code in enumerate(codes):
+            row = port_distances.get(code, {})
+            for j, other_code in enumerate(codes):
+                if other_code in row:
+                    distances[i, j] = row[other_code]
+        np.fill_diagonal(distances, 0)
+        missing = np.isnan(distances)
+
+        fill_values = np.full((port_count, port_count), fill_value, dtype=np.float32)
+        if fill == "haversine":
+            lat = np.array([float(port[1]["latitude"]) for port in ports])
+            lon = np.array([float(port[1]["longitude"]) for port in ports])
+            # a few entries in ports.json have broken coordinates, keep the constant for those
+            valid = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+            great_circle = haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+            valid_pair = valid[:, None] & valid[None, :]
+            fill_values[valid_pair] = great_circle[valid_pair]
+        distances[missing] = fill_values[missing]
+
+        return cls(codes, distances, missing)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        return self.distances[key]
+
+    def between(self, departure_code, arrival_code):
+        return self.distances[self.index[departure_code], self.index[arrival_code]]
+
+    def flight_hours(self, departure_port_ids, arrival_port_ids, mile_completion_per_hour):
+        # works for scalar ids as well as arrays of ids
+        return self.distances[departure_port_ids, arrival_port_ids] / mile_completion_per_hour
@@ -0,0 +1,89 @@
+import cProfile
+import time
+
+import numpy as np
+
+# phases of Simulation.step/reset in the order they run, Fleet.step covers distance..trajectory
+PHASES = ("distance", "boarding", "reward", "move", "trajectory", "demand_refresh", "render", "observe", "reset")
+COUNTERS = ("steps", "resets", "demand_refreshes", "fallback_distances", "boarded_passengers", "invalid_actions")
+
+
+class SimulationStats:
+    # Per-phase wall time and event counters of one env, see Simulation(instrument=True).
+    # `last` holds the current step's values (what goes into the info dict), `total` accumulates
+    # them until pop() is called.
+    def __init__(self):
+        self.phase_index = {phase: i for i, phase in enumerate(PHASES)}
+        self.counter_index = {name: len(PHASES) + i for i, name in enumerate(COUNTERS)}
+        self.last = np.zeros(len(PHASES) + len(COUNTERS))
+        self.total = np.zeros(len(PHASES) + len(COUNTERS))
+        self.mark = 0.0
+
+    def start(self):
+        self.last[:] = 0
+        self.mark = time.perf_counter()
+
+    def lap(self, phase):
+        # time since the previous lap (or start) goes to phase
+        now = time.perf_counter()
+        self.last[self.phase_index[phase]] += now - self.mark
+        self.mark = now
+
+    def count(self, name, value=1):
+        self.last[self.counter_index[name]] += value
+
+    def finish(self):
+        self.total += self.last
+        return self.info()
+
+    def info(self):
+        return {name: self.last[i] for name, i in (*self.phase_index.items(), *self.counter_index.items())}
+
+    def snapshot(self):
+        # accumulated seconds per phase and counts since the last pop()
+        return {name: float(self.total[i]) for name, i in (*self.phase_index.items(), *self.counter_index.items())}
+
+    def pop(self):
+        snapshot = self.snapshot()
+        self.total[:] = 0
+        return snapshot
+
+
+def merge_stats(snapshots):
+    # sums the snapshots of several envs
+    merged = dict.fromkeys(PHASES + COUNTERS, 0.0)
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            merged[name] += value
+    return merged
+
+
+def stats_scalars(snapshot, prefix="env"):
+    # Tensorboard friendly view: microseconds per step for every phase, plus the counters
+    steps = max(snapshot["steps"], 1)
+    scalars = {f"{prefix}/{phase}_us_per_step": snapshot[phase] / steps * 1e6 for phase in PHASES if phase != "reset"}
+    scalars[f"{prefix}/reset_us_per_reset"] = snapshot["reset"] / max(snapshot["resets"], 1) * 1e6
+    scalars.update({f"{prefix}/{name}": snapshot[name] for name in COUNTERS})
+    return scalars
+
+
+class StepProfiler:
+    # Runs cProfile over the next `steps` calls of step and writes the stats (pstats format,
+    # e.g. for snakeviz) to path once they are done.
+    def __init__(self, step, steps, path):
+        self.step_fn = step
+        self.remaining = steps
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def step(self, action):
+        if self.remaining <= 0:
+            return self.step_fn(action)
+        self.profile.enable()
+        try:
+            return self.step_fn(action)
+        finally:
+            self.profile.disable()
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.profile.dump_stats(self.path)
@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch import nn
+
+from Rl import get_args as get_train_args, make_net, port_count
+
+# CPU inference for a trained Rainbow policy (policy.pth or checkpoint.pth written by Rl.py).
+# Requests are raw demand matrices plus the ports the planes are at; no Simulation is built.
+
+
+class GreedyAction(nn.Module):
+    # obs (N, P + 1, P) float, mask (N, P) bool -> best valid action (N,) and Q-values (N, P),
+    # what RainbowPolicy picks with eps 0. With route_keys (a --sparse-observation policy) obs
+    # is (N, P + routes), see encode.
+    def __init__(self, net, support, port_count=port_count, route_keys=None):
+        super().__init__()
+        self.net = net
+        self.register_buffer("support", support)
+        self.port_count = port_count
+        self.route_keys = route_keys
+
+    def forward(self, obs, mask):
+        probs, _ = self.net(obs)
+        q = (probs * self.support).sum(dim=2)
+        q = q.masked_fill(~mask, float("-inf"))
+        return q.argmax(dim=1), q
+
+
+def load_port_layout(path):
+    # (port codes, route keys or None) from the port_index.json Rl.py saves next to the policy;
+    # the first port_count ports, dense, for policies trained before it existed
+    if not os.path.exists(path):
+        return None, None
+    with open(path) as f:
+        layout = json.load(f)
+    if not layout["sparse_observation"]:
+        return layout["codes"], None
+    indptr, indices = np.array(layout["route_indptr"]), np.array(layout["route_indices"], dtype=np.int64)
+    departure = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return layout["codes"], departure * len(layout["codes"]) + indices
+
+
+def set_shapes(args, ports, route_keys):
+    args.state_shape = ports + len(route_keys) if route_keys is not None else ports * (ports + 1)
+    args.action_shape = ports
+    if args.hidden_sizes is None:
+        args.hidden_sizes = [args.state_shape + ports + 1, 128, 128, 56]
+
+
+def load_policy(path, args=None):
+    # GreedyAction on the CPU with the weights of the online network in path, the Net built
+    # with the same hyperparameters as Rl.py (its --hidden-sizes, --num-atoms... arguments)
+    # and the ports of its port_index.json
+    args = args or get_train_args()
+    codes, route_keys = load_port_layout(os.path.join(os.path.dirname(path), "port_index.json"))
+    ports = port_count if codes is None else len(codes)
+    set_shapes(args, ports, route_keys)
+    state_dict = torch.load(path, map_location="cpu")
+    state_dict = state_dict.get("model", state_dict)
+    net = make_net(args, "cpu")
+    net.load_state_dict({key[len("model."):]: value for key, value in state_dict.items() if key.startswith("model.")})
+    support = state_dict.get("support", torch.linspace(args.v_min, args.v_max, args.num_atoms))
+    return GreedyAction(net, support, ports, route_keys).eval()
+
+
+def random_policy_module(args=None, ports=port_count):
+    # untrained network of the same shape, for benchmarks without a policy.pth
+    args = args or get_train_args()
+    set_shapes(args, ports, None)
+    return GreedyAction(make_net(args, "cpu"), torch.linspace(args.v_min, args.v_max, args.num_atoms), ports).eval()
+
+
+def example_inputs(batch_size, module):
+    ports, route_keys = module.port_count, module.route_keys
+    obs_shape = (ports + 1, ports) if route_keys is None else (ports + len(route_keys),)
+    return torch.zeros(batch_size, *obs_shape), torch.ones(batch_size, ports, dtype=torch.bool)
+
+
+class Predictor:
+    # numpy in, numpy out around the module run eagerly, traced to TorchScript or exported to
+    # ONNX (needs the onnx and onnxruntime packages)
+    def __init__(self, module, backend="torchscript", onnx_path="policy.onnx"):
+        self.backend = backend
+        self.port_count = module.port_count
+        self.route_keys = module.route_keys
+        if backend == "eager":
+            self.module = module
+        elif backend == "torchscript":
+            with torch.no_grad(), warnings.catch_warnings():
+                # the deprecation notices of the jit API and Net's no-op as_tensor on a traced tensor
+                warnings.simplefilter("ignore")
+                traced = torch.jit.trace(module, example_inputs(2, module))
+                self.module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        elif backend == "onnx":
+            import onnxruntime
+            torch.onnx.export(module, example_inputs(2, module), onnx_path, input_names=["obs", "mask"],
+                              output_names=["action", "q"],
+                              dynamic_axes={"obs": {0: "batch"}, "mask": {0: "batch"}, "action": {0: "batch"},
+                                            "q": {0: "batch"}})
+            self.session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        else:
+            raise ValueError(f"Unknown backend {backend!r}, expected 'eager', 'torchscript' or 'onnx'")
+
+    def __call__(self, obs, mask):
+        obs = np.asarray(obs, dtype=np.float32)
+        mask = np.asarray(mask, dtype=bool)
+        if self.backend == "onnx":
+            action, q = self.session.run(None, {"obs": obs, "mask": mask})
+            return action, q
+        with torch.inference_mode():
+            action, q = self.module(torch.from_numpy(obs), torch.from_numpy(mask))
+        return action.numpy(), q.numpy()
+
+
+def encode(demand, plane_port_ids, mask=None, route_keys=None):
+    # One observation per plane, laid out like Simulation.observe() for a single plane (the
+    # setting Rl.py trains): a one-hot of the plane's port over the (P, P) demand matrix, or
+    # with route_keys over the demand of those routes (--sparse-observation). demand is one
+    # matrix for every plane or (planes, P, P).
+    demand = np.asarray(demand)
+    plane_port_ids = np.atleast_1d(plane_port_ids)
+    ports = demand.shape[-1]
+    if route_keys is None:
+        obs = np.zeros((len(plane_port_ids), ports + 1, ports), dtype=np.float32)
+        obs[np.arange(len(plane_port_ids)), 0, plane_port_ids] = 1
+        obs[:, 1:] = demand
+    else:
+        obs = np.zeros((len(plane_port_ids), ports + len(route_keys)), dtype=np.float32)
+        obs[np.arange(len(plane_port_ids)), plane_port_ids] = 1
+        obs[:, ports:] = demand.reshape(*demand.shape[:-2], -1)[..., route_keys]
+    if mask is None:
+        mask = np.ones((len(plane_port_ids), ports), dtype=bool)
+    return obs, np.broadcast_to(mask, (len(plane_port_ids), ports)).copy()
+
+
+class PolicyServer:
+    # Micro-batches concurrent schedule() calls: requests queue up until max_batch_size planes
+    # are waiting or the oldest has waited max_delay seconds, then go through the predictor in
+    # one call on a worker thread so the event loop keeps accepting requests.
+    def __init__(self, predictor, max_batch_size=1024, max_delay=0.002):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._serve())
+
+    async def close(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def schedule(self, demand, plane_port_ids, mask=None):
+        # next port of every plane in plane_port_ids given the demand matrix
+        obs, mask = encode(demand, plane_port_ids, mask, self.predictor.route_keys)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((obs, mask, future))
+        return await future
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            rows = len(requests[0][0])
+            deadline = loop.time() + self.max_delay
+            while rows < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                rows += len(request[0])
+            obs = np.concatenate([request[0] for request in requests])
+            mask = np.concatenate([request[1] for request in requests])
+            try:
+                action, _ = await loop.run_in_executor(self.executor, self.predictor, obs, mask)
+            except Exception as e:
+                for *_, future in requests:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_obs, _, future in requests:
+                if not future.cancelled():
+                    future.set_result(action[start:start + len(request_obs)])
+                start += len(request_obs)
+
+
+async def serve_load(server, requests, concurrency, rng):
+    # concurrency clients sending single plane requests back to back; returns the latencies
+    latencies = []
+    ports = server.predictor.port_count
+
+    async def client(count):
+        for _ in range(count):
+            demand = rng.integers(0, 100, (ports, ports))
+            start = time.perf_counter()
+            await server.schedule(demand, rng.integers(0, ports, 1))
+            latencies.append(time.perf_counter() - start)
+
+    await server.start()
+    await asyncio.gather(*(client(requests // concurrency) for _ in range(concurrency)))
+    await server.close()
+    return np.array(latencies)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--policy", type=str, default=os.path.join("log", "Simulation", "rainbow", "policy.pth"))
+    parser.add_argument("--backend", type=str, default="torchscript", choices=["eager", "torchscript", "onnx"])
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--demand", type=str, required=True, help=".npy (P, P) demand matrix")
+    parser.add_argument("--planes", type=int, nargs="+", required=True, help="port id of every plane")
+    return parser.parse_known_args()[0]
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    predictor = Predictor(load_policy(args.policy), args.backend)
+    action, q = predictor(*encode(np.load(args.demand), args.planes, route_keys=predictor.route_keys))
+    for port_id, next_port_id, values in zip(args.planes, action, q):
+        print(f"plane at {port_id} -> {next_port_id} (Q {values[next_port_id]:.3f})")
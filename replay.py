@@ -0,0 +1,139 @@
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Draws episodes recorded with Simulation(record_dir=...) headlessly, after the fact, as a PNG
+# sequence or (with ffmpeg on the PATH) an mp4. Several episodes are drawn in a process pool.
+
+
+def load_episode(path):
+    with np.load(path) as episode:
+        return {name: episode[name] for name in episode.files}
+
+
+def plane_positions(episode, hours):
+    # (len(hours), plane_count) latitudes and longitudes, each plane interpolated along the move
+    # it is on at that hour like interpolate_location
+    moves = episode["moves"]
+    latitude, longitude = episode["port_latitude"], episode["port_longitude"]
+    plane_count = int(moves["plane_id"].max()) + 1
+    frame_latitude = np.empty((len(hours), plane_count))
+    frame_longitude = np.empty((len(hours), plane_count))
+    for plane_id in range(plane_count):
+        plane_moves = moves[moves["plane_id"] == plane_id]  # recorded in hour order
+        move = plane_moves[np.maximum(np.searchsorted(plane_moves["hour"], hours, side="right") - 1, 0)]
+        progress = np.clip((hours - move["hour"]) / np.maximum(move["hours"], 1), 0, 1)
+        departure, arrival = move["departure_port_id"], move["arrival_port_id"]
+        frame_latitude[:, plane_id] = latitude[departure] + (latitude[arrival] - latitude[departure]) * progress
+        frame_longitude[:, plane_id] = longitude[departure] + (longitude[arrival] - longitude[departure]) * progress
+    return frame_latitude, frame_longitude
+
+
+def frame_hours(episode, substeps):
+    return np.arange(int(episode["duration"]) * substeps + 1) / substeps
+
+
+def write_video(frames, path, fps, size):
+    # raw RGB frames piped into ffmpeg
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("mp4 output needs ffmpeg on the PATH, use --format png instead")
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{size[0]}x{size[1]}", "-r", str(fps), "-i", "-", "-pix_fmt", "yuv420p", path]
+    with subprocess.Popen(command, stdin=subprocess.PIPE) as process:
+        for frame in frames:
+            process.stdin.write(frame)
+        process.stdin.close()
+        if process.wait():
+            raise RuntimeError(f"ffmpeg failed writing {path}")
+
+
+def render_episode(path, output, name, fmt="png", substeps=4, fps=20, size=(800, 600)):
+    # every episode gets its own output, output/<name>/frame_00000.png or output/<name>.mp4
+    os.environ["SDL_VIDEODRIVER"] = "dummy"  # before pygame opens a display
+    import pygame
+    from visualization import Visualization
+
+    episode = load_episode(path)
+    visualization = Visualization(*size, fps=None)
+    visualization.draw_static_layer(episode["port_names"], episode["port_latitude"], episode["port_longitude"])
+    hours = frame_hours(episode, substeps)
+    latitude, longitude = plane_positions(episode, hours)
+    demand_index = np.searchsorted(episode["demand_hour"], hours, side="right") - 1
+    port_demand = episode["demand"].sum(axis=2, dtype=np.int64)  # passengers waiting at each port
+    moves = episode["moves"]
+    reward = np.cumsum(np.bincount(moves["hour"], weights=moves["reward"], minlength=int(episode["duration"]) + 1))
+
+    if fmt == "png":
+        frame_dir = os.path.join(output, name)
+        os.makedirs(frame_dir, exist_ok=True)
+
+    def frames():
+        for i, hour in enumerate(hours):
+            caption = f"hour {hour:.0f}  reward {reward[int(hour)]:.2f}"
+            visualization.draw_frame(latitude[i], longitude[i], port_demand[demand_index[i]], caption)
+            if fmt == "png":
+                pygame.image.save(visualization.screen, os.path.join(frame_dir, f"frame_{i:05d}.png"))
+            else:
+                yield pygame.image.tostring(visualization.screen, "RGB")
+
+    if fmt == "png":
+        for _ in frames():
+            pass
+        result = frame_dir
+    else:
+        result = os.path.join(output, name + ".mp4")
+        write_video(frames(), result, fps, size)
+    return result
+
+
+def episode_paths(paths):
+    # (file, output name) of episode files and of every episode_*.npz under the given
+    # directories, named after the directory and their path below it (e.g.
+    # record_test_3_episode_00012). Names that still collide get a _2, _3, ... suffix so no two
+    # episodes render into the same output.
+    found = []
+    names = set()
+    for path in paths:
+        if os.path.isdir(path):
+            directory = os.path.basename(os.path.abspath(path))
+            files = [(file, directory + "_" + os.path.splitext(os.path.relpath(file, path))[0].replace(os.sep, "_"))
+                     for file in sorted(glob.glob(os.path.join(path, "**", "episode_*.npz"), recursive=True))]
+        else:
+            files = [(path, os.path.splitext(os.path.basename(path))[0])]
+        for file, name in files:
+            unique, count = name, 1
+            while unique in names:
+                count += 1
+                unique = f"{name}_{count}"
+            names.add(unique)
+            found.append((file, unique))
+    return found
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="episode .npz files or directories of them")
+    parser.add_argument("--output", type=str, default="replays")
+    parser.add_argument("--format", type=str, default="png", choices=["png", "mp4"])
+    parser.add_argument("--substeps", type=int, default=4, help="frames per simulated hour")
+    parser.add_argument("--fps", type=int, default=20, help="mp4 frame rate")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    paths = episode_paths(args.paths)
+    os.makedirs(args.output, exist_ok=True)
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(render_episode, path, args.output, name, args.format, args.substeps, args.fps,
+                               (args.width, args.height)) for path, name in paths]
+        for (path, _), future in zip(paths, futures):
+            print(f"{path} -> {future.result()}")
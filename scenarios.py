@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from airport_dataset import get_dataset, select_ports
+from Simulation import (Resources, demand_refresh_interval, generate_demand, passenger_bounds, passenger_ranges,
+                        plane_count, port_count)
+
+# A scenario is one whole episode of exogenous randomness: the port types, where the planes start
+# and the demand matrix of the reset and of every refresh. A store keeps them as one structured
+# array in scenarios.npy, memory-mapped read-only so every env (and worker process) on the same
+# machine indexes into the same pages instead of drawing demand itself.
+
+SCENARIO_FILE = "scenarios.npy"
+META_FILE = "meta.json"
+
+
+def scenario_dtype(ports, planes, refreshes):
+    # demand fits in the smallest unsigned type holding the largest passenger range bound
+    demand_type = np.min_scalar_type(max(high for _, high in passenger_ranges.values()))
+    return np.dtype([
+        ("port_types", np.int8, (ports,)),
+        ("plane_port_ids", np.int64, (planes,)),
+        ("demand", demand_type, (refreshes + 1, ports, ports)),
+    ])
+
+
+def refresh_count(sim_duration):
+    # refreshes at every multiple of demand_refresh_interval before the episode ends, as in
+    # Simulation.reset with pregenerate_demand
+    return len(range(0, sim_duration, demand_refresh_interval))
+
+
+def draw_scenarios(rng, count, planes, refreshes, route_mask):
+    # count scenarios of the distributions Resources draws from: port types, the demand of the
+    # reset and of every refresh, planes parked like Resources.reset_fleet
+    ports = len(route_mask)
+    port_types = rng.integers(0, len(passenger_ranges), (count, ports))
+    passenger_low, passenger_high = passenger_bounds(port_types)
+    shape = (count, refreshes + 1, ports)
+    demand = generate_demand(rng, np.broadcast_to(passenger_low[:, None], shape),
+                             np.broadcast_to(passenger_high[:, None], shape))
+    demand *= route_mask
+    parked_cumsum = np.cumsum(demand[:, 0].sum(axis=2) // 250, axis=1)
+    plane_port_ids = (parked_cumsum[:, :, None] <= np.arange(planes)[None, None, :]).sum(axis=1)
+    return port_types, np.minimum(plane_port_ids, ports - 1), demand
+
+
+def fill_chunk(path, start, stop, seed, planes, refreshes, route_mask):
+    # one worker's slice of the file being generated, drawn from its own seed
+    records = np.load(path, mmap_mode="r+")
+    port_types, plane_port_ids, demand = draw_scenarios(np.random.default_rng(seed), stop - start, planes,
+                                                        refreshes, route_mask)
+    records["port_types"][start:stop] = port_types
+    records["plane_port_ids"][start:stop] = plane_port_ids
+    records["demand"][start:stop] = demand
+    records.flush()
+
+
+def generate_scenarios(path, count, seed=0, ports=None, port_count=port_count, hubs=None, planes=plane_count,
+                       sim_duration=168, workers=None, chunk_size=256):
+    # Draws count scenarios into the store directory path, chunk_size at a time on a pool of
+    # workers. Every chunk has its own child of seed, so the store does not depend on workers.
+    resources = Resources(plane_count=planes, trajectory_retention="off", port_count=port_count, ports=ports,
+                          hubs=hubs)
+    port_index = resources.port_index
+    route_mask = ~np.eye(len(port_index), dtype=bool) if resources.route_mask is None else resources.route_mask
+    refreshes = refresh_count(sim_duration)
+    os.makedirs(path, exist_ok=True)
+    # write then rename so a reader never maps a half written store
+    tmp_path = os.path.join(path, "scenarios.tmp.npy")
+    records = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=scenario_dtype(len(port_index), planes, refreshes),
+                                        shape=(count,))
+    del records
+    chunks = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(tmp_path, start, stop, chunk_seed, planes, refreshes, route_mask)
+            for (start, stop), chunk_seed in zip(chunks, seeds)]
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            for future in [pool.submit(fill_chunk, *chunk_args) for chunk_args in args]:
+                future.result()
+    else:
+        for chunk_args in args:
+            fill_chunk(*chunk_args)
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump({
+            "codes": port_index.codes,
+            "plane_count": planes,
+            "sim_duration": sim_duration,
+            "demand_refresh_interval": demand_refresh_interval,
+            "route_mask": None if resources.route_mask is None else resources.route_mask.tolist(),
+            "seed": seed,
+        }, f)
+    os.replace(tmp_path, os.path.join(path, SCENARIO_FILE))
+    return load_scenarios(path)
+
+
+class ScenarioStore:
+    # Read-only views of the scenarios in a store directory, indexed by scenario id.
+    def __init__(self, path, records, meta):
+        self.path = path
+        self.codes = meta["codes"]
+        self.plane_count = meta["plane_count"]
+        self.sim_duration = meta["sim_duration"]
+        self.demand_refresh_interval = meta["demand_refresh_interval"]
+        self.route_mask = None if meta["route_mask"] is None else np.array(meta["route_mask"], dtype=bool)
+        self.port_types = records["port_types"]  # (S, P)
+        self.plane_port_ids = records["plane_port_ids"]  # (S, planes)
+        self.demand = records["demand"]  # (S, refreshes + 1, P, P)
+
+    def __len__(self):
+        return len(self.port_types)
+
+    def check(self, resources, sim_duration):
+        # ValueError unless the store was drawn for this env's ports, fleet, routes and episode length
+        if self.codes != resources.port_index.codes:
+            raise ValueError(f"Scenarios in {self.path} are for the ports {self.codes}")
+        if self.plane_count != len(resources.fleet.id):
+            raise ValueError(f"Scenarios in {self.path} are for {self.plane_count} planes")
+        if self.demand_refresh_interval != demand_refresh_interval or \
+                len(self.demand[0]) < refresh_count(sim_duration) + 1:
+            raise ValueError(f"Scenarios in {self.path} are shorter than {sim_duration} hours")
+        if not np.array_equal(self.route_mask, resources.route_mask):
+            raise ValueError(f"Scenarios in {self.path} were drawn for other hubs")
+
+
+_stores = {}
+
+
+def load_scenarios(path, mmap=True):
+    # loaded once per process and path, like get_dataset, and shared by every env using it
+    key = (os.path.abspath(path), mmap)
+    if key not in _stores:
+        records = np.load(os.path.join(path, SCENARIO_FILE), mmap_mode="r" if mmap else None)
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        _stores[key] = ScenarioStore(path, records, meta)
+    return _stores[key]
+
+
+def evaluation_ids(store_size, env_id, env_num):
+    # The scenarios test env env_id of env_num cycles through: every env_num-th from env_id, so
+    # together the envs cover the store and, with as many scenarios as envs, every test replays
+    # the same episodes.
+    return np.arange(env_id, store_size, env_num) if env_id < store_size else np.array([env_id % store_size])
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=str, help="store directory")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ports", type=str, nargs="+", default=None)
+    parser.add_argument("--port-count", type=int, default=port_count)
+    parser.add_argument("--hubs", type=str, nargs="+", default=None, help="a count of top hubs or their codes")
+    parser.add_argument("--plane-count", type=int, default=plane_count)
+    parser.add_argument("--sim-duration", type=int, default=168)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    ports = select_ports(get_dataset(), args.ports, None if args.ports else args.port_count)
+    hubs = int(args.hubs[0]) if args.hubs and len(args.hubs) == 1 and args.hubs[0].isdigit() else args.hubs
+    store = generate_scenarios(args.output, args.count, args.seed, ports, hubs=hubs, planes=args.plane_count,
+                               sim_duration=args.sim_duration, workers=args.workers, chunk_size=args.chunk_size)
+    print(f"Wrote {len(store)} scenarios of {len(store.codes)} ports to {args.output}")
@@ -0,0 +1,212 @@
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArrays:
+    # observation/reward/terminated/truncated rings laid out in one shared memory block, plus a
+    # ring for the valid actions of {"obs": state, "mask": valid actions} observations
+    def __init__(self, ring_size, env_num, obs_shape, obs_dtype, mask_shape=None, name=None):
+        self.specs = [
+            ("obs", (ring_size, env_num) + tuple(obs_shape), np.dtype(obs_dtype)),
+            ("reward", (ring_size, env_num), np.dtype(np.float64)),
+            ("terminated", (ring_size, env_num), np.dtype(bool)),
+            ("truncated", (ring_size, env_num), np.dtype(bool)),
+        ]
+        if mask_shape is not None:
+            self.specs.append(("mask", (ring_size, env_num) + tuple(mask_shape), np.dtype(bool)))
+        size = sum(int(np.prod(shape)) * dtype.itemsize for _, shape, dtype in self.specs)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        offset = 0
+        for field, shape, dtype in self.specs:
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, field, array)
+            offset += array.nbytes
+        self.has_mask = mask_shape is not None
+
+    def write_obs(self, slot, env_id, obs):
+        if self.has_mask:
+            self.mask[slot, env_id] = obs["mask"]
+            obs = obs["obs"]
+        self.obs[slot, env_id] = obs
+
+    def read_obs(self, slot, index):
+        if self.has_mask:
+            return {"obs": self.obs[slot, index], "mask": self.mask[slot, index]}
+        return self.obs[slot, index]
+
+    def close(self):
+        for field, _, _ in self.specs:
+            setattr(self, field, None)
+        self.shm.close()
+
+
+def _worker(conn, env_fns, env_ids, shm_name, ring_size, env_num, obs_shape, obs_dtype, mask_shape):
+    arrays = SharedArrays(ring_size, env_num, obs_shape, obs_dtype, mask_shape, name=shm_name)
+    envs = {env_id: env_fn() for env_id, env_fn in zip(env_ids, env_fns)}
+    try:
+        while True:
+            command, slot, ids, data = conn.recv()
+            if command == "step":
+                infos = []
+                for env_id, action in zip(ids, data):
+                    obs, reward, terminated, truncated, info = envs[env_id].step(action)
+                    arrays.write_obs(slot, env_id, obs)
+                    arrays.reward[slot, env_id] = reward
+                    arrays.terminated[slot, env_id] = terminated
+                    arrays.truncated[slot, env_id] = truncated
+                    infos.append(info)
+                conn.send(infos)
+            elif command == "reset":
+                infos = []
+                for env_id in ids:
+                    obs, info = envs[env_id].reset(**data)
+                    arrays.write_obs(slot, env_id, obs)
+                    infos.append(info)
+                conn.send(infos)
+            elif command == "seed":
+                conn.send([envs[env_id].seed(seed) for env_id, seed in zip(ids, data)])
+            elif command == "getattr":
+                conn.send([getattr(envs[env_id], data) for env_id in ids])
+            elif command == "close":
+                for env in envs.values():
+                    env.close()
+                conn.send(None)
+                break
+    finally:
+        arrays.close()
+        conn.close()
+
+
+class SharedMemoryVectorEnv:
+    # Process-pool vector env for Simulation. Workers write observations, rewards and done
+    # flags straight into a shared memory ring; only env ids and actions go over the pipes.
+    # Called for all envs the returned arrays are views into the ring, valid for ring_size - 1
+    # further calls; for a subset of ids they are copies.
+    # Implements the part of tianshou's BaseVectorEnv interface the Collector uses.
+    # env_fn is one callable for every env or, like tianshou's env_fns, a list with one per env.
+    is_async = False
+
+    def __init__(self, env_fn, env_num, worker_num=None, ring_size=4):
+        env_fns = list(env_fn) if isinstance(env_fn, (list, tuple)) else [env_fn] * env_num
+        self.env_num = env_num
+        self.worker_num = min(worker_num or os.cpu_count() or 1, env_num)
+        self.ring_size = ring_size
+        self.slot = 0
+
+        env = env_fns[0]()
+        obs, _ = env.reset()
+        self.observation_space = [env.observation_space] * env_num
+        self.action_space = [env.action_space] * env_num
+        env.close()
+
+        # masked observations go into two rings, returned as {"obs": ..., "mask": ...} of stacked arrays
+        mask_shape = None
+        if isinstance(obs, dict):
+            mask_shape = np.shape(obs["mask"])
+            obs = np.asarray(obs["obs"])
+        self.arrays = SharedArrays(ring_size, env_num, obs.shape, obs.dtype, mask_shape)
+        # contiguous chunks of envs per worker
+        self.worker_of_env = np.arange(env_num) * self.worker_num // env_num
+        self.conns = []
+        self.processes = []
+        for worker_id in range(self.worker_num):
+            parent_conn, child_conn = mp.Pipe()
+            env_ids = np.flatnonzero(self.worker_of_env == worker_id).tolist()
+            worker_env_fns = [env_fns[env_id] for env_id in env_ids]
+            process = mp.Process(
+                target=_worker,
+                args=(child_conn, worker_env_fns, env_ids, self.arrays.shm.name, ring_size, env_num, obs.shape,
+                      obs.dtype, mask_shape),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        self.closed = False
+
+    def __len__(self):
+        return self.env_num
+
+    def _wrap_id(self, id=None):
+        if id is None:
+            return np.arange(self.env_num)
+        return np.atleast_1d(np.asarray(id, dtype=np.int64))
+
+    def _index(self, id, env_ids):
+        return slice(None) if id is None else env_ids
+
+    def _next_slot(self):
+        slot = self.slot
+        self.slot = (self.slot + 1) % self.ring_size
+        return slot
+
+    def _call(self, command, slot, env_ids, data):
+        # scatter per-worker requests, then gather replies back into env_ids order
+        worker_ids = self.worker_of_env[env_ids]
+        requests = []
+        for worker_id in np.unique(worker_ids):
+            positions = np.flatnonzero(worker_ids == worker_id)
+            worker_data = [data[p] for p in positions] if isinstance(data, list) else data
+            self.conns[worker_id].send((command, slot, env_ids[positions].tolist(), worker_data))
+            requests.append((worker_id, positions))
+        replies = [None] * len(env_ids)
+        for worker_id, positions in requests:
+            for position, reply in zip(positions, self.conns[worker_id].recv()):
+                replies[position] = reply
+        return replies
+
+    def reset(self, id=None, **kwargs):
+        env_ids = self._wrap_id(id)
+        slot = self._next_slot()
+        infos = self._call("reset", slot, env_ids, kwargs)
+        return self.arrays.read_obs(slot, self._index(id, env_ids)), np.array(infos, dtype=object)
+
+    def step(self, action, id=None):
+        env_ids = self._wrap_id(id)
+        slot = self._next_slot()
+        infos = self._call("step", slot, env_ids, list(np.asarray(action)))
+        index = self._index(id, env_ids)
+        return (
+            self.arrays.read_obs(slot, index),
+            self.arrays.reward[slot, index],
+            self.arrays.terminated[slot, index],
+            self.arrays.truncated[slot, index],
+            np.array(infos, dtype=object),
+        )
+
+    def seed(self, seed=None):
+        env_ids = self._wrap_id()
+        seeds = [None if seed is None else seed + i for i in range(self.env_num)]
+        return self._call("seed", 0, env_ids, seeds)
+
+    def get_env_attr(self, key, id=None):
+        return self._call("getattr", 0, self._wrap_id(id), key)
+
+    def render(self, **kwargs):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        for conn in self.conns:
+            conn.send(("close", 0, [], None))
+        for conn, process in zip(self.conns, self.processes):
+            conn.recv()
+            process.join()
+        self.arrays.close()
+        self.arrays.shm.unlink()
+        self.closed = True
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
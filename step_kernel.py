@@ -0,0 +1,153 @@
+import numpy as np
+
+from Simulation import PlaneStatus
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Compiled core of Simulation(engine="jit"): the step engine's boarding, demand decrement, rank
+# updates, rewards, moves and plane counts as loops over plain arrays, written straight into the
+# Fleet and Resources arrays (the observation buffer included). Demand is still drawn by
+# Resources' numpy generator, so a seeded episode is the same as with engine="step".
+# The functions below are plain Python until numba compiles them at the end of the module.
+
+
+def rank_rows(demand, ranks, rows, row_count):
+    # demand_ranks of rows[:row_count], the same keys with one argsort per row
+    port_count = demand.shape[1]
+    key = np.empty(port_count, dtype=np.int64)
+    for i in range(row_count):
+        departure = rows[i]
+        for port in range(port_count):
+            key[port] = port + 1 - np.int64(demand[departure, port]) * (port_count + 1)
+        key[departure] -= departure + 1
+        order = np.argsort(key)
+        for rank in range(port_count):
+            ranks[departure, order[rank]] = rank
+
+
+def set_demand(demand, new_demand, ranks, rows):
+    port_count = demand.shape[1]
+    for departure in range(port_count):
+        for arrival in range(port_count):
+            demand[departure, arrival] = new_demand[departure, arrival]
+    rank_rows(demand, ranks, rows, port_count)
+
+
+def step_planes(action, capacity, departure_port_id, current_port_id, arrival_port_id, passenger_count,
+                passenger_ratio, fly_miles, route_completion, status, latitude, longitude, demand, ranks,
+                distances, port_latitude, port_longitude, plane_counts, departure, boarded, reward, changed_rows,
+                row_changed):
+    # Fleet.step for every plane: planes board in plane id order, the ranks of the rows
+    # something boarded from are updated once all have boarded, then the rewards are read
+    plane_count = len(action)
+    port_count = demand.shape[1]
+    all_stay = True
+    for plane in range(plane_count):
+        if action[plane] < 0 or action[plane] >= port_count:
+            raise IndexError("action out of the port range")
+        departure[plane] = departure_port_id[plane]
+        if action[plane] != departure[plane]:
+            all_stay = False
+
+    for plane in range(plane_count):
+        arrival_port_id[plane] = action[plane]
+        boarded[plane] = 0
+        reward[plane] = -1.0
+    if all_stay:
+        # nobody moves: nothing boards and the demand, so the ranks, stay as they are
+        for plane in range(plane_count):
+            fly_miles[plane] = 0
+    else:
+        changed = 0
+        for plane in range(plane_count):
+            port, arrival = departure[plane], action[plane]
+            fly_miles[plane] = distances[port, arrival]
+            seated = np.int64(min(demand[port, arrival], capacity[plane]))
+            demand[port, arrival] -= seated
+            boarded[plane] = seated
+            if seated > 0 and not row_changed[port]:
+                row_changed[port] = True
+                changed_rows[changed] = port
+                changed += 1
+        rank_rows(demand, ranks, changed_rows, changed)
+        for i in range(changed):
+            row_changed[changed_rows[i]] = False
+        for plane in range(plane_count):
+            port, arrival = departure[plane], action[plane]
+            if port != arrival:
+                reward[plane] = (port_count - ranks[port, arrival]) / port_count
+
+    wait = PlaneStatus.WAIT.value
+    plane_counts[:] = 0
+    for plane in range(plane_count):
+        arrival = action[plane]
+        passenger_count[plane] = boarded[plane]
+        passenger_ratio[plane] = boarded[plane] / capacity[plane]
+        current_port_id[plane] = arrival
+        departure_port_id[plane] = arrival
+        arrival_port_id[plane] = -1
+        status[plane] = wait
+        route_completion[plane] = 0
+        latitude[plane] = port_latitude[arrival]
+        longitude[plane] = port_longitude[arrival]
+        plane_counts[arrival] += 1
+
+
+available = njit is not None
+if available:
+    # cached next to the module so every worker process after the first loads the machine code
+    rank_rows = njit(cache=True)(rank_rows)
+    set_demand = njit(cache=True)(set_demand)
+    step_planes = njit(cache=True)(step_planes)
+
+
+class StepKernel:
+    # The arrays of one Simulation the kernels work on and their scratch buffers.
+    def __init__(self, resources):
+        fleet = resources.fleet
+        port_count = len(resources.ports)
+        self.resources = resources
+        self.distances = np.asarray(resources.distance_matrix.distances)
+        self.all_rows = np.arange(port_count)
+        self.departure = np.zeros(fleet.size, dtype=np.int64)
+        self.boarded = np.zeros(fleet.size, dtype=np.int64)
+        self.reward = np.zeros(fleet.size)
+        self.changed_rows = np.zeros(port_count, dtype=np.int64)
+        self.row_changed = np.zeros(port_count, dtype=bool)
+
+    def step(self, action, step, stats=None):
+        # moves every plane to its action port, returns the (reused) per plane rewards
+        resources = self.resources
+        fleet = resources.fleet
+        action = np.broadcast_to(np.asarray(action, dtype=np.int64), fleet.id.shape)
+        if stats is not None:
+            departure = fleet.departure_port_id
+            stats.count("invalid_actions", (~resources.valid_route(departure, action)).sum())
+            stats.count("fallback_distances", resources.distance_matrix.missing[departure, action].sum())
+        step_planes(action, fleet.capacity, fleet.departure_port_id, fleet.current_port_id, fleet.arrival_port_id,
+                    fleet.current_passenger_count, fleet.current_passenger_ratio, fleet.curr_fly_total_miles,
+                    fleet.route_completion, fleet.status, fleet.latitude, fleet.longitude, resources.demand,
+                    resources.ranks, self.distances, resources.port_latitude, resources.port_longitude,
+                    resources.observation[0], self.departure, self.boarded, self.reward, self.changed_rows,
+                    self.row_changed)
+        if stats is not None:
+            stats.count("boarded_passengers", self.boarded.sum())
+            stats.lap("move")
+        if fleet.trajectory.retention != "off":
+            status = np.where(self.departure == action, PlaneStatus.WAIT.value, PlaneStatus.FLY.value)
+            fleet.trajectory.record(step, fleet.id, self.departure, action, self.boarded, self.reward, status)
+            if stats is not None:
+                stats.lap("trajectory")
+        return self.reward
+
+    def set_demand(self, demand):
+        # the kernels keep ranks itself up to date, Resources.rank_keys is only read by board()
+        resources = self.resources
+        set_demand(resources.demand, np.asarray(demand), resources.ranks, self.all_rows)
+
+    def count_planes(self):
+        self.resources.observation[0] = np.bincount(self.resources.fleet.current_port_id,
+                                                    minlength=len(self.resources.ports))
@@ -0,0 +1,202 @@
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from airport_dataset import get_dataset
+
+# Hyperparameter sweep over Rl.test_rainbow: every trial is a short CPU run in its own process,
+# with a fixed number of torch threads so that concurrent trials fill the cores without
+# oversubscribing them. Trials whose test reward falls below the median of the others at the
+# same env step are stopped through Rl's --stop-file.
+
+
+def rl_defaults():
+    sys.argv = sys.argv[:1]  # Rl.get_args parses the command line at import
+    import Rl
+    return Rl, Rl.get_args()
+
+
+def rl_actions():
+    Rl, _ = rl_defaults()
+    return {action.dest: action for action in Rl.get_parser()._actions}
+
+
+def parse_value(text, action):
+    # typed like Rl's argparse action for the argument, lists (--hidden-sizes) separated by spaces
+    if isinstance(action, argparse._StoreConstAction):
+        return text.lower() in ("1", "true", "yes")
+    convert = action.type or str
+    if action.nargs is not None and action.nargs != "?":
+        return [convert(item) for item in text.split()]
+    return convert(text)
+
+
+def parse_assignments(assignments, actions, multiple):
+    # ["lr=1e-4,3e-4", ...] -> {"lr": [0.0001, 0.0003]}, a single value each unless multiple
+    parsed = {}
+    for assignment in assignments:
+        name, _, values = assignment.partition("=")
+        key = name.replace("-", "_")
+        if key not in actions:
+            raise ValueError(f"Rl.py has no argument --{name}")
+        values = [parse_value(value, actions[key]) for value in values.split(",")]
+        parsed[key] = values if multiple else values[0]
+    return parsed
+
+
+def make_trials(space, samples, seed):
+    # the full grid, or `samples` distinct points of it
+    keys = list(space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*space.values())]
+    if samples and samples < len(grid):
+        rng = np.random.default_rng(seed)
+        grid = [grid[i] for i in sorted(rng.choice(len(grid), samples, replace=False))]
+    return grid
+
+
+def pin_threads(threads):
+    # once per worker process, before torch is imported, so the OpenMP/MKL pools get the same size
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def trial_log_path(sweep_dir, trial_id):
+    # where Rl.py writes the trial's tensorboard events and checkpoints
+    return os.path.join(sweep_dir, f"trial_{trial_id:03d}", "Simulation", "rainbow")
+
+
+def run_trial(trial_id, params, fixed, sweep_dir):
+    Rl, args = rl_defaults()
+    for key, value in {**fixed, **params}.items():
+        setattr(args, key, value)
+    args.device = "cpu"
+    args.logdir = os.path.join(sweep_dir, f"trial_{trial_id:03d}")
+    args.stop_file = os.path.join(trial_log_path(sweep_dir, trial_id), "STOP")
+    record = {"trial": trial_id, **params, "status": "done", "best_reward": None, "train_step": None,
+              "seconds": None, "error": ""}
+    start = time.perf_counter()
+    try:
+        result = Rl.test_rainbow(args)
+        record.update(best_reward=result["best_reward"], train_step=result.get("train_step"))
+        # a stop file that came after the last epoch did not cut the trial short
+        if os.path.exists(args.stop_file) and result.get("train_step", 0) < args.epoch * args.step_per_epoch:
+            record["status"] = "pruned"
+    except Exception as e:
+        record.update(status="failed", error=repr(e))
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def read_test_rewards(log_path):
+    # (env steps, test rewards) logged so far by the trial's TensorboardLogger
+    from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
+    if not os.path.isdir(log_path):
+        return np.zeros(0), np.zeros(0)
+    accumulator = EventAccumulator(log_path, size_guidance={"scalars": 0})
+    accumulator.Reload()
+    if "test/reward" not in accumulator.Tags()["scalars"]:
+        return np.zeros(0), np.zeros(0)
+    events = accumulator.Scalars("test/reward")
+    return np.array([event.step for event in events]), np.array([event.value for event in events])
+
+
+def best_until(steps, rewards, step):
+    reached = steps <= step
+    return rewards[reached].max() if reached.any() else None
+
+
+def prune(running, sweep_dir, min_step, min_trials):
+    # Median stopping rule: a running trial whose best test reward so far is below the median of
+    # the other trials' best rewards up to the same env step gets its stop file.
+    curves = {trial_id: read_test_rewards(trial_log_path(sweep_dir, trial_id)) for trial_id in running["all"]}
+    pruned = []
+    for trial_id in running["active"]:
+        steps, rewards = curves[trial_id]
+        if len(steps) == 0 or steps[-1] < min_step:
+            continue
+        step = steps[-1]
+        others = [best_until(*curves[other], step) for other in curves if other != trial_id
+                  and len(curves[other][0]) and curves[other][0][-1] >= step]
+        others = [value for value in others if value is not None]
+        if len(others) >= min_trials and rewards.max() < np.median(others):
+            stop_file = os.path.join(trial_log_path(sweep_dir, trial_id), "STOP")
+            if not os.path.exists(stop_file):
+                open(stop_file, "w").close()
+                pruned.append(trial_id)
+    return pruned
+
+
+def write_results(records, path, keys):
+    columns = ["trial", *keys, "status", "best_reward", "train_step", "seconds", "error"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(records)
+    ranked = sorted(records, key=lambda record: -np.inf if record["best_reward"] is None else record["best_reward"],
+                    reverse=True)
+    print(" | ".join(columns[:-1]))
+    for record in ranked:
+        print(" | ".join(str(record[column]) for column in columns[:-1]))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--param", action="append", default=[],
+                        help="Rl.py argument and the values to try, e.g. lr=1e-4,3e-4 or 'hidden-sizes=128 128,256 256'")
+    parser.add_argument("--set", action="append", default=[], help="Rl.py argument fixed for every trial, e.g. epoch=5")
+    parser.add_argument("--samples", type=int, default=None, help="random points of the grid instead of all of it")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per trial")
+    parser.add_argument("--workers", type=int, default=None, help="concurrent trials, cores / threads by default")
+    parser.add_argument("--sweep-dir", type=str, default=os.path.join("log", "sweep"))
+    parser.add_argument("--prune-interval", type=float, default=30.0, help="seconds between median stopping checks")
+    parser.add_argument("--prune-min-step", type=int, default=0, help="env steps before a trial can be stopped")
+    parser.add_argument("--prune-min-trials", type=int, default=3, help="trials to compare with before stopping one")
+    parser.add_argument("--no-prune", action="store_true")
+    return parser.parse_args()
+
+
+def main(args):
+    actions = rl_actions()
+    space = parse_assignments(args.param, actions, multiple=True)
+    fixed = parse_assignments(args.set, actions, multiple=False)
+    trials = make_trials(space, args.samples, args.seed)
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    # compile the airport bundle once here, the trials then memory-map the same read-only pages
+    get_dataset()
+    print(f"{len(trials)} trials on {workers} workers with {args.threads} threads each")
+
+    records = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=pin_threads, initargs=(args.threads,)) as pool:
+        futures = {pool.submit(run_trial, trial_id, params, fixed, args.sweep_dir): trial_id
+                   for trial_id, params in enumerate(trials)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=args.prune_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                records.append(future.result())
+                print(f"trial {futures[future]}: {records[-1]['status']}, best reward {records[-1]['best_reward']}")
+            if not args.no_prune and pending:
+                # trials still queued have no log yet and are skipped
+                running = {"all": list(futures.values()), "active": [futures[future] for future in pending]}
+                for trial_id in prune(running, args.sweep_dir, args.prune_min_step, args.prune_min_trials):
+                    print(f"trial {trial_id}: stopping, below the median")
+
+    records.sort(key=lambda record: record["trial"])
+    write_results(records, os.path.join(args.sweep_dir, "results.csv"), list(space))
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -1,64 +1,150 @@
 import requests
 import json
-import copy
+import hashlib
+import sqlite3
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from thy_api_config import *
 
 
-class ThyAPI: 
-    def __init__(self) -> None:
-        pass
+class ResponseCache:
+    # Persistent JSON response store keyed by endpoint and normalized payload.
+    # ttl is in seconds, None keeps responses forever.
+    def __init__(self, path, ttl=None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, payload TEXT, "
+                "response TEXT, created REAL)"
+            )
+
+    @staticmethod
+    def normalize(payload):
+        return json.dumps(payload, sort_keys=True, separators=(",", ":"))
+
+    def key(self, url, payload):
+        return hashlib.sha256((url + "\n" + self.normalize(payload)).encode()).hexdigest()
+
+    def get(self, url, payload):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (self.key(url, payload),)
+            ).fetchone()
+        if row is None:
+            return None
+        response, created = row
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return None
+        return json.loads(response)
+
+    def set(self, url, payload, response_json):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (self.key(url, payload), url, self.normalize(payload), json.dumps(response_json), time.time()),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class ThyAPI:
+    # requests.Session backed client: keep-alive connection pool, timeouts, retries with
+    # exponential backoff on connection errors and 429/5xx, and an optional on-disk cache.
+    # The endpoint urls can be pointed at a local stub server.
+    def __init__(self, timeout=10, retries=3, backoff_factor=0.5, pool_size=10, cache_path=None, cache_ttl=None,
+                 ports_url=get_ports_url, sector_url=get_sector_url, availability_url=availability_url) -> None:
+        self.timeout = timeout
+        self.ports_url = ports_url
+        self.sector_url = sector_url
+        self.availability_url = availability_url
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["POST"]))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-    def get_domestic_ports(self): 
-        payload = copy.deepcopy(get_ports_payload)
-        response = requests.request("POST", get_ports_url, headers=headers, data=json.dumps(payload))
+        self.cache = ResponseCache(cache_path, cache_ttl) if cache_path is not None else None
+
+    def post(self, url, payload):
+        if self.cache is not None:
+            cached = self.cache.get(url, payload)
+            if cached is not None:
+                return cached
+        response = self.session.post(url, data=json.dumps(payload), timeout=self.timeout)
+        response.raise_for_status()
         response_json = response.json()
+        if self.cache is not None:
+            self.cache.set(url, payload, response_json)
+        return response_json
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def get_domestic_ports(self):
+        response_json = self.post(self.ports_url, get_ports_payload)
         ports = response_json["data"]["Port"]
         domestic_ports = []
-        for port in ports: 
+        for port in ports:
             if port["IsDomestic"] == True:
                 coordinate = port["Coordinate"]
                 code = port["Code"]
                 # name = port["LanguageInfo"]["Language"][0]["Name"]
                 domestic_port = [code, coordinate]
                 domestic_ports.append(domestic_port)
-        return domestic_ports 
-    
-    def get_distance_between_ports(self, departure_code, arrival_code): 
-        payload = copy.deepcopy(get_sector_payload)
-        payload["departureAirport"] = departure_code
-        payload["arrivalAirport"] = arrival_code
-        response = requests.request("POST", get_sector_url, headers=headers, data=json.dumps(payload))
-        return response.json()
-
-    def get_availability(self, origin_code, destination_code, date): 
-        payload = copy.deepcopy(availability_payload)
-        payload["OriginDestinationInformation"][0]["DepartureDateTime"]["Date"] = date
-        payload["OriginDestinationInformation"][0]["DepartureDateTime"]["Date"] = date
-        payload["OriginDestinationInformation"][0]["DepartureDateTime"]["Date"] = date
-        response = requests.request("POST", availability_url, headers=headers, data=json.dumps(payload))
-        return response.json()
-
-
-if __name__ == "__main__": 
-    api = ThyAPI()
+        return domestic_ports
+
+    def get_distance_between_ports(self, departure_code, arrival_code):
+        # the templates are never mutated, so a shallow copy is enough
+        payload = {**get_sector_payload, "departureAirport": departure_code, "arrivalAirport": arrival_code}
+        return self.post(self.sector_url, payload)
+
+    def get_availability(self, origin_code, destination_code, date):
+        # outbound leg origin -> destination and the return leg back, both on date
+        legs = []
+        for leg, (origin, destination) in zip(availability_payload["OriginDestinationInformation"],
+                                              ((origin_code, destination_code), (destination_code, origin_code))):
+            legs.append({
+                **leg,
+                "DepartureDateTime": {**leg["DepartureDateTime"], "Date": date},
+                "OriginLocation": {**leg["OriginLocation"], "LocationCode": origin},
+                "DestinationLocation": {**leg["DestinationLocation"], "LocationCode": destination},
+            })
+        payload = {**availability_payload, "OriginDestinationInformation": legs}
+        return self.post(self.availability_url, payload)
+
+
+if __name__ == "__main__":
+    # see thy_crawler.py for the options of the refresh (concurrency, rate limit, availability sweep)
+    import asyncio
+    from thy_crawler import refresh_distances
+
+    # re-running only hits the network for pairs missing from the journal or the cache
+    api = ThyAPI(cache_path="thy_api_cache.sqlite", cache_ttl=30 * 24 * 3600, pool_size=16)
     domestic_ports = api.get_domestic_ports()
     # ports = {}
-    # for port in domestic_ports: 
+    # for port in domestic_ports:
     #     ports[port[0]] = port[1]
     # with open('ports.json', 'w') as fp:
     #     json.dump(ports, fp)
 
-    port_distances = {}
-    for port in domestic_ports: 
-        port_distances[port[0]] = {}
-        for other_port in domestic_ports: 
-            if port[0] != other_port[0]: 
-                try: 
-                    distance = api.get_distance_between_ports(port[0], other_port[0])["data"]["distance"]
-                    port_distances[port[0]][other_port[0]] = distance
-                except: 
-                    print("Distance not found")
+    port_distances, report = asyncio.run(refresh_distances(api, [port[0] for port in domestic_ports],
+                                                           "port_distances.jsonl"))
+    for failure in report["failed"]:
+        print("Distance not found", failure["key"], failure["error"])
     with open('port_distances.json', 'w') as fp:
         json.dump(port_distances, fp)
-    # api.get_distance_between_ports("IST", "BAL")
\ No newline at end of file
+    api.close()
+    # api.get_distance_between_ports("IST", "BAL")
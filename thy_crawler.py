@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from thy_api import ThyAPI
+
+
+class RateLimiter:
+    # token bucket allowing `rate` requests per second with bursts of up to `burst`
+    def __init__(self, rate, burst=1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CrawlJournal:
+    # Append-only JSON lines file of finished requests, written as results arrive so an
+    # interrupted crawl resumes where it stopped. The last line of a key wins.
+    def __init__(self, path) -> None:
+        self.path = path
+        self.results = {}  # key -> value
+        self.failures = {}  # key -> {"error": str, "attempts": int}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a crash can leave a partial last line behind
+                        continue
+                    self._apply(entry)
+        self.file = open(path, "a")
+
+    def _apply(self, entry):
+        key = tuple(entry["key"])
+        if entry["ok"]:
+            self.results[key] = entry["value"]
+            self.failures.pop(key, None)
+        else:
+            attempts = self.failures.get(key, {}).get("attempts", 0) + 1
+            self.failures[key] = {"error": entry["error"], "attempts": attempts}
+
+    def write(self, entry):
+        self._apply(entry)
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+async def crawl(api, tasks, fetch, journal, concurrency=16, rate=None, retry_failed=True):
+    # Runs fetch(api, *args) for every (key, args) task not already in the journal, with at most
+    # `concurrency` requests in flight and at most `rate` requests per second. ThyAPI is
+    # synchronous, so the requests run on a thread pool sharing its connection pool and cache.
+    pending = [(key, args) for key, args in tasks
+               if key not in journal.results and (retry_failed or key not in journal.failures)]
+    limiter = RateLimiter(rate, burst=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def run(executor, key, args):
+        async with semaphore:
+            await limiter.acquire()
+            try:
+                value = await loop.run_in_executor(executor, fetch, api, *args)
+                journal.write({"key": list(key), "ok": True, "value": value})
+            except Exception as e:
+                journal.write({"key": list(key), "ok": False, "error": f"{type(e).__name__}: {e}"})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*(run(executor, key, args) for key, args in pending))
+    failed_keys = [key for key, _ in tasks if key in journal.failures]
+    return {
+        "tasks": len(tasks),
+        "fetched": len(pending),
+        "skipped": len(tasks) - len(pending),
+        "failed": [{"key": list(key), **journal.failures[key]} for key in failed_keys],
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def fetch_distance(api, departure_code, arrival_code):
+    return api.get_distance_between_ports(departure_code, arrival_code)["data"]["distance"]
+
+
+def fetch_availability(api, origin_code, destination_code, date):
+    return api.get_availability(origin_code, destination_code, date)
+
+
+async def refresh_distances(api, codes, journal_path, concurrency=16, rate=None):
+    # Distances are symmetric, so only one direction of every pair is requested and the
+    # returned table has both.
+    tasks = [((a, b), (a, b)) for i, a in enumerate(codes) for b in codes[i + 1:]]
+    journal = CrawlJournal(journal_path)
+    try:
+        report = await crawl(api, tasks, fetch_distance, journal, concurrency, rate)
+    finally:
+        journal.close()
+    port_distances = {code: {} for code in codes}
+    for (a, b), distance in journal.results.items():
+        if a in port_distances and b in port_distances:
+            port_distances[a][b] = distance
+            port_distances[b][a] = distance
+    return port_distances, report
+
+
+async def sweep_availability(api, origins, destinations, dates, journal_path, concurrency=16, rate=None):
+    tasks = [((origin, destination, date), (origin, destination, date))
+             for origin in origins for destination in destinations for date in dates if origin != destination]
+    journal = CrawlJournal(journal_path)
+    try:
+        report = await crawl(api, tasks, fetch_availability, journal, concurrency, rate)
+    finally:
+        journal.close()
+    availability = {"|".join(key): journal.results[key] for key, _ in tasks if key in journal.results}
+    return availability, report
+
+
+def check_crawler(codes=("AAA", "BBB", "CCC", "DDD", "EEE", "FFF"), failing=("BBB", "DDD"), concurrency=4,
+                  latency=0.05, rate=40):
+    # refresh_distances against a local stub server answering after `latency` seconds:
+    # - a first crawl where the stub fails one pair must overlap requests, never have more than
+    #   `concurrency` in flight and take well under the sequential pairs * latency;
+    # - a resumed crawl on the same journal must skip every finished pair and fetch only the
+    #   failed one;
+    # - a crawl on a fresh journal limited to `rate` requests per second must not beat the rate
+    #   after its first burst of `concurrency`.
+    # Raises RuntimeError when any of it does not hold, returns the three reports otherwise.
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    served = {}  # (departure, arrival) -> sector requests the stub served
+    state = {"fail": True, "in_flight": 0, "peak": 0}
+    lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == "/ports":
+                body = {"data": {"Port": [{"Code": code, "IsDomestic": True, "Coordinate": {}} for code in codes]}}
+            else:
+                pair = (payload["departureAirport"], payload["arrivalAirport"])
+                with lock:
+                    served[pair] = served.get(pair, 0) + 1
+                    state["in_flight"] += 1
+                    state["peak"] = max(state["peak"], state["in_flight"])
+                time.sleep(latency)
+                with lock:
+                    state["in_flight"] -= 1
+                if state["fail"] and pair == failing:
+                    # not a retried status, so the failure reaches the journal
+                    self.send_error(404)
+                    return
+                body = {"data": {"distance": codes.index(pair[0]) * 100 + codes.index(pair[1])}}
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def crawl_stub(journal_path, fail, crawl_rate=None):
+        state["fail"] = fail
+        state["peak"] = 0
+        api = ThyAPI(ports_url=url + "/ports", sector_url=url + "/sector", availability_url=url + "/availability",
+                     pool_size=concurrency)
+        try:
+            crawled_codes = [port[0] for port in api.get_domestic_ports()]
+            port_distances, report = asyncio.run(refresh_distances(api, crawled_codes, journal_path, concurrency,
+                                                                   crawl_rate))
+        finally:
+            api.close()
+        return port_distances, {**report, "peak_in_flight": state["peak"]}
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            journal_path = os.path.join(directory, "port_distances.jsonl")
+            _, first = crawl_stub(journal_path, fail=True)
+            port_distances, resumed = crawl_stub(journal_path, fail=False)
+            resumed_served = dict(served)
+            _, limited = crawl_stub(os.path.join(directory, "limited.jsonl"), fail=False, crawl_rate=rate)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    pair_count = len(codes) * (len(codes) - 1) // 2
+    sequential_seconds = pair_count * latency
+    problems = []
+    if first["fetched"] != pair_count or [failure["key"] for failure in first["failed"]] != [list(failing)]:
+        problems.append(f"the first crawl should fetch all {pair_count} pairs and fail only {failing}: {first}")
+    if not 1 < first["peak_in_flight"] <= concurrency:
+        problems.append(f"the first crawl should have 2 to {concurrency} requests in flight: {first}")
+    if first["seconds"] > sequential_seconds / 2:
+        problems.append(f"the first crawl should take well under the sequential {sequential_seconds:.2f}s: {first}")
+    if resumed["fetched"] != 1 or resumed["skipped"] != pair_count - 1 or resumed["failed"]:
+        problems.append(f"the resumed crawl should fetch only {failing}: {resumed}")
+    if any(count != (2 if pair == failing else 1) for pair, count in resumed_served.items()) or \
+            len(resumed_served) != pair_count:
+        problems.append(f"the stub should see every pair once and {failing} twice: {resumed_served}")
+    if port_distances[failing[0]].get(failing[1]) != codes.index(failing[0]) * 100 + codes.index(failing[1]):
+        problems.append(f"the retried distance of {failing} is missing: {port_distances}")
+    # the bucket starts full, so the first `concurrency` requests go out at once
+    if limited["fetched"] != pair_count or limited["seconds"] < (pair_count - concurrency) / rate:
+        problems.append(f"the crawl limited to {rate} requests/s should take at least "
+                        f"{(pair_count - concurrency) / rate:.2f}s: {limited}")
+    if problems:
+        raise RuntimeError("; ".join(problems))
+    return first, resumed, limited
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    # check runs check_crawler against a local stub server instead of the real endpoints
+    parser.add_argument("command", choices=["distances", "availability", "check"])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=None, help="max requests per second")
+    parser.add_argument("--journal", type=str, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--report", type=str, default=None)
+    parser.add_argument("--cache", type=str, default="thy_api_cache.sqlite")
+    parser.add_argument("--dates", type=str, nargs="*", default=["30APR"])
+    return parser.parse_args()
+
+
+def main(args):
+    if args.command == "check":
+        first, resumed, limited = check_crawler()
+        print(f"first crawl: {first['fetched']} fetched in {first['seconds']:.2f}s, at most "
+              f"{first['peak_in_flight']} in flight, {len(first['failed'])} failed; resumed crawl: "
+              f"{resumed['fetched']} fetched, {resumed['skipped']} already done; rate limited crawl: "
+              f"{limited['fetched']} fetched in {limited['seconds']:.2f}s")
+        return
+    api = ThyAPI(cache_path=args.cache, pool_size=args.concurrency)
+    codes = [port[0] for port in api.get_domestic_ports()]
+    if args.command == "distances":
+        result, report = asyncio.run(refresh_distances(
+            api, codes, args.journal or "port_distances.jsonl", args.concurrency, args.rate))
+        output = args.output or "port_distances.json"
+    else:
+        result, report = asyncio.run(sweep_availability(
+            api, codes, codes, args.dates, args.journal or "availability.jsonl", args.concurrency, args.rate))
+        output = args.output or "availability.json"
+    api.close()
+
+    with open(output, "w") as fp:
+        json.dump(result, fp)
+    with open(args.report or os.path.splitext(output)[0] + "_report.json", "w") as fp:
+        json.dump(report, fp, indent=2)
+    print(f"{report['fetched']} fetched, {report['skipped']} already done, {len(report['failed'])} failed "
+          f"in {report['seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+trajectory_dtype = np.dtype([
+    ("step", np.int32),  # first step of the run
+    ("span", np.int32),  # number of consecutive steps merged into this record
+    ("plane_id", np.int32),
+    ("status", np.int8),  # PlaneStatus value
+    ("departure_port_id", np.int16),
+    ("arrival_port_id", np.int16),
+    ("passengers", np.int32),
+    ("reward", np.float32),
+])
+
+
+class TrajectoryRecorder:
+    # Episode log of (step, plane, departure, arrival, passengers, reward) kept in one
+    # preallocated record array. Consecutive steps of a plane with the same status and route
+    # (e.g. a WAIT span at one port) are run-length encoded into a single record.
+    #   retention="off":  nothing is stored
+    #   retention="last": a ring of the last max_records records
+    #   retention="full": everything, the array doubles when it fills up
+    RETENTIONS = ("off", "last", "full")
+
+    def __init__(self, plane_count, retention="full", max_records=None, initial_capacity=1024):
+        if retention not in self.RETENTIONS:
+            raise ValueError(f"Unknown retention {retention!r}, expected one of {self.RETENTIONS}")
+        if retention == "last" and not max_records:
+            raise ValueError("retention='last' needs max_records")
+        self.retention = retention
+        if retention == "off":
+            capacity = 0
+        elif retention == "last":
+            capacity = max_records
+        else:
+            capacity = initial_capacity
+        self.records = np.zeros(capacity, dtype=trajectory_dtype)
+        self.count = 0  # records appended since the last clear, also their sequence numbers
+        self.last_seq = np.full(plane_count, -1, dtype=np.int64)  # latest record of each plane
+
+    def __len__(self):
+        return min(self.count, len(self.records))
+
+    @property
+    def nbytes(self):
+        return self.records.nbytes
+
+    def clear(self):
+        self.count = 0
+        self.last_seq[:] = -1
+
+    def _slot(self, seq):
+        if self.retention == "last":
+            return seq % len(self.records)
+        return seq
+
+    def _grow(self, size):
+        capacity = max(len(self.records), 1)
+        while capacity < size:
+            capacity *= 2
+        records = np.zeros(capacity, dtype=trajectory_dtype)
+        records[:self.count] = self.records[:self.count]
+        self.records = records
+
+    def record(self, step, plane_ids, departure_port_ids, arrival_port_ids, passengers, reward, status, span=1):
+        # span is the number of steps the move takes, more than one for a flight of the event engine
+        if self.retention == "off":
+            return
+        plane_ids = np.asarray(plane_ids)
+        departure_port_ids, arrival_port_ids, passengers, reward, status, span = np.broadcast_arrays(
+            departure_port_ids, arrival_port_ids, passengers, reward, status, span)
+
+        # extend the plane's latest record if it is still retained and this step continues it
+        last_seq = self.last_seq[plane_ids]
+        retained = last_seq >= max(0, self.count - len(self.records))
+        last_slot = self._slot(np.maximum(last_seq, 0))
+        last = self.records[last_slot]
+        extend = (retained & (last["status"] == status)
+                  & (last["departure_port_id"] == departure_port_ids) & (last["arrival_port_id"] == arrival_port_ids)
+                  & (last["step"] + last["span"] == step))
+        extend_slot = last_slot[extend]
+        self.records["span"][extend_slot] += span[extend]
+        self.records["passengers"][extend_slot] += passengers[extend]
+        self.records["reward"][extend_slot] += reward[extend]
+
+        new = ~extend
+        new_count = int(new.sum())
+        if self.retention == "full" and self.count + new_count > len(self.records):
+            self._grow(self.count + new_count)
+        seqs = self.count + np.arange(new_count)
+        slots = self._slot(seqs)
+        self.records["step"][slots] = step
+        self.records["span"][slots] = span[new]
+        self.records["plane_id"][slots] = plane_ids[new]
+        self.records["status"][slots] = status[new]
+        self.records["departure_port_id"][slots] = departure_port_ids[new]
+        self.records["arrival_port_id"][slots] = arrival_port_ids[new]
+        self.records["passengers"][slots] = passengers[new]
+        self.records["reward"][slots] = reward[new]
+        self.last_seq[plane_ids[new]] = seqs
+        self.count += new_count
+
+    def table(self):
+        # retained records in the order they were started
+        first_seq = max(0, self.count - len(self.records))
+        return self.records[self._slot(np.arange(first_seq, self.count))]
+
+    def plane_table(self, plane_id):
+        table = self.table()
+        return table[table["plane_id"] == plane_id]
+
+    def stops(self, plane_id):
+        # port the plane was at after every retained step
+        table = self.plane_table(plane_id)
+        return np.repeat(table["arrival_port_id"], table["span"])
+
+    def export(self, path):
+        # one compressed column per field
+        table = self.table()
+        np.savez_compressed(path, **{name: table[name] for name in trajectory_dtype.names})
+
+
+move_dtype = np.dtype([
+    ("hour", np.int32),  # when the plane leaves
+    ("hours", np.int32),  # flight duration, 0 for the starting position
+    ("plane_id", np.int32),
+    ("departure_port_id", np.int16),
+    ("arrival_port_id", np.int16),
+    ("reward", np.float32),
+])
+
+
+class EpisodeRecorder:
+    # Everything replay.py needs to draw an episode after the fact: every move of every plane
+    # with its departure hour and duration (the position at any hour is interpolated from it,
+    # as interpolate_location does) and the demand matrix after each step as uint16. save()
+    # writes one compressed .npz per episode together with the port names and coordinates; it
+    # only copies the episode, the compression runs on a background thread.
+    def __init__(self, port_names, port_latitude, port_longitude, initial_capacity=256):
+        self.port_names = np.asarray(port_names)
+        self.port_latitude = np.asarray(port_latitude)
+        self.port_longitude = np.asarray(port_longitude)
+        port_count = len(self.port_names)
+        self.moves = np.zeros(initial_capacity, dtype=move_dtype)
+        self.move_count = 0
+        self.demand = np.zeros((initial_capacity, port_count, port_count), dtype=np.uint16)
+        self.demand_hour = np.zeros(initial_capacity, dtype=np.int32)
+        self.demand_count = 0
+        self.executor = None
+        self.pending = None
+
+    def start(self, port_ids, demand):
+        # planes parked at port_ids at hour 0
+        self.move_count = 0
+        self.demand_count = 0
+        port_ids = np.asarray(port_ids)
+        self.record(0, np.arange(len(port_ids)), port_ids, port_ids, 0, 0.0)
+        self.record_demand(0, demand)
+
+    def record(self, hour, plane_ids, departure_port_ids, arrival_port_ids, hours, reward):
+        plane_ids = np.asarray(plane_ids)
+        count = self.move_count + len(plane_ids)
+        if count > len(self.moves):
+            moves = np.zeros(max(count, 2 * len(self.moves)), dtype=move_dtype)
+            moves[:self.move_count] = self.moves[:self.move_count]
+            self.moves = moves
+        new = self.moves[self.move_count:count]
+        new["hour"] = hour
+        new["hours"] = hours
+        new["plane_id"] = plane_ids
+        new["departure_port_id"] = departure_port_ids
+        new["arrival_port_id"] = arrival_port_ids
+        new["reward"] = reward
+        self.move_count = count
+
+    def record_demand(self, hour, demand):
+        if self.demand_count == len(self.demand):
+            grown = np.zeros((2 * len(self.demand), *self.demand.shape[1:]), dtype=self.demand.dtype)
+            grown[:self.demand_count] = self.demand
+            self.demand = grown
+            self.demand_hour = np.resize(self.demand_hour, 2 * len(self.demand_hour))
+        self.demand[self.demand_count] = demand
+        self.demand_hour[self.demand_count] = hour
+        self.demand_count += 1
+
+    def save(self, path, duration):
+        self.wait()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        arrays = {"moves": self.moves[:self.move_count].copy(), "demand": self.demand[:self.demand_count].copy(),
+                  "demand_hour": self.demand_hour[:self.demand_count].copy(), "port_names": self.port_names,
+                  "port_latitude": self.port_latitude, "port_longitude": self.port_longitude, "duration": duration}
+        self.pending = self.executor.submit(np.savez_compressed, path, **arrays)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,146 @@
+import os
+import time
+
+import numpy as np
+import pygame
+
+from Simulation import Port, Plane
+
+_image_cache = {}
+
+
+def load_image(path, size=None):
+    # Images are decoded and scaled once per process and shared by every env and plane.
+    key = (path, size)
+    if key not in _image_cache:
+        # the artwork (arkaplan.jpg background, ucak.png plane) is not in the repository
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Rendering needs the image {path!r} in the working directory")
+        image = pygame.image.load(path)
+        if size is not None:
+            image = pygame.transform.scale(image, size)
+        _image_cache[key] = image
+    return _image_cache[key]
+
+
+class Visualization:
+    # The background, port circles and labels only change with the ports, so they are drawn once
+    # into static_layer; a frame is that layer plus the planes. render() is called on every env
+    # step but only draws every frame_skip-th call and at most fps times per second (None for
+    # no limit), it never sleeps so the env runs at full speed.
+    def __init__(self, width, height, fps=30, frame_skip=1, margin=0.05) -> None:
+        pygame.init()  # pygame'i başlatır
+        self.width = width
+        self.height = height
+        self.screen = pygame.display.set_mode((self.width, self.height))  # ekranı oluşturur
+        pygame.display.set_caption("Simulasyon")  # pencere
+        # pencere başlığını ayarlar
+        self.background_image = load_image("arkaplan.jpg", (self.width, self.height))  # arkaplan resmini yükler
+        self.font = pygame.font.Font(None, 32)  # font nesnesi oluşturur
+        self.static_layer = None
+        self.fps = fps
+        self.frame_skip = max(1, frame_skip)
+        self.margin = margin
+        self.render_calls = 0
+        self.last_frame_time = None
+
+        # x is the longitude, y the latitude; set from the port coordinates by fit_bounds
+        self.boundary_min_x = 0
+        self.boundary_min_y = 0
+        self.boundary_max_x = 0
+        self.boundary_max_y = 0
+        self.lat_length = self.boundary_max_y - self.boundary_min_y
+        self.lon_length = self.boundary_max_x - self.boundary_min_x
+
+    def fit_bounds(self, latitude, longitude):
+        # The ports' bounding box with `margin` of it on each side, so labels stay on screen.
+        # Coordinates that are not valid degrees (ONQ in ports.json) are left out.
+        latitude, longitude = np.asarray(latitude), np.asarray(longitude)
+        valid = (np.abs(latitude) <= 90) & (np.abs(longitude) <= 180)
+        if valid.any():
+            latitude, longitude = latitude[valid], longitude[valid]
+        lon_pad = max(np.ptp(longitude), 1e-6) * self.margin
+        lat_pad = max(np.ptp(latitude), 1e-6) * self.margin
+        self.boundary_min_x = float(np.min(longitude)) - lon_pad
+        self.boundary_max_x = float(np.max(longitude)) + lon_pad
+        self.boundary_min_y = float(np.min(latitude)) - lat_pad
+        self.boundary_max_y = float(np.max(latitude)) + lat_pad
+        self.lat_length = self.boundary_max_y - self.boundary_min_y
+        self.lon_length = self.boundary_max_x - self.boundary_min_x
+
+    def project(self, latitude, longitude):
+        # screen coordinates of arrays of locations, north up
+        x = (np.asarray(longitude) - self.boundary_min_x) / self.lon_length * self.width
+        y = (self.boundary_max_y - np.asarray(latitude)) / self.lat_length * self.height
+        return x, y
+
+    def convert_geoloc_to_cart(self, loc):
+        x_loc, y_loc = self.project(loc["latitude"], loc["longitude"])
+        return (float(x_loc), float(y_loc))
+
+    def render_port(self, port: Port, surface=None):
+        self.draw_port(port.name, self.convert_geoloc_to_cart(port.location), surface)
+
+    def draw_port(self, name, position, surface=None):
+        surface = self.screen if surface is None else surface
+        color = (0, 0, 0)
+        circle_radius = 5
+        text_surface = self.font.render(name, True, color)  # metni renderlar
+        surface.blit(text_surface, (position[0], position[1] + circle_radius))  # metni çizer
+        pygame.draw.circle(surface, color, position, circle_radius)
+
+    def render_plane(self, plane: Plane):
+        plane_cart_loc = self.convert_geoloc_to_cart(plane.location)
+        self.screen.blit(plane.image, plane_cart_loc)
+
+    def build_static_layer(self, resources):
+        names = [port.name for port in resources.ports.values()]
+        self.draw_static_layer(names, resources.port_latitude, resources.port_longitude)
+
+    def draw_static_layer(self, names, latitude, longitude):
+        self.fit_bounds(latitude, longitude)
+        self.static_layer = self.background_image.convert()
+        self.port_latitude, self.port_longitude = np.asarray(latitude), np.asarray(longitude)
+        self.port_valid = (np.abs(self.port_latitude) <= 90) & (np.abs(self.port_longitude) <= 180)
+        x, y = self.project(latitude, longitude)
+        for name, position, shown in zip(names, zip(x.tolist(), y.tolist()), self.port_valid):  # havalimanlarını çizer
+            if shown:
+                self.draw_port(str(name), position, self.static_layer)
+
+    def frame_due(self):
+        self.render_calls += 1
+        if (self.render_calls - 1) % self.frame_skip:
+            return False
+        if self.fps is None:
+            return True
+        now = time.perf_counter()
+        if self.last_frame_time is not None and now - self.last_frame_time < 1 / self.fps:
+            return False
+        self.last_frame_time = now
+        return True
+
+    def draw_frame(self, latitude, longitude, port_demand=None, caption=None):
+        # the static layer, then (replay.py) each port's waiting passengers as a circle growing
+        # with their share of the busiest port, the planes and a caption line
+        self.screen.blit(self.static_layer, (0, 0))
+        if port_demand is not None:
+            x, y = self.project(self.port_latitude, self.port_longitude)
+            radius = 4 + 16 * np.asarray(port_demand) / max(np.max(port_demand), 1)
+            for position, r, shown in zip(zip(x.tolist(), y.tolist()), radius.tolist(), self.port_valid):
+                if shown:
+                    pygame.draw.circle(self.screen, (200, 40, 40), position, r, width=2)
+        image = load_image("ucak.png", Plane.image_size)
+        x, y = self.project(latitude, longitude)
+        self.screen.blits([(image, position) for position in zip(x.tolist(), y.tolist())], doreturn=False)
+        if caption is not None:
+            self.screen.blit(self.font.render(caption, True, (0, 0, 0)), (10, 10))
+        pygame.display.flip()
+
+    def render(self, resources, force=False):
+        if not (self.frame_due() or force):
+            return False
+        pygame.event.pump()  # keeps the window responsive
+        if self.static_layer is None:
+            self.build_static_layer(resources)
+        self.draw_frame(resources.fleet.latitude, resources.fleet.longitude)
+        return True